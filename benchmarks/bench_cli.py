@@ -0,0 +1,38 @@
+"""End to end runs of the command line interface, in a fresh process"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from .common import inputs_dir, repo_dir
+
+
+class CommandLine:
+    params = [[1, 30]]
+    param_names = ["days"]
+    timeout = 300
+
+    def setup(self, days):
+        self.workdir = tempfile.mkdtemp()
+        shutil.copytree(inputs_dir, os.path.join(self.workdir, "inputs"))
+        os.mkdir(os.path.join(self.workdir, "results"))
+
+    def teardown(self, days):
+        shutil.rmtree(self.workdir)
+
+    def time_cli(self, days):
+        subprocess.run(
+            [sys.executable, os.path.join(repo_dir, "coexist.py"), f"-days={days}", "-out=bench.csv"],
+            cwd=self.workdir,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+
+
+class Import:
+    timeout = 60
+
+    def time_import(self):
+        subprocess.run([sys.executable, "-c", "import coexist"], cwd=repo_dir, check=True)
@@ -0,0 +1,25 @@
+"""Turning a simulation output into the results table"""
+
+import io
+
+import numpy as np
+
+from .common import bundled_model, coexist
+
+
+class ResultsTable:
+    params = [[30, 365]]
+    param_names = ["days"]
+
+    def setup(self, days):
+        self.model = bundled_model()
+        self.result = np.random.default_rng(0).random((2,) + self.model.stateTensor_init.shape + (days,))
+
+    def time_array_to_df_clean_df(self, days):
+        coexist.clean_df(
+            coexist.array_to_df(days, self.result, ageGroups=self.model.ageGroups),
+            self.model.testingStartDate,
+        )
+
+    def time_write_csv(self, days):
+        self.model.write_results(self.result, io.StringIO())
@@ -0,0 +1,59 @@
+"""Single evaluations of the right hand side and its most expensive building blocks"""
+
+import numpy as np
+
+from .common import bundled_model, coexist, quiet, rhs_arguments
+
+
+class DydtComplete:
+    params = [["newOnly", "flows", "jacobian"]]
+    param_names = ["mode"]
+
+    def setup(self, mode):
+        self.state, self.kwargs = rhs_arguments(bundled_model())
+        if mode == "flows":
+            self.kwargs["debugReturnNewPerDay"] = False
+            self.kwargs["trackFlows"] = list(coexist.flowDefinitions)
+            nState = self.state.size // 2
+            self.state = np.concatenate([self.state[:nState], np.zeros(len(coexist.flowDefinitions) * 9)])
+        self.kwargs["returnJacobian"] = mode == "jacobian"
+
+    def time_dydt(self, mode):
+        with quiet():
+            coexist.dydt_Complete(33.3, self.state, **self.kwargs)
+
+
+class DydtCompleteEnsemble:
+    params = [[8, 32, 128]]
+    param_names = ["nScenarios"]
+
+    def setup(self, nScenarios):
+        self.state, self.kwargs = rhs_arguments(bundled_model(), nScenarios=nScenarios)
+
+    def time_dydt(self, nScenarios):
+        with quiet():
+            coexist.dydt_Complete(33.3, self.state, **self.kwargs)
+
+
+class TransitionBlocks:
+    def setup(self):
+        model = bundled_model()
+        self.stateTensor = model.stateTensor_init
+        _, self.kwargs = rhs_arguments(model)
+
+    def time_trFunc_testing(self):
+        coexist.trFunc_testing(
+            self.stateTensor,
+            33.3,
+            self.kwargs["realStartDate"],
+            calendar=self.kwargs["calendar"],
+            **self.kwargs["trFunc_testing_params"],
+        )
+
+    def time_trFunc_newInfections_Complete(self):
+        coexist.trFunc_newInfections_Complete(
+            self.stateTensor,
+            policySocialDistancing=True,
+            policyImmunityPassports=False,
+            **self.kwargs["trFunc_newInfections_params"],
+        )
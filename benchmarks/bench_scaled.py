@@ -0,0 +1,54 @@
+"""Synthetic scaled cases: finer age groups, long horizons and large ensembles"""
+
+from .common import bundled_model, coexist, quiet, rhs_arguments, scaled_model
+
+
+class ScaledAgeGroups:
+    params = [[2, 4]]
+    param_names = ["ageSplit"]
+    timeout = 600
+
+    def setup(self, ageSplit):
+        self.model = scaled_model(ageSplit)
+        self.paramDict = self.model.build_paramDict()
+        self.state, self.kwargs = rhs_arguments(self.model)
+
+    def time_dydt(self, ageSplit):
+        with quiet():
+            coexist.dydt_Complete(33.3, self.state, **self.kwargs)
+
+    def time_run_90days(self, ageSplit):
+        with quiet():
+            self.model.run(90, self.paramDict)
+
+
+class LongHorizon:
+    params = [["RK23", "BDF"]]
+    param_names = ["method"]
+    timeout = 1200
+
+    def setup(self, method):
+        self.model = bundled_model()
+        self.paramDict = self.model.build_paramDict()
+
+    def time_run_730days(self, method):
+        with quiet():
+            self.model.run(730, self.paramDict, method=method)
+
+
+class LargeEnsemble:
+    params = [[16, 64]]
+    param_names = ["nScenarios"]
+    timeout = 1200
+
+    def setup(self, nScenarios):
+        self.model = bundled_model()
+        self.paramDicts = []
+        for scenario in range(nScenarios):
+            paramDict = self.model.build_paramDict()
+            paramDict["trFunc_newInfections_params"]["transmissionInfectionStage"] *= 0.8 + 0.4 * scenario / nScenarios
+            self.paramDicts.append(paramDict)
+
+    def time_run_ensemble_60days(self, nScenarios):
+        with quiet():
+            self.model.run_ensemble(60, self.paramDicts)
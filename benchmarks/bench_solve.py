@@ -0,0 +1,19 @@
+"""Whole simulations on the bundled inputs"""
+
+from .common import bundled_model, quiet
+
+
+class SolveSystem:
+    params = [[30, 180, 365], ["RK23", "BDF", "Euler"]]
+    param_names = ["days", "method"]
+    timeout = 600
+
+    def setup(self, days, method):
+        self.model = bundled_model()
+        self.paramDict = self.model.build_paramDict()
+        # Euler: fixed steps of a quarter day
+        self.solverKwargs = {"samplesPerDay": 4} if method == "Euler" else {"method": method}
+
+    def time_run(self, days, method):
+        with quiet():
+            self.model.run(days, self.paramDict, **self.solverKwargs)
@@ -0,0 +1,88 @@
+"""
+Shared setup of the benchmarks: the model on the bundled inputs, synthetic scaled models, and silencing the progress output.
+"""
+
+import contextlib
+import copy
+import io
+import json
+import os
+import sys
+
+import numpy as np
+
+# The benchmarks time the coexist.py of the checkout they live in
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if repo_dir not in sys.path:
+    sys.path.insert(0, repo_dir)
+
+import coexist  # noqa: E402
+
+inputs_dir = os.path.join(repo_dir, coexist.data_folder)
+
+
+def quiet():
+    """Context manager swallowing the progress output of the simulation"""
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def bundled_model():
+    model = coexist.CoexistModel(inputs_dir)
+    model.inputs  # read the inputs outside of the timed code
+    return model
+
+
+def scaled_model(ageSplit):
+    """
+    Synthetic model with every age group of the bundled inputs split into ageSplit equal subgroups
+    (ageSplit x 9 age groups, the same total population and contacts)
+    """
+    with open(os.path.join(inputs_dir, "sme_input.json")) as jf:
+        sme_input = json.load(jf)
+    with open(os.path.join(inputs_dir, "user_input.json")) as jf:
+        user_input = json.load(jf)
+
+    def split(values, divide):
+        values = np.repeat(np.asarray(values, dtype=float), ageSplit)
+        return list(values / ageSplit if divide else values)
+
+    def labels(values):
+        return [f"{label}#{part}" for label in values for part in range(ageSplit)]
+
+    sme_input = copy.deepcopy(sme_input)
+    sme_input["age_group"] = labels(sme_input["age_group"])
+    for key in ["agePopulationTotal", "yearly_baseline_admissions", "ageTestingData"]:
+        sme_input[key] = split(sme_input[key], divide=True)
+    for key in ["ageHospitalMeanLengthOfStay", "ageNhsClinicalStaffPopulationRatio", "riskOfAEAttandance_by_age"]:
+        sme_input[key] = split(sme_input[key], divide=False)
+
+    user_input = copy.deepcopy(user_input)
+    user_input["age_group"] = labels(user_input["age_group"])
+    user_input["deaths_by_age"] = split(user_input["deaths_by_age"], divide=True)
+    for key in ["percent_admitted", "percent_not_isolating"]:
+        user_input[key] = split(user_input[key], divide=False)
+
+    # Contacts of a person with each age group are shared equally between its subgroups
+    base = bundled_model()
+    model = coexist.CoexistModel(
+        sme_input=sme_input,
+        user_input=user_input,
+        socialMixingBaseline=np.kron(base.inputs["ageSocialMixingBaseline"], np.ones((ageSplit, ageSplit)) / ageSplit),
+        socialMixingDistancing=np.kron(base.inputs["ageSocialMixingDistancing"], np.ones((ageSplit, ageSplit)) / ageSplit),
+    )
+    model.inputs
+    return model
+
+
+def rhs_arguments(model, total_days=200, nScenarios=None):
+    """(state, keyword arguments) of a single dydt_Complete evaluation, set up as solveSystem does"""
+    paramDict = model.build_paramDict()
+    stateTensor = model.stateTensor_init
+    if nScenarios is not None:
+        paramDict = coexist.stack_paramDicts([paramDict] * nScenarios)
+        paramDict["nScenarios"] = nScenarios
+        stateTensor = np.broadcast_to(stateTensor, (nScenarios,) + stateTensor.shape)
+    paramDict["calendar"] = coexist.SimulationCalendar(total_days + 1, **paramDict)
+    paramDict["workspace"] = coexist.rhs_workspace(stateTensor.shape, **paramDict)
+    state = np.stack([stateTensor, stateTensor], axis=-5).reshape(-1)
+    return state, paramDict
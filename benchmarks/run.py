@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+"""
+Run the benchmarks without asv, and save or compare their timings.
+
+################### COMMAND LINE RUN
+# $ python3 -m benchmarks.run                              # run everything, print the timings
+# $ python3 -m benchmarks.run -k=SolveSystem -save=main     # run the matching benchmarks, save them as results/main.json
+# $ python3 -m benchmarks.run -compare=main                 # exit status 1 if any benchmark got slower than threshold x main
+# $ python3 -m benchmarks.run -quick                        # one timing of the first parameter combination only
+#
+# The benchmarks are the time_* methods of the classes in benchmarks/bench_*.py. They follow the asv conventions
+# (params, param_names, setup, teardown, timeout), so they can be run by asv as well.
+# Results are per machine, they are written to benchmarks/results/ (not committed).
+"""
+
+import argparse
+import importlib
+import inspect
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import timeit
+from collections import OrderedDict
+from datetime import datetime
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+results_dir = os.path.join(bench_dir, "results")
+
+
+def discover(pattern=None):
+    """(name, class, method name, parameter combination) of every benchmark whose name contains pattern"""
+    for fname in sorted(os.listdir(bench_dir)):
+        if not (fname.startswith("bench_") and fname.endswith(".py")):
+            continue
+        module = importlib.import_module(f"benchmarks.{fname[:-3]}")
+        for className, cls in inspect.getmembers(module, inspect.isclass):
+            if cls.__module__ != module.__name__:
+                continue
+            params = getattr(cls, "params", [])
+            if params and not isinstance(params[0], (list, tuple)):
+                params = [params]
+            paramNames = getattr(cls, "param_names", [f"param{i}" for i in range(len(params))])
+            for methodName in sorted(name for name in dir(cls) if name.startswith("time_")):
+                for combination in itertools.product(*params):
+                    args = ", ".join(f"{name}={value!r}" for name, value in zip(paramNames, combination))
+                    name = f"{fname[:-3]}.{className}.{methodName}({args})"
+                    if pattern is None or pattern in name:
+                        yield name, cls, methodName, combination
+
+
+def time_benchmark(cls, methodName, combination, repeat=3, maxTime=10.0):
+    """Best time (s) of a single call, from repeat rounds of as many calls as fit in ~0.2 s (fewer rounds for slow benchmarks)"""
+    bench = cls()
+    if hasattr(bench, "setup"):
+        bench.setup(*combination)
+    try:
+        timer = timeit.Timer(lambda: getattr(bench, methodName)(*combination))
+        number, total = timer.autorange()
+        times = [total / number]
+        for _ in range(repeat - 1):
+            if sum(times) * number > maxTime:
+                break
+            times.append(timer.timeit(number) / number)
+    finally:
+        if hasattr(bench, "teardown"):
+            bench.teardown(*combination)
+    return min(times)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=bench_dir, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    ################### COMMAND LINE ARGS
+    parser = argparse.ArgumentParser(description="Run the COEXIST benchmarks")
+    parser.add_argument("-k", dest="pattern", type=str, default=None, help="Only run benchmarks whose name contains this")
+    parser.add_argument("-save", dest="save", type=str, default=None, help="Save the timings as results/<save>.json")
+    parser.add_argument("-compare", dest="compare", type=str, default=None, help="Compare the timings with results/<compare>.json")
+    parser.add_argument("-threshold", dest="threshold", type=float, default=1.2, help="Slowdown ratio reported as a regression")
+    parser.add_argument("-quick", dest="quick", action="store_true", help="Single timing of the first parameter combination")
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare is not None:
+        with open(os.path.join(results_dir, f"{args.compare}.json")) as jf:
+            baseline = json.load(jf)["results"]
+
+    results = OrderedDict()
+    regressions = []
+    seen = set()
+    for name, cls, methodName, combination in discover(args.pattern):
+        if args.quick and (cls, methodName) in seen:
+            continue
+        seen.add((cls, methodName))
+        results[name] = time_benchmark(cls, methodName, combination, repeat=1 if args.quick else 3)
+        line = f"{name:80s} {results[name]:10.4g} s"
+        if baseline is not None and name in baseline:
+            ratio = results[name] / baseline[name]
+            line += f"  x{ratio:5.2f}"
+            if ratio > args.threshold:
+                line += "  SLOWER"
+                regressions.append(name)
+            elif ratio < 1.0 / args.threshold:
+                line += "  faster"
+        print(line, flush=True)
+
+    if args.save is not None:
+        os.makedirs(results_dir, exist_ok=True)
+        with open(os.path.join(results_dir, f"{args.save}.json"), "w") as jf:
+            json.dump(
+                OrderedDict([
+                    ("commit", git_commit()),
+                    ("date", datetime.now().isoformat(timespec="seconds")),
+                    ("python", sys.version.split()[0]),
+                    ("machine", platform.platform()),
+                    ("results", results),
+                ]),
+                jf,
+                indent=2,
+            )
+
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) slower than {args.threshold} x {args.compare}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
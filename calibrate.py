@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+
+"""
+Calibration: fit selected parameters of the COEXIST model to observed daily series
+(deaths, hospital admissions, positive tests), by maximising a Poisson or negative binomial likelihood.
+
+################### COMMAND LINE RUN
+# $ python3 calibrate.py -spec=calibration.json -obs=observed.csv -out=calibrated.json -workers=4 -batch=8
+#
+# calibration.json lists the fitted parameters (dot separated paths of the build_paramDict(dydt_Complete) tree, as in sweep.py)
+# and the likelihood:
+#     {"parameters": [
+#         {"path": "trFunc_newInfections_params.transmissionInfectionStage", "mode": "scale", "bounds": [0.2, 5.0], "log": true},
+#         {"path": "trFunc_newInfections_params.ageSocialMixingDistancing", "mode": "scale", "bounds": [0.1, 1.0]},
+#         {"path": "trFunc_HospitalAdmission_params.infToHospitalExtra", "mode": "scale", "bounds": [0.1, 10.0], "log": true},
+#         {"path": "trFunc_diseaseProgression_params.symptom_to_hospitalisation", "bounds": [2.0, 10.0]}],
+#      "likelihood": "negbin", "dispersion": 10.0}
+# mode "value" (default) sets the parameter (or its element "index"), "scale" multiplies its default value,
+# "shift" moves a date by a number of days; with "log" the search is uniform in log space.
+#
+# observed.csv has a simDay column (as in the output tables) or a timestamp column (YYYY-MM-DD), and one column of daily
+# counts per observed series, named as the tracked flows (see coexist.flowDefinitions): deaths, hospitalAdmissions,
+# positiveTests (newInfections if known). Missing values are skipped. The counts of simDay k are the people that went
+# through the flow between the output days k-1 and k.
+#
+# Every generation of the optimiser (differential evolution) is evaluated in batches of candidates, each batch
+# integrated as one ensemble (see CoexistModel.run_ensemble), and the batches are spread over a process pool
+# that shares the inputs (see sweep.SharedInputs). The best parameters are written to results/<out>.
+"""
+
+import argparse
+import copy
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from scipy import optimize
+from scipy.special import gammaln
+
+import coexist
+import sweep
+
+
+# ## Likelihoods
+# Vectorised over candidates: observed (nSeries x nDays, NaN where missing) broadcasts against expected (... x nSeries x nDays)
+def poisson_logLikelihood(observed, expected):
+    """Poisson log likelihood of the observed counts, summed over the series and days (one value per candidate)"""
+    expected = np.maximum(expected, 1e-10)
+    missing = np.isnan(observed)
+    observed = np.where(missing, 0.0, observed)
+    logLik = observed * np.log(expected) - expected - gammaln(observed + 1.0)
+    return np.sum(np.where(missing, 0.0, logLik), axis=(-2, -1))
+
+
+def negbin_logLikelihood(observed, expected, dispersion):
+    """
+    Negative binomial log likelihood (mean expected, variance expected + expected^2 / dispersion) of the observed counts,
+    summed over the series and days. dispersion is a number, or one number per series.
+    """
+    expected = np.maximum(expected, 1e-10)
+    dispersion = np.reshape(dispersion, np.shape(dispersion) + (1,)) if np.ndim(dispersion) == 1 else dispersion
+    missing = np.isnan(observed)
+    observed = np.where(missing, 0.0, observed)
+    logLik = (
+        gammaln(observed + dispersion)
+        - gammaln(dispersion)
+        - gammaln(observed + 1.0)
+        + dispersion * np.log(dispersion / (dispersion + expected))
+        + observed * np.log(expected / (dispersion + expected))
+    )
+    return np.sum(np.where(missing, 0.0, logLik), axis=(-2, -1))
+
+
+likelihoods = OrderedDict([("poisson", poisson_logLikelihood), ("negbin", negbin_logLikelihood)])
+
+
+# ## Observations
+def read_observations(path_or_df, startDate=None):
+    """
+    Observed daily counts (DataFrame indexed by simDay, one column per tracked flow), from a csv file (or DataFrame)
+    with a simDay column, or a timestamp column that is converted with the startDate of the output tables
+    """
+    df = pd.read_csv(path_or_df) if isinstance(path_or_df, (str, os.PathLike)) else pd.DataFrame(path_or_df)
+    if "simDay" not in df.columns:
+        if "timestamp" not in df.columns or startDate is None:
+            raise ValueError("read_observations: the observations need a simDay column (or a timestamp column and a startDate)")
+        df["simDay"] = (pd.to_datetime(df["timestamp"], format="%Y-%m-%d") - pd.Timestamp(startDate)).dt.days
+    df = df.set_index("simDay").drop(columns=["timestamp"], errors="ignore")
+
+    unknown = [col for col in df.columns if col not in coexist.flowDefinitions]
+    if unknown or len(df.columns) == 0:
+        raise ValueError(f"read_observations: the observed series must be among {list(coexist.flowDefinitions)}, got {list(df.columns)}")
+    if np.any(df.index < 2):
+        raise ValueError("read_observations: daily counts are only defined from simDay 2 on")
+    return df.groupby(level=0).sum(min_count=1).sort_index().astype(float)
+
+
+# ## Fitted parameters
+def get_param(paramDict, path):
+    """Value at the (dot separated) path of paramDict"""
+    cur = paramDict
+    for key in path.split("."):
+        if not isinstance(cur, dict) or key not in cur:
+            raise KeyError(f"calibrate: {path} is not a parameter of the model")
+        cur = cur[key]
+    return cur
+
+
+class CalibrationParameter:
+    """
+    A fitted parameter: the value at path (mode "value", or its element index), a multiplier of its default value
+    (mode "scale", e.g. of transmissionInfectionStage or a mixing matrix), or a number of days by which its default
+    date is moved (mode "shift"), within bounds; searched in log space if log.
+    """
+
+    def __init__(self, path, bounds, mode="value", index=None, log=False):
+        if path.partition(".")[0] in ["sme_input", "user_input"]:
+            raise ValueError(f"calibrate: {path} is an input file entry, only parameters of the paramDict can be fitted")
+        if mode not in ["value", "scale", "shift"]:
+            raise ValueError(f"calibrate: unknown mode {mode} of {path}")
+        if bounds[0] >= bounds[1] or (log and bounds[0] <= 0):
+            raise ValueError(f"calibrate: invalid bounds {bounds} of {path}")
+        self.path = path
+        self.bounds = (float(bounds[0]), float(bounds[1]))
+        self.mode = mode
+        self.index = index
+        self.log = log
+
+    @classmethod
+    def from_spec(cls, spec):
+        return cls(**spec)
+
+    def to_spec(self):
+        return OrderedDict([("path", self.path), ("bounds", list(self.bounds)), ("mode", self.mode), ("index", self.index), ("log", self.log)])
+
+    @property
+    def searchBounds(self):
+        return tuple(np.log(self.bounds)) if self.log else self.bounds
+
+    def value(self, x):
+        """Parameter value (or multiplier) of the search coordinate x"""
+        return float(np.exp(x)) if self.log else float(x)
+
+    def apply(self, paramDict, x, default):
+        """Set the parameter of paramDict (a copy of the default parameters) for the search coordinate x"""
+        value = self.value(x)
+        if self.mode == "scale":
+            value = np.multiply(default, value)
+        elif self.mode == "shift":
+            value = pd.Timestamp(default) + pd.Timedelta(days=int(round(value)))  # the policies switch on whole days
+        elif self.index is not None:
+            value = np.array(default, dtype=float)
+            value[tuple(np.atleast_1d(self.index))] = self.value(x)
+        elif np.ndim(default) > 0:
+            raise ValueError(f"calibrate: {self.path} is an array, fit it with mode scale or an index")
+        return sweep.apply_paramOverrides(paramDict, OrderedDict([(self.path, value)]))
+
+
+class CalibrationProblem:
+    """
+    Likelihood of the observations (see read_observations) as a function of the search coordinates of the parameters,
+    for a CoexistModel and base parameters (default: model.build_paramDict()).
+    Many candidates are evaluated by batched runs, sharing everything else (and the caches of the static transitions).
+    """
+
+    def __init__(self, model, parameters, observations, likelihood="poisson", dispersion=10.0, paramDict=None, solverKwargs=None):
+        if likelihood not in likelihoods:
+            raise ValueError(f"calibrate: unknown likelihood {likelihood}, use one of {list(likelihoods)}")
+        self.model = model
+        self.parameters = [
+            param if isinstance(param, CalibrationParameter) else CalibrationParameter.from_spec(param)
+            for param in parameters
+        ]
+        self.observations = observations
+        self.likelihood = likelihood
+        self.dispersion = dispersion
+        self.solverKwargs = dict(solverKwargs or {})
+        self.solverKwargs["trackFlows"] = list(observations.columns)
+
+        self.paramDict = model.build_paramDict() if paramDict is None else paramDict
+        self.defaults = [copy.deepcopy(get_param(self.paramDict, param.path)) for param in self.parameters]
+        self.total_days = int(observations.index.max())
+        # Output columns of the observed days (simDay k is column k-1), and the observations as nSeries x nDays
+        self.dayColumns = observations.index.to_numpy(dtype=int) - 1
+        self.observed = observations.to_numpy(dtype=float).T
+
+    def problem_args(self):
+        """Everything but the model, to rebuild the problem in a worker process"""
+        return OrderedDict([
+            ("parameters", [param.to_spec() for param in self.parameters]),
+            ("observations", self.observations),
+            ("likelihood", self.likelihood),
+            ("dispersion", self.dispersion),
+            ("paramDict", self.paramDict),
+            ("solverKwargs", self.solverKwargs),
+        ])
+
+    @property
+    def bounds(self):
+        return [param.searchBounds for param in self.parameters]
+
+    def paramDict_for(self, x):
+        """Full parameter dictionary of the search coordinates x"""
+        paramDict = copy.deepcopy(self.paramDict)
+        for param, xi, default in zip(self.parameters, x, self.defaults):
+            param.apply(paramDict, xi, default)
+        return paramDict
+
+    def expected(self, X):
+        """Expected daily counts of the observed series on the observed days (nCandidates x nSeries x nDays)"""
+        _, flows = self.model.run_ensemble(
+            self.total_days, [self.paramDict_for(x) for x in X], **self.solverKwargs
+        )
+        # cumulative people per flow (nCandidates x nSeries x days), differenced into daily counts
+        cumulative = np.sum(flows, axis=-2)
+        daily = np.diff(cumulative, axis=-1, prepend=0.0)
+        return daily[..., self.dayColumns]
+
+    def logLikelihood(self, X):
+        """Log likelihood of every candidate (rows of X), -inf where the integration fails"""
+        X = np.atleast_2d(X)
+        try:
+            expected = self.expected(X)
+        except RuntimeError:
+            if len(X) == 1:
+                return np.array([-np.inf])
+            # A single failing candidate would fail the whole batch, so evaluate them separately
+            return np.concatenate([self.logLikelihood(x) for x in X])
+        if self.likelihood == "negbin":
+            logLik = negbin_logLikelihood(self.observed, expected, self.dispersion)
+        else:
+            logLik = poisson_logLikelihood(self.observed, expected)
+        return np.where(np.isfinite(logLik), logLik, -np.inf)
+
+    def parameter_values(self, x):
+        """Fitted values (or multipliers) by parameter path"""
+        return OrderedDict((param.path, param.value(xi)) for param, xi in zip(self.parameters, x))
+
+
+# ## Parallel evaluation
+# State of each worker process, set up once by init_worker
+_workerProblem = None
+_workerBlocks = []
+
+
+def init_worker(arrays, other, problemArgs):
+    global _workerProblem, _workerBlocks
+    inputs, _workerBlocks = sweep.SharedInputs.attach(arrays, other)
+    _workerProblem = CalibrationProblem(coexist.CoexistModel.from_inputs(inputs), **problemArgs)
+
+
+def _logLikelihood_task(X):
+    return _workerProblem.logLikelihood(X)
+
+
+def evaluate_candidates(problem, X, batchSize=8, executor=None):
+    """Log likelihood of every candidate, in batches of batchSize candidates (spread over the executor's workers, if any)"""
+    X = np.atleast_2d(X)
+    batches = [X[start : start + batchSize] for start in range(0, len(X), batchSize)]
+    if executor is None:
+        results = [problem.logLikelihood(batch) for batch in batches]
+    else:
+        results = list(executor.map(_logLikelihood_task, batches))
+    return np.concatenate(results)
+
+
+# ## Optimisation
+def calibrate(problem, workers=1, batchSize=8, maxiter=50, popsize=15, seed=None, callback=None, **deOptions):
+    """
+    Maximise the likelihood by differential evolution, evaluating every generation at once (see evaluate_candidates)
+    in a pool of workers processes (workers=1: in this process). Returns a dictionary with the best search coordinates
+    "x", the fitted "parameters" (by path), the "logLikelihood", the number of candidates evaluated and the optimiser status.
+    """
+    nEvaluations = [0]
+
+    def run(executor):
+        def mapper(func, population):
+            # func is the objective of a single candidate, the population is evaluated in batches instead
+            population = np.asarray(list(population))
+            nEvaluations[0] += len(population)
+            logLik = evaluate_candidates(problem, population, batchSize=batchSize, executor=executor)
+            return list(np.where(np.isfinite(logLik), -logLik, np.inf))
+
+        return optimize.differential_evolution(
+            lambda x: -problem.logLikelihood(x)[0],
+            problem.bounds,
+            maxiter=maxiter,
+            popsize=popsize,
+            seed=seed,
+            callback=callback,
+            polish=False,
+            updating="deferred",
+            workers=mapper,
+            **deOptions,
+        )
+
+    if workers == 1:
+        solution = run(None)
+    else:
+        with sweep.SharedInputs(problem.model.inputs) as shared:
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=init_worker,
+                initargs=(shared.arrays, shared.other, problem.problem_args()),
+            ) as executor:
+                solution = run(executor)
+
+    return OrderedDict([
+        ("x", solution.x.tolist()),
+        ("parameters", problem.parameter_values(solution.x)),
+        ("logLikelihood", -float(solution.fun)),
+        ("nEvaluations", nEvaluations[0]),
+        ("nGenerations", int(solution.nit)),
+        ("success", bool(solution.success)),
+        ("message", solution.message),
+    ])
+
+
+def main(argv=None):
+    ################### COMMAND LINE ARGS
+    parser = argparse.ArgumentParser(description="Fit model parameters to observed daily series")
+    parser.add_argument("-spec", dest="specfile", type=str, help="json file with the fitted parameters and the likelihood")
+    parser.add_argument("-obs", dest="obsfile", type=str, help="csv file with the observed daily counts")
+    parser.add_argument("-out", dest="outfile", type=str, help="Name of output (json) file")
+    parser.add_argument("-workers", dest="workers", type=int, default=1, help="Number of worker processes (default: 1, in this process)")
+    parser.add_argument("-batch", dest="batch", type=int, default=8, help="Number of candidates integrated together")
+    parser.add_argument("-maxiter", dest="maxiter", type=int, default=50, help="Maximum number of generations")
+    parser.add_argument("-seed", dest="seed", type=int, default=None, help="Random seed of the optimiser")
+    parser.add_argument("-method", dest="method", type=str, default="RK23", help="Integrator, e.g. RK23 (default) or BDF")
+
+    args = parser.parse_args(argv)
+
+    # Set Working/Data dirs
+    workdir = os.getcwd()
+    data_dir = f"{workdir}/{coexist.data_folder}"
+
+    with open(args.specfile) as jf:
+        spec = json.load(jf)
+
+    print("\n")
+    start_it = datetime.now()
+    print(f"Started at {start_it}")
+    print("Running calibration...")
+
+    model = coexist.CoexistModel(data_dir)
+    problem = CalibrationProblem(
+        model,
+        spec["parameters"],
+        read_observations(args.obsfile, startDate=model.testingStartDate),
+        likelihood=spec.get("likelihood", "poisson"),
+        dispersion=spec.get("dispersion", 10.0),
+        solverKwargs={"method": args.method},
+    )
+
+    nGenerations = [0]
+
+    def progress(xk, convergence):
+        nGenerations[0] += 1
+        print(f" Generations done: {nGenerations[0]}, convergence: {convergence:.3g}", end="\r")
+
+    result = calibrate(
+        problem,
+        workers=args.workers,
+        batchSize=args.batch,
+        maxiter=args.maxiter,
+        popsize=spec.get("popsize", 15),
+        seed=args.seed,
+        callback=progress,
+    )
+    result["spec"] = spec
+
+    with open(f"{workdir}/results/{args.outfile}", "w") as jf:
+        json.dump(result, jf, indent=2)
+
+    end_it = datetime.now()
+    print(f"Runtime = {end_it-start_it}")
+    print("\n")
+    print(f"Log likelihood {result['logLikelihood']:.6g} after {result['nEvaluations']} evaluations")
+    print(f"Results written to {workdir}/results/{args.outfile}")
+    print("\n")
+
+
+if __name__ == "__main__":
+    main()
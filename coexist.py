@@ -29,10 +29,14 @@ SOFTWARE.
 
 # Basic packages
 import numpy as np
-from scipy import integrate, stats, spatial
+from scipy import integrate, stats, spatial, sparse
 from scipy.special import expit, binom
 import pandas as pd
+import contextlib
+import cProfile
 import copy
+import functools
+import types
 import warnings
 import argparse
 
@@ -51,52 +55,20 @@ import shutil
 import sys
 import itertools
 import json
+import hashlib
+import importlib.util
 
 ################### COMMAND LINE RUN
 # $ python3 coexist.py -days=200 -out=stateResults.csv
+#
+# Importing this module has no side effects: inputs are only read when a CoexistModel is first used,
+# and the command line interface lives in main()
 
-################### COMMAND LINE ARGS
-
-parser = argparse.ArgumentParser(description="Get number of days to run simulation")
-parser.add_argument("-days", dest="total_days", type=int, help="Number of days to run simulation")
-parser.add_argument("-out", dest="outfile", type=str, help="Name of output file")
-
-args = parser.parse_args()
-
-total_days = args.total_days
-outfile = args.outfile
-
-# Set Working/Data dirs
-workdir = os.getcwd()
+# Default location of the input files, relative to the working directory
 data_folder = "inputs"
-data_dir = f"{workdir}/{data_folder}"
-
-############# Static Input Parameters#############  ref: "baked_in_parameters.ipynb"
-with open(f"{data_dir}/sme_input.json") as jf:
-    sme_input = json.load(jf)
-print(data_dir)
-# Population by Age (0-9, 10-19, ... 70-79, 80+) ref: https://en.wikipedia.org/wiki/Demographics_of_Ethiopia "AGE STRUCTURE"
-agePopulationTotal = np.array(sme_input["agePopulationTotal"])
-agePopulationRatio = agePopulationTotal / np.sum(agePopulationTotal)
-
-## Social Mixing Matrices
-# BASELINE
-ageSocialMixingBaseline = (
-    pd.read_csv(f"{data_dir}/social_mixing_BASELINE.csv", sep=",")
-    .iloc[:, 1:]
-    .values
-)
-ageSocialMixingBaseline = (ageSocialMixingBaseline + ageSocialMixingBaseline.T) / 2.0
-
-# SOCIAL DISTANCING
-ageSocialMixingDistancing = (
-    pd.read_csv(f"{data_dir}/social_mixing_DISTANCE.csv", sep=",")
-    .iloc[:, 1:]
-    .values
-)
-ageSocialMixingDistancing = (
-    ageSocialMixingDistancing + ageSocialMixingDistancing.T
-) / 2.0
+
+# Age group labels of the input files and the results
+ageGroups = ["0-9", "10-19", "20-29", "30-39", "40-49", "50-59", "60-69", "70-79", "80+"]
 
 # Travel Data Gamma Distribution
 travelMaxTime = 200
@@ -113,166 +85,69 @@ nI_symp = 2  # number of sympyomatic infected states
 nI = (2 + nI_symp)  # number of total infected states (disease stages), the +2 are Exposed and I_nonsymptomatic
 nR = 2  # number of recovery states (antibody development post-disease, IgM and IgG are two stages)
 nHS = (2 + nI + nR)  # number of total health states, the +2: S, D are suspectible and dead
-nAge = 9  # Age groups (risk groups) In accordance w Imperial #13 report (0-9, 10-19, ... 70-79, 80+)
+nAge = len(ageGroups)  # Age groups (risk groups) In accordance w Imperial #13 report (0-9, 10-19, ... 70-79, 80+)
 nIso = 4  # Isolation states: None/distancing, Case isolation, Hospitalised, Hospital staff
 nTest = 4  # Testing states: untested/negative, Virus positive, Antibody positive, Both positive
 
-stateTensor = np.zeros((nAge, nHS, nIso, nTest))
-
-### Hospitalization
-
-# Hospitalization rate by age: mapped UK to ETH population (see "baked_in_parameters")
-yearly_baseline_admissions = np.array(sme_input["yearly_baseline_admissions"])
-ageHospitalisationRateBaseline = yearly_baseline_admissions / (365 * agePopulationTotal)
-
-
-# Average days in the hospital by age
-ageHospitalMeanLengthOfStay = np.array(sme_input["ageHospitalMeanLengthOfStay"])
-ageHospitalisationRecoveryRateBaseline = 1.0 / ageHospitalMeanLengthOfStay
-
-# Ratio of Hospital Staff by Age
-ageNhsClinicalStaffPopulationRatio = np.array(sme_input["ageNhsClinicalStaffPopulationRatio"])
-
-# Rate of transmission given contact for differnt states [exposed, asymptomatic, I1 (symptomatic early), I2 (symptomatic late)]
-transmissionInfectionStage = np.array(sme_input["transmissionInfectionStage"])
-
-
-############# USER INPUT PARAMETERS ############# from "USER_build_data.ipynb"
-with open(f"{data_dir}/user_input.json") as jf:
-    user_input = json.load(jf)
-
-# Number of Days in Isolation
-nDaysInHomeIsolation = user_input["nDaysInHomeIsolation"]
-
-tStartSocialDistancing = pd.to_datetime(
-    user_input["tStartSocialDistancing"], format="%Y-%m-%d"
-)
-tStopSocialDistancing = pd.to_datetime(
-    user_input["tStopSocialDistancing"], format="%Y-%m-%d"
-)
-tStartImmunityPassports = pd.to_datetime(
-    user_input["tStartImmunityPassports"], format="%Y-%m-%d"
-)
-tStopImmunityPassports = pd.to_datetime(
-    user_input["tStopImmunityPassports"], format="%Y-%m-%d"
-)
-tStartQuarantineCaseIsolation = pd.to_datetime(
-    user_input["tStartQuarantineCaseIsolation"], format="%Y-%m-%d"
-)
-tStopQuarantineCaseIsolation = pd.to_datetime(
-    user_input["tStopQuarantineCaseIsolation"], format="%Y-%m-%d"
-)
-CONST_DATA_START_DATE = user_input["CONST_DATA_START_DATE"]
-CONST_DATA_CUTOFF_DATE = user_input["CONST_DATA_CUTOFF_DATE"]
-
-
-# Risk of Admission by age
-totalCOVIDAdmitted_byAge_regroup = user_input["percent_admitted"] * agePopulationTotal
-relativeAdmissionRisk_given_COVID_by_age = (totalCOVIDAdmitted_byAge_regroup / agePopulationTotal)
-
-relativeAdmissionRisk_given_COVID_by_age /= np.mean(relativeAdmissionRisk_given_COVID_by_age)
-relativeAdmissionRisk_given_COVID_by_age -= 1
-
-# Risk of Death by Age
-totalDeaths_byAge_regroupLinear = user_input["deaths_by_age"]
-relativeDeathRisk_given_COVID_by_age = (totalDeaths_byAge_regroupLinear / agePopulationTotal)
-relativeDeathRisk_given_COVID_by_age /= np.mean(relativeDeathRisk_given_COVID_by_age)
-relativeDeathRisk_given_COVID_by_age -= 1
-
-
-# Death Rate by Age
-caseFatalityRatioHospital_given_COVID_by_age = (totalDeaths_byAge_regroupLinear / totalCOVIDAdmitted_byAge_regroup)
-
-# ageRelativeRecoverySpeed = np.array([0.2]*5+[-0.1, -0.2, -0.3, -0.5]) # TODO - this is a guess, find data and fix
-ageRelativeRecoverySpeed = np.array([0.0] * 9)  # For now we make it same for everyone, makes calculations easier
-
-# Social Mixing WHILE Isolating (rule-breakers)
-percent_not_isolating = np.array(user_input["percent_not_isolating"])
-percent_isolating_mat = np.array([percent_not_isolating,] * nAge).transpose()
-
-# ageSocialMixingIsolation = percent_isolating_mat*ageSocialMixingDistancing
-ageSocialMixingIsolation = np.zeros_like(ageSocialMixingBaseline)  # OR PERFECT ISOLATION
-
 # From coexist model
 # Getting Infected in the Hospital
 elevatedMixingRatioInHospital = 3.0
-withinHospitalSocialMixing = elevatedMixingRatioInHospital * np.sum(np.dot(agePopulationRatio, ageSocialMixingBaseline))
-
-# Calculate initial hospitalisation (occupancy), that will be used to initialise the model
-initBaselineHospitalOccupancyEquilibriumAgeRatio = ageHospitalisationRateBaseline / (ageHospitalisationRateBaseline + ageHospitalisationRecoveryRateBaseline)
-
-# Extra rate of hospitalisation due to COVID-19 infection stages; Symptom to hospitalisation is 5.76 days on average (Imperial #8)
-infToHospitalExtra = np.array(sme_input["infToHospitalExtra"])
 
-# We do know at least how age affects these risks:
-# For calculations see data_cleaning_py.ipynb, calculations from CHESS dataset as per 05 Apr
-riskOfAEAttandance_by_age = np.array(sme_input["riskOfAEAttandance_by_age"])
-# riskOfAEAttandance_by_age = np.array([0.41261361, 0.31560648, 0.3843979 , 0.30475704, 0.26659415,0.25203475, 0.24970244, 0.31549102, 0.65181376])
 
+@functools.lru_cache(maxsize=64)
+def _regroup_matrix(fromAgeSplits, toAgeSplits, maxAge, maxAgeWeight):
+    fromAgeSplits = np.array((0.0,) + fromAgeSplits + (maxAge,))  # Add 0 at the beginning and maxAge at the end
+    toAgeSplits = np.array((0.0,) + toAgeSplits + (maxAge,))
 
-testingStartDate = pd.to_datetime(user_input["testingStartDate"], format="%Y-%m-%d")
-ageTestingData = sme_input["ageTestingData"]
-df_CHESS_numTests_regroup = pd.DataFrame({testingStartDate: ageTestingData}).T
+    # Number of years of each input bin (columns) that falls into each output bin (rows)
+    overlap = np.maximum(
+        0.0,
+        np.minimum(toAgeSplits[1:, None], fromAgeSplits[None, 1:])
+        - np.maximum(toAgeSplits[:-1, None], fromAgeSplits[None, :-1]),
+    )
+    # Define the relative number of ages if we have to distribute between second to last and last age groups
+    overlap[-1, overlap[-1] > 0] = maxAgeWeight
 
-#df_CHESS_numTests_regroup.index = df_CHESS_numTests.index
+    weights = overlap / np.sum(overlap, axis=0, keepdims=True)
+    weights.setflags(write=False)
+    return weights
 
-# ## Initialise the model
 
-# Initialise state
-stateTensor_init = copy.deepcopy(stateTensor)
-# Populate
-stateTensor_init[:, 0, 0, 0] = agePopulationTotal
-# Move hospital staff to working in hospital
-stateTensor_init[:, 0, 0, 0] -= ageNhsClinicalStaffPopulationRatio * agePopulationTotal
-stateTensor_init[:, 0, 3, 0] += ageNhsClinicalStaffPopulationRatio * agePopulationTotal
-# Move people to hospital according to baseline occupation (move only from normal people, not hospital staff!)
-stateTensor_init[:, 0, 2, 0] += (
-    initBaselineHospitalOccupancyEquilibriumAgeRatio * stateTensor_init[:, 0, 0, 0]
-)
-stateTensor_init[:, 0, 0, 0] -= (
-    initBaselineHospitalOccupancyEquilibriumAgeRatio * stateTensor_init[:, 0, 0, 0]
-)
+def regroup_matrix(fromAgeSplits, toAgeSplits, maxAge=100.0, maxAgeWeight=5.0):
+    """
+    Weights (len(toAgeSplits)+1 x len(fromAgeSplits)+1) redistributing the age bins given by fromAgeSplits
+    to the bins given by toAgeSplits, proportionally to the overlapping years (but with maxAgeWeight years
+    for the part of a bin that falls into the last output bin). Every column sums to 1.
+    Built once per set of arguments, the returned array is read-only.
+    """
+    return _regroup_matrix(
+        tuple(np.asarray(fromAgeSplits, dtype=float).tolist()),
+        tuple(np.asarray(toAgeSplits, dtype=float).tolist()),
+        float(maxAge),
+        float(maxAgeWeight),
+    )
 
 
 def regroup_by_age(
-    inp,  # first dimension is ages, others don't matter.
+    inp,  # first dimension is ages (or the axis given), others don't matter.
     fromAgeSplits,
     toAgeSplits,
     maxAge=100.0,
     maxAgeWeight=5.0,
+    axis=0,
 ):
-    fromAgeSplits = np.concatenate(
-        [np.array([0]), fromAgeSplits, np.array([maxAge])]
-    )  # Add a zero at beginning for calculations
-    toAgeSplits = np.concatenate(
-        [np.array([0]), toAgeSplits, np.array([maxAge])]
-    )  # Add inf at end for calculations
-
-    def getOverlap(a, b):
-        return max(0, min(a[1], b[1]) - max(a[0], b[0]))
-
-    out = np.zeros((len(toAgeSplits) - 1,) + inp.shape[1:])
-    for from_ind in range(1, len(fromAgeSplits)):
-        # Redistribute to the new bins by calculating how many years in from_ind-1:from_ind falls into each output bin
-        cur_out_distribution = [
-            getOverlap(
-                toAgeSplits[cur_to_ind - 1 : cur_to_ind + 1],
-                fromAgeSplits[from_ind - 1 : from_ind + 1],
-            )
-            for cur_to_ind in range(1, len(toAgeSplits))
-        ]
-
-        if cur_out_distribution[-1] > 0:
-            cur_out_distribution[
-                -1
-            ] = maxAgeWeight  # Define the relative number of ages if we have to distribute between second to last and last age groups
-
-        cur_out_distribution = cur_out_distribution / np.sum(cur_out_distribution)
-
-        for to_ind in range(len(out)):
-            out[to_ind] += cur_out_distribution[to_ind] * inp[from_ind - 1]
-
-    return out
+    """
+    Redistribute the age dimension of inp from the bins given by fromAgeSplits to the bins given by toAgeSplits
+    (see regroup_matrix), e.g. single year census data to the model age groups, or model results (axis=-5 of a
+    results tensor) to other age groupings
+    """
+    weights = regroup_matrix(fromAgeSplits, toAgeSplits, maxAge=maxAge, maxAgeWeight=maxAgeWeight)
+    inp = np.asarray(inp)
+    if inp.shape[axis] != weights.shape[1]:
+        raise ValueError(
+            f"regroup_by_age: {weights.shape[1]} age bins in fromAgeSplits, but inp has {inp.shape[axis]} along axis {axis}"
+        )
+    return np.moveaxis(np.tensordot(weights, inp, axes=([1], [axis])), 0, axis)
 
 
 # Build the nested parameter/computation graph of a single function.
@@ -363,9 +238,266 @@ def paramTable_toDict(paramTable, defaultDict=None):
     return paramDict
 
 
+# Ensembles of scenarios
+# ----------------------
+# Several parameter dictionaries can be combined into one, that is evaluated in a single vectorised pass:
+# every parameter that differs between scenarios is stacked along a new leading scenario axis,
+# and the state tensor gets the same leading axis (nScenarios x nAge x nHS x nIso x nTest).
+class ScenarioParamDict(OrderedDict):
+    """
+    A parameter dictionary (level) where the values of stackedKeys have a leading axis of length nScenarios.
+    Nested "_params" dictionaries are ScenarioParamDicts themselves.
+    """
+
+    def __init__(self, *args, nScenarios=1, stackedKeys=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.nScenarios = nScenarios
+        self.stackedKeys = set(stackedKeys)
+
+    def is_stacked(self):
+        return len(self.stackedKeys) > 0 or any(
+            isinstance(val, ScenarioParamDict) and val.is_stacked()
+            for val in self.values()
+        )
+
+
+def stack_paramDicts(paramDicts):
+    """
+    Combine a list of parameter dictionaries (with identical structure) into a single ScenarioParamDict.
+    Values that are identical in all scenarios are kept as they are, numbers, arrays and dates that differ are stacked
+    (except realStartDate, which all scenarios have to share).
+    """
+    nScenarios = len(paramDicts)
+    stackedDict = ScenarioParamDict(nScenarios=nScenarios)
+
+    for key, value in paramDicts[0].items():
+        values = [curDict[key] for curDict in paramDicts]
+        if key.endswith("_params"):
+            stackedDict[key] = stack_paramDicts(values)
+        elif all(paramHash(val) == paramHash(value) for val in values[1:]):
+            stackedDict[key] = value
+        elif key == "realStartDate":
+            # the testing dates (see trFunc_testing) and the calendar are shared by the batch
+            raise ValueError("stack_paramDicts: realStartDate has to be the same in all scenarios of a batched run")
+        elif all(isinstance(val, (pd.Timestamp, datetime)) for val in values):
+            stackedDict[key] = np.array([pd.Timestamp(val) for val in values], dtype=object)
+            stackedDict.stackedKeys.add(key)
+        elif all(
+            isinstance(val, (int, float, np.number, np.ndarray, list)) for val in values
+        ):
+            stackedDict[key] = np.stack([np.asarray(val) for val in values], axis=0)
+            stackedDict.stackedKeys.add(key)
+        else:
+            raise ValueError(
+                f"stack_paramDicts: parameter {key} differs between scenarios, but it cannot be stacked ({type(value).__name__})"
+            )
+
+    return stackedDict
+
+
+def select_scenario(paramDict, scenario):
+    """Parameters of a single scenario of a (possibly) stacked parameter dictionary"""
+    out = OrderedDict()
+    for key, value in paramDict.items():
+        if isinstance(value, dict):
+            out[key] = select_scenario(value, scenario)
+        elif isinstance(paramDict, ScenarioParamDict) and key in paramDict.stackedKeys:
+            out[key] = value[scenario]
+        else:
+            out[key] = value
+    return out
+
+
+# Metapopulations
+# ---------------
+# Regions are scenarios of an ensemble, whose new infections are coupled by an nRegions x nRegions matrix
+# (see trFunc_newInfections_Complete). The coupling is usually sparse, so the cost grows linearly with the number of regions.
+def region_coupling(mobility):
+    """
+    regionCoupling from mobility[r, s], the fraction of the contacts of the residents of region r made in region s (r != s,
+    the diagonal is ignored): the remaining contacts are made at home, so every row of the coupling sums to 1.
+    Sparse mobility matrices give a sparse (CSR) coupling.
+    """
+    if sparse.issparse(mobility):
+        mobility = sparse.csr_matrix(mobility, dtype=float)
+        mobility = mobility - sparse.diags(mobility.diagonal())
+        awayFraction = np.asarray(mobility.sum(axis=1)).ravel()
+        coupling = (mobility + sparse.diags(1.0 - awayFraction)).tocsr()
+    else:
+        mobility = np.array(mobility, dtype=float)
+        np.fill_diagonal(mobility, 0.0)
+        awayFraction = np.sum(mobility, axis=1)
+        coupling = mobility + np.diag(1.0 - awayFraction)
+    if (mobility < 0).sum() > 0 or np.any(awayFraction > 1.0):
+        raise ValueError("region_coupling: mobility fractions must be non-negative, and sum to at most 1 for every region")
+    return coupling
+
+
+def couple_regions(regionCoupling, values):
+    """Apply regionCoupling (nRegions x nRegions, dense or sparse) along the leading (region) axis of values"""
+    nRegions = regionCoupling.shape[0]
+    if np.ndim(values) < 4 or np.shape(values)[0] != nRegions:
+        raise ValueError(f"regionCoupling: expected a leading region axis of length {nRegions}, got shape {np.shape(values)}")
+    return np.reshape(regionCoupling @ np.reshape(values, (nRegions, -1)), np.shape(values))
+
+
+def expand_scenarioAxes(value, nTrailing):
+    """Append nTrailing singleton axes to a per-scenario value, such that it broadcasts against state-shaped arrays"""
+    return np.reshape(value, np.shape(value) + (1,) * nTrailing)
+
+
+def daysBetween(startDate, endDate):
+    """Whole days from startDate to endDate, where either may be an array of per-scenario dates"""
+    if np.ndim(startDate) == 0 and np.ndim(endDate) == 0:
+        return (endDate - startDate).days
+    startDate, endDate = np.broadcast_arrays(
+        np.asarray(startDate, dtype=object), np.asarray(endDate, dtype=object)
+    )
+    return np.asarray(
+        (pd.DatetimeIndex(endDate.ravel()) - pd.DatetimeIndex(startDate.ravel())).days
+    ).reshape(endDate.shape)
+
+
+def stackedScenarios(*paramDicts):
+    """Number of scenarios if any of the (nested) parameter dictionaries are stacked, None otherwise"""
+    for paramDict in paramDicts:
+        if isinstance(paramDict, ScenarioParamDict) and paramDict.is_stacked():
+            return paramDict.nScenarios
+    return None
+
+
+def stackScenarioResults(results):
+    """Stack the arrays of per-scenario results (nested in tuples and dicts) along a new leading axis"""
+    first = results[0]
+    if isinstance(first, dict):
+        return {key: stackScenarioResults([res[key] for res in results]) for key in first}
+    if isinstance(first, tuple):
+        return tuple(stackScenarioResults(list(vals)) for vals in zip(*results))
+    if isinstance(first, np.ndarray):
+        stacked = np.stack(results, axis=0)
+        stacked.setflags(write=first.flags.writeable)
+        return stacked
+    return first
+
+
+# Content hashing and caching of parameter-dependent computations
+def paramHash(*values):
+    """
+    Stable content hash of (nested) parameter values, such as the "_params" sub-dictionaries of a paramDict.
+    Dictionaries are hashed independent of key order, numpy arrays and pandas objects by their contents,
+    functions by their qualified name, code (bytecode, names and constants), defaults and closure contents,
+    functools.partial objects by their function and arguments, and other callables by their repr.
+    """
+    hasher = hashlib.sha1()
+    seenFunctions = set()
+
+    def update(val):
+        if isinstance(val, dict):
+            hasher.update(b"{")
+            for key, item in sorted(val.items(), key=lambda kv: str(kv[0])):
+                update(key)
+                update(item)
+            hasher.update(b"}")
+        elif isinstance(val, (list, tuple)):
+            hasher.update(b"[")
+            for item in val:
+                update(item)
+            hasher.update(b"]")
+        elif isinstance(val, np.ndarray):
+            hasher.update(str((val.dtype.str, val.shape)).encode())
+            if val.dtype == object:
+                for item in val.reshape(-1):
+                    update(item)
+            else:
+                hasher.update(np.ascontiguousarray(val).tobytes())
+        elif sparse.issparse(val):
+            val = sparse.csr_matrix(val, copy=True)
+            val.sum_duplicates()
+            hasher.update(str((val.dtype.str, val.shape)).encode())
+            for part in [val.indptr, val.indices, val.data]:
+                hasher.update(np.ascontiguousarray(part).tobytes())
+        elif isinstance(val, (pd.DataFrame, pd.Series)):
+            hasher.update(repr(val.columns if isinstance(val, pd.DataFrame) else val.name).encode())
+            hasher.update(pd.util.hash_pandas_object(val, index=True).values.tobytes())
+        elif isinstance(val, functools.partial):
+            hasher.update(b"partial(")
+            update(val.func)
+            update(val.args)
+            update(val.keywords)
+            hasher.update(b")")
+        elif isinstance(val, types.FunctionType):
+            hasher.update(f"{val.__module__}.{val.__qualname__}".encode())
+            if id(val) in seenFunctions:  # recursive closures
+                return
+            seenFunctions.add(id(val))
+            update(val.__code__)
+            update(val.__defaults__)
+            update(val.__kwdefaults__)
+            for cell in val.__closure__ or ():
+                try:
+                    update(cell.cell_contents)
+                except ValueError:  # empty cell
+                    hasher.update(b"<empty cell>")
+        elif isinstance(val, types.CodeType):
+            hasher.update(val.co_code)
+            update(val.co_names)
+            update(val.co_consts)
+        elif isinstance(val, (set, frozenset)):
+            hasher.update(b"set(")
+            for item in sorted(val, key=repr):
+                update(item)
+            hasher.update(b")")
+        elif callable(val):
+            # Builtins, classes, ufuncs have a stable repr; for other callable objects it includes their id,
+            # so they only match themselves
+            hasher.update(repr((type(val).__name__, val)).encode())
+        else:
+            hasher.update(repr((type(val).__name__, val)).encode())
+
+    for val in values:
+        update(val)
+
+    return hasher.hexdigest()
+
+
+class LRUCache:
+    """Bounded, least recently used mapping from hash keys to computed values"""
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        if key in self._data:
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+
 # Helper function to adjust average rates to age-aware rates
 def adjustRatesByAge_KeepAverageRate(
-    rate, ageRelativeAdjustment, agePopulationRatio=agePopulationRatio, maxOutRate=1e20
+    rate, ageRelativeAdjustment, agePopulationRatio, maxOutRate=1e20
 ):
     """This is a helper function and wont be picked up as a model parameter!"""
     if rate == 0:
@@ -402,42 +534,146 @@ def adjustRatesByAge_KeepAverageRate(
 # - people's age distribution in travel is square of the usual age distribution
 # - travel rates declined from a base rate as a sigmoid due to border closures, with given mean and slope
 # - infection rates due to travel are modelled as a gamma pdf over time, with given peak value, loc, and scale parameter
-def trFunc_travelInfectionRate_ageAdjusted(
-    t,  # Time (int, in days) within simulation
-    travelMaxTime=travelMaxTime,
-    travelBaseRate=travelBaseRate,  # How many people normally travel back to the country per day # TODO - get data
-    travelDecline_mean=travelDecline_mean,
-    travelDecline_slope=travelDecline_slope,
-    travelInfection_peak=travelInfection_peak,
-    travelInfection_maxloc=travelInfection_maxloc,
-    travelInfection_shape=travelInfection_shape,
-    **kwargs,
+def travelImportationTable(
+    travelMaxTime,
+    travelBaseRate,
+    travelDecline_mean,
+    travelDecline_slope,
+    travelInfection_peak,
+    travelInfection_maxloc,
+    travelInfection_shape,
+    agePopulationRatio,
+    agePopulationTotal=None,
+    travelImportedCases=None,
 ):
+    """
+    Per capita rate of infections imported by travel, for each age group and day of the simulation (... x nAge x days).
+    With travelImportedCases (days x nAge counts, see read_travelImportedCases) the counts are divided by the age group
+    populations, otherwise the modelled curve of the parameters is used (travelMaxTime days).
+    """
+    if travelImportedCases is not None:
+        return np.swapaxes(
+            np.asarray(travelImportedCases, dtype=float) / np.expand_dims(agePopulationTotal, -2), -1, -2
+        )
 
+    # (all parameters may also be per-scenario arrays, see stack_paramDicts)
     tmpTime = np.arange(travelMaxTime)
     # nAge x T TODO get some realistic data on this
-    travelAgeRateByTime = travelBaseRate * np.outer(
-        agePopulationRatio,
-        1 - expit((tmpTime - travelDecline_mean) / travelDecline_slope),
+    travelDeclineByTime = 1 - expit(
+        (tmpTime - expand_scenarioAxes(travelDecline_mean, 1))
+        / expand_scenarioAxes(travelDecline_slope, 1)
+    )
+    travelAgeRateByTime = expand_scenarioAxes(travelBaseRate, 2) * (
+        np.expand_dims(agePopulationRatio, -1) * np.expand_dims(travelDeclineByTime, -2)
     )
 
     # 1 x T TODO get some realistic data on this, maybe make it age weighted
     travelContractionRateByTime = stats.gamma.pdf(
         tmpTime,
-        a=travelInfection_shape,
+        a=expand_scenarioAxes(travelInfection_shape, 1),
         loc=0.0,
-        scale=travelInfection_maxloc / (travelInfection_shape - 1),
+        scale=expand_scenarioAxes(travelInfection_maxloc / (travelInfection_shape - 1), 1),
     )
     travelContractionRateByTime = (
-        travelInfection_peak
+        expand_scenarioAxes(travelInfection_peak, 1)
         * travelContractionRateByTime
-        / np.max(travelContractionRateByTime)
+        / np.max(travelContractionRateByTime, axis=-1, keepdims=True)
     )
 
-    if t >= travelAgeRateByTime.shape[-1]:
-        return np.zeros(travelAgeRateByTime.shape[0])
+    return travelAgeRateByTime * np.expand_dims(travelContractionRateByTime, -2)
+
+
+travelTableCache = LRUCache(maxsize=16)
+
+
+def cached_travelImportationTable(**travelParams):
+    """travelImportationTable, computed once per parameter set"""
+    key = paramHash(travelParams)
+    table = travelTableCache.get(key)
+    if table is None:
+        table = travelImportationTable(**travelParams)
+        table.setflags(write=False)
+        travelTableCache.put(key, table)
+    return table
+
+
+def travel_table(travelParams):
+    """
+    cached_travelImportationTable of the parameters of trFunc_travelInfectionRate_ageAdjusted (its defaults where they are
+    not given), looked up once per run by SimulationCalendar
+    """
+    params = build_paramDict(trFunc_travelInfectionRate_ageAdjusted)
+    params.update(travelParams)
+    return cached_travelImportationTable(
+        **{name: params[name] for name in inspect.getfullargspec(travelImportationTable).args}
+    )
+
+
+def read_travelImportedCases(path, agePopulationRatio, ageGroups=ageGroups):
+    """
+    Daily infections imported by travel (days x nAge), for the travelImportedCases parameter, from a csv file with a "day" column
+    (days since the start of the simulation, days not listed have no imported infections) and either a column per age group
+    or a "total" column (split between the age groups by agePopulationRatio)
+    """
+    df = pd.read_csv(path)
+    if "day" not in df.columns:
+        raise ValueError(f"read_travelImportedCases: {path} has no day column")
+    if all(ageGroup in df.columns for ageGroup in ageGroups):
+        cases = df[list(ageGroups)].to_numpy(dtype=float)
+    elif "total" in df.columns:
+        cases = np.outer(df["total"].to_numpy(dtype=float), agePopulationRatio)
+    else:
+        raise ValueError(f"read_travelImportedCases: {path} needs either a total column or the columns {list(ageGroups)}")
+    days = df["day"].to_numpy(dtype=int)
+    if np.any(days < 0):
+        raise ValueError(f"read_travelImportedCases: negative days in {path}")
+    importedCases = np.zeros((np.max(days, initial=-1) + 1, len(ageGroups)))
+    np.add.at(importedCases, days, cases)
+    return importedCases
+
+
+def trFunc_travelInfectionRate_ageAdjusted(
+    t,  # Time (int, in days) within simulation
+    travelMaxTime=travelMaxTime,
+    travelBaseRate=travelBaseRate,  # How many people normally travel back to the country per day # TODO - get data
+    travelDecline_mean=travelDecline_mean,
+    travelDecline_slope=travelDecline_slope,
+    travelInfection_peak=travelInfection_peak,
+    travelInfection_maxloc=travelInfection_maxloc,
+    travelInfection_shape=travelInfection_shape,
+    travelInterpolate=False,  # Interpolate linearly between days instead of using the rate of the current day
+    travelImportedCases=None,  # Daily imported infections (days x nAge) replacing the modelled rates, see read_travelImportedCases
+    agePopulationRatio=None,  # Filled in by CoexistModel from the input population
+    agePopulationTotal=None,  # Filled in by CoexistModel from the input population
+    *,
+    calendar=None,  # SimulationCalendar with the importation table of the run (passed by dydt_Complete)
+    **kwargs,
+):
+
+    if calendar is not None and calendar.travelTable is not None:
+        table = calendar.travelTable
     else:
-        return travelAgeRateByTime[:, int(t)] * travelContractionRateByTime[int(t)]
+        table = cached_travelImportationTable(
+            travelMaxTime=travelMaxTime,
+            travelBaseRate=travelBaseRate,
+            travelDecline_mean=travelDecline_mean,
+            travelDecline_slope=travelDecline_slope,
+            travelInfection_peak=travelInfection_peak,
+            travelInfection_maxloc=travelInfection_maxloc,
+            travelInfection_shape=travelInfection_shape,
+            agePopulationRatio=agePopulationRatio,
+            agePopulationTotal=agePopulationTotal,
+            travelImportedCases=travelImportedCases,
+        )
+
+    # The rates are read only views of the cached table
+    day = int(t)
+    if day >= table.shape[-1]:
+        return np.zeros(table.shape[:-1])
+    if not travelInterpolate:
+        return table[..., day]
+    next_rate = table[..., day + 1] if day + 1 < table.shape[-1] else 0.0
+    return table[..., day] + (t - day) * (next_rate - table[..., day])
 
 
 # Overall new infections include within quarantine and hospital infections
@@ -448,11 +684,14 @@ def trFunc_newInfections_Complete(
     stateTensor,
     policySocialDistancing,  # True / False, no default because it's important to know which one we use at any moment!
     policyImmunityPassports,  # True / False, no default because it's important to know which one we use at any moment!
-    ageSocialMixingBaseline=ageSocialMixingBaseline,
-    ageSocialMixingDistancing=ageSocialMixingDistancing,
-    ageSocialMixingIsolation=ageSocialMixingIsolation,
-    withinHospitalSocialMixing=withinHospitalSocialMixing,
-    transmissionInfectionStage=transmissionInfectionStage,
+    # Filled in by CoexistModel from the input files
+    ageSocialMixingBaseline=None,
+    ageSocialMixingDistancing=None,
+    ageSocialMixingIsolation=None,
+    withinHospitalSocialMixing=None,
+    transmissionInfectionStage=None,
+    # Metapopulation runs only: nRegions x nRegions coupling of the regions stacked along the scenario axis (see Metapopulation)
+    regionCoupling=None,
     **kwargs,
 ):
     """
@@ -474,33 +713,56 @@ def trFunc_newInfections_Complete(
     This separation will help disentangle the effects of simply a blanket lessening of social distancing
     (keeping the policy True but with less effective ageSocialMixingDistancing matrix),
     vs case isolation (policy = False, but with serious ageSocialMixingIsolation)
+
+    The stateTensor, the policies and the parameters may all have a leading scenario axis (see stack_paramDicts).
+
+    With a regionCoupling, the scenarios are regions: the community (non-hospital) infections of region r are driven by
+    sum_s regionCoupling[r, s] * (infectious fraction of the population of region s), hospital infections stay local.
     """
 
-    ageIsoContractionRate = np.zeros((nAge, nIso, nTest))
+    ageIsoContractionRate = np.zeros(stateTensor.shape[:-3] + (nIso, nTest))
+
+    # Infectious people in each age group, isolation and testing state, weighted by infection stage,
+    # as a fraction of the total population
+    infectiousByIsoTest = np.einsum(
+        "...ijkl,...j->...ikl",
+        stateTensor[..., 1 : (nI + 1), :, :],
+        transmissionInfectionStage,
+    ) / expand_scenarioAxes(np.sum(stateTensor, axis=(-4, -3, -2, -1)), 3)
+
+    communityInfectiousByIsoTest = infectiousByIsoTest
+    if regionCoupling is not None:
+        communityInfectiousByIsoTest = couple_regions(regionCoupling, infectiousByIsoTest)
+
+    def infectious(isoStates, testStates=slice(None), local=False):
+        return np.sum(
+            (infectiousByIsoTest if local else communityInfectiousByIsoTest)[..., isoStates, testStates],
+            axis=(-2, -1),
+        )
+
+    def mix(socialMixing, infectiousByAge):
+        return np.einsum("...ij,...j->...i", socialMixing, infectiousByAge)
 
     # Add non-hospital infections
     # --------------------------------
 
-    curNonIsolatedSocialMixing = (
-        ageSocialMixingDistancing if policySocialDistancing else ageSocialMixingBaseline
+    curNonIsolatedSocialMixing = np.where(
+        expand_scenarioAxes(policySocialDistancing, 2),
+        ageSocialMixingDistancing,
+        ageSocialMixingBaseline,
     )
 
     # Add baseline interactions only between non-isolated people
     for k1 in [0, 3]:
         for k2 in [0, 3]:
-            ageIsoContractionRate[:, k1, :] += np.expand_dims(
-                np.matmul(
-                    curNonIsolatedSocialMixing,
-                    np.einsum(
-                        "ijl,j->i",
-                        stateTensor[:, 1 : (nI + 1), k2, :],
-                        transmissionInfectionStage,
-                    ),  # all infected in non-isolation
-                ),
-                axis=1,
+            ageIsoContractionRate[..., k1, :] += np.expand_dims(
+                mix(
+                    curNonIsolatedSocialMixing, infectious([k2])
+                ),  # all infected in non-isolation
+                axis=-1,
             )
 
-    if policyImmunityPassports:
+    if np.any(policyImmunityPassports):
         # If the immunity passports policy is on, everyone who tested antibody positive, can roam freely
         # Therefore replace the interactions between people with testingState = 2 with ageSocialMixingBaseline
         # we do this by using the distributive property of matrix multiplication, and adding extra interactions
@@ -508,42 +770,29 @@ def trFunc_newInfections_Complete(
         # TODO - this is a bit hacky?, but probably correct - double check though!
         for k1 in [0, 3]:
             for k2 in [0, 3]:
-                ageIsoContractionRate[:, k1, 2:] += np.matmul(
-                    ageSocialMixingBaseline - curNonIsolatedSocialMixing,
-                    np.einsum(
-                        "ijk,j->ik",
-                        stateTensor[:, 1 : (nI + 1), k2, 2:],
-                        transmissionInfectionStage,
-                    ),  # all infected in non-isolation
-                )
+                for l in [2, 3]:
+                    ageIsoContractionRate[..., k1, l] += expand_scenarioAxes(
+                        policyImmunityPassports, 1
+                    ) * mix(
+                        ageSocialMixingBaseline - curNonIsolatedSocialMixing,
+                        infectious([k2], slice(l, l + 1)),
+                    )  # all infected in non-isolation
 
     # Add isolation interactions only between isolated and non-isolated people
     # non-isolated contracting it from isolated
     for k1 in [0, 3]:
-        ageIsoContractionRate[:, k1, :] += np.expand_dims(
-            np.matmul(
-                ageSocialMixingIsolation,
-                np.einsum(
-                    "ijl,j->i",
-                    stateTensor[:, 1 : (nI + 1), 1, :],
-                    transmissionInfectionStage,
-                ),  # all infected in isolation
-            ),
-            axis=1,
+        ageIsoContractionRate[..., k1, :] += np.expand_dims(
+            mix(ageSocialMixingIsolation, infectious([1])),  # all infected in isolation
+            axis=-1,
         )
 
     # isolated contracting it from non-isolated
     for k1 in [0, 3]:
-        ageIsoContractionRate[:, 1, :] += np.expand_dims(
-            np.matmul(
-                ageSocialMixingIsolation,
-                np.einsum(
-                    "ijl,j->i",
-                    stateTensor[:, 1 : (nI + 1), k1, :],
-                    transmissionInfectionStage,
-                ),  # all infected in non-hospital, non-isolation
-            ),
-            axis=1,
+        ageIsoContractionRate[..., 1, :] += np.expand_dims(
+            mix(
+                ageSocialMixingIsolation, infectious([k1])
+            ),  # all infected in non-hospital, non-isolation
+            axis=-1,
         )
 
         # isolated cannot contracting it from another isolated
@@ -553,17 +802,13 @@ def trFunc_newInfections_Complete(
     # (TODO - within hospitals we probably want to take into effect the testing state;
     #      tested people are better isolated and there's less mixing)
 
-    ageIsoContractionRate[:, 2:, :] += np.expand_dims(
-        withinHospitalSocialMixing
-        * np.einsum(
-            "ijkl,j->i", stateTensor[:, 1 : (nI + 1), 2:, :], transmissionInfectionStage
-        ),  # all infected in hospital (sick or working)
-        axis=(1, 2),
+    ageIsoContractionRate[..., 2:, :] += np.expand_dims(
+        expand_scenarioAxes(withinHospitalSocialMixing, 1)
+        * infectious(slice(2, None), local=True),  # all infected in hospital (sick or working)
+        axis=(-1, -2),
     )
 
-    return ageIsoContractionRate / np.sum(
-        stateTensor
-    )  # Normalise the rate by total population
+    return ageIsoContractionRate
 
 
 # Build the transition tensor from any non-hospitalised state to a hospitalised state
@@ -576,13 +821,16 @@ def trFunc_newInfections_Complete(
 
 
 def trFunc_HospitalAdmission(
-    ageHospitalisationRateBaseline=ageHospitalisationRateBaseline,
-    infToHospitalExtra=infToHospitalExtra,
-    ageRelativeExtraAdmissionRiskToCovid=relativeAdmissionRisk_given_COVID_by_age
-    * riskOfAEAttandance_by_age,
+    # Filled in by CoexistModel from the input files
+    ageHospitalisationRateBaseline=None,
+    infToHospitalExtra=None,
+    ageRelativeExtraAdmissionRiskToCovid=None,  # relativeAdmissionRisk_given_COVID_by_age * riskOfAEAttandance_by_age
+    agePopulationRatio=None,
     **kwargs,
 ):
 
+    nAge = len(ageHospitalisationRateBaseline)
+
     # This tensor will pointwise multiply an nAge x nHS slice of the stateTensor
     trTensor_HospitalAdmission = np.zeros((nAge, nHS))
 
@@ -594,6 +842,7 @@ def trFunc_HospitalAdmission(
         ageAdjusted_infToHospitalExtra[:, ii] = adjustRatesByAge_KeepAverageRate(
             infToHospitalExtra[ii],
             ageRelativeAdjustment=ageRelativeExtraAdmissionRiskToCovid,
+            agePopulationRatio=agePopulationRatio,
         )
 
     # Add baseline hospitalisation to all non-dead states
@@ -615,12 +864,12 @@ def trFunc_HospitalAdmission(
 
 
 def trFunc_HospitalDischarge(
-    ageHospitalisationRecoveryRateBaseline=ageHospitalisationRecoveryRateBaseline,
+    ageHospitalisationRecoveryRateBaseline=None,  # Filled in by CoexistModel from the input files
     dischargeDueToCovidRateMultiplier=3.0,
     **kwargs,
 ):
 
-    trTensor_HospitalDischarge = np.zeros((nAge, nHS))
+    trTensor_HospitalDischarge = np.zeros((len(ageHospitalisationRecoveryRateBaseline), nHS))
 
     # Baseline discharges apply to all non-symptomatic patients (TODO: take into account testing state!)
     trTensor_HospitalDischarge[:, :3] += ageHospitalisationRecoveryRateBaseline[
@@ -651,13 +900,18 @@ def trFunc_diseaseProgression(
     IgG_formation=15.0,
     # Age related parameters
     # for now we'll assume that all hospitalised cases are known (overall 23% of hospitalised COVID patients die. 9% overall case fatality ratio)
-    caseFatalityRatioHospital_given_COVID_by_age=caseFatalityRatioHospital_given_COVID_by_age,
-    ageRelativeRecoverySpeed=ageRelativeRecoverySpeed,
+    # (filled in by CoexistModel from the input files)
+    caseFatalityRatioHospital_given_COVID_by_age=None,
+    ageRelativeRecoverySpeed=None,
+    relativeDeathRisk_given_COVID_by_age=None,
+    agePopulationRatio=None,
     # Unknown rates to estimate
     nonsymp_to_recovery=15.0,
     inverse_IS1_IS2=4.0,
     **kwargs,
 ):
+    nAge = len(caseFatalityRatioHospital_given_COVID_by_age)
+
     # Now we have all the information to build the age-aware multistage SIR model transition matrix
     # The full transition tensor is a sparse map from the Age x HealthState x isolation state to HealthState,
     # and thus is a 4th order tensor itself, representing a linear mapping
@@ -707,6 +961,7 @@ def trFunc_diseaseProgression(
         ageAdjusted_diseaseProgBaseline[:, ii, -1] = adjustRatesByAge_KeepAverageRate(
             ageAdjusted_diseaseProgBaseline[0, ii, -1],
             ageRelativeAdjustment=relativeDeathRisk_given_COVID_by_age,
+            agePopulationRatio=agePopulationRatio,
         )
 
         # Adjust recovery rate by age dependent recovery speed
@@ -861,6 +1116,123 @@ def inpFunc_testSpecifications(
     return testSpecifications
 
 
+# The testSpecifications table is compiled into arrays once per parameter set,
+# such that the test transition tensor is a single contraction in trFunc_testing
+testSpecificationsCache = LRUCache(maxsize=16)
+
+
+def compile_testSpecifications(testSpecifications, nTest=nTest):
+    """
+    Convert a testSpecifications table into numpy arrays, indexed by (test type, health state) or (test type, test state):
+    - testTypes: test names, in order of appearance in the table
+    - falseNegativeRate, falsePositiveRate, truePositive (mask)
+    - positiveTestState, negativeTestState: output test state after a positive / negative test, given the current test state
+    - testTransitionProbs: nTestTypes x nHS x nTest x nTest probabilities of ending up in each test state after a test
+    """
+    testTypes = list(pd.unique(testSpecifications["Name"]))
+    nHS_spec = int(np.max(testSpecifications["InputHealthState"])) + 1
+
+    falseNegativeRate = np.zeros((len(testTypes), nHS_spec))
+    falsePositiveRate = np.zeros((len(testTypes), nHS_spec))
+    truePositive = np.zeros((len(testTypes), nHS_spec), dtype=bool)
+    positiveTestState = np.zeros((len(testTypes), nTest), dtype=int)
+    negativeTestState = np.zeros((len(testTypes), nTest), dtype=int)
+
+    for ii, testType in enumerate(testTypes):
+        curTestSpecs = testSpecifications[testSpecifications["Name"] == testType]
+        curHS = curTestSpecs["InputHealthState"].values.astype(int)
+        falseNegativeRate[ii, curHS] = curTestSpecs["FalseNegativeRate"].values
+        falsePositiveRate[ii, curHS] = curTestSpecs["FalsePositiveRate"].values
+        truePositive[ii, curTestSpecs["TruePosHealthState"].values[0]] = True
+
+        outputTestState = int(curTestSpecs["OutputTestState"].values[0])
+        for curTS in range(nTest):
+            # Set output positive test state based on current test state
+            if curTS == outputTestState:
+                # already positive for the given test
+                positiveTestState[ii, curTS] = curTS
+            elif curTS == 3:
+                # If already positive for both, stay positive
+                positiveTestState[ii, curTS] = 3
+            else:
+                # Transition 0->1, 0->2, 1->2, 1->3 or 2->3
+                positiveTestState[ii, curTS] = curTS + outputTestState
+
+            # Where do we go after negative test based on where we are now?
+            if curTS == 0:
+                # Negatives stay negatives
+                negativeTestState[ii, curTS] = 0
+            elif curTS == 3:
+                # go to only virus or antibody positive from both positive
+                negativeTestState[ii, curTS] = 3 - outputTestState
+            elif curTS == outputTestState:
+                # go to 0 if tested for the one you're positive for
+                negativeTestState[ii, curTS] = 0
+            else:
+                # stay where you are if you test negative for the one you didnt have anyway
+                negativeTestState[ii, curTS] = curTS
+
+    # True positives * (1-FNR) and false positives * FPR go to the positive state,
+    # false negatives * FNR and true negatives (weighted by the FPR, as in the original table-based kernel) to the negative state
+    positiveProb = np.where(truePositive, 1 - falseNegativeRate, falsePositiveRate)
+    negativeProb = np.where(truePositive, falseNegativeRate, falsePositiveRate)
+    testStates = np.arange(nTest)
+    testTransitionProbs = np.einsum(
+        "tj,tlm->tjlm",
+        positiveProb,
+        (positiveTestState[:, :, np.newaxis] == testStates).astype(float),
+    ) + np.einsum(
+        "tj,tlm->tjlm",
+        negativeProb,
+        (negativeTestState[:, :, np.newaxis] == testStates).astype(float),
+    )
+
+    return {
+        "testTypes": testTypes,
+        "falseNegativeRate": falseNegativeRate,
+        "falsePositiveRate": falsePositiveRate,
+        "truePositive": truePositive,
+        "positiveTestState": positiveTestState,
+        "negativeTestState": negativeTestState,
+        "testTransitionProbs": testTransitionProbs,
+    }
+
+
+def cached_testSpecifications(inpFunc_testSpecifications, inpFunc_testSpecifications_params):
+    """Build and compile the test specifications once per parameter set (and per scenario, if the parameters are stacked)"""
+    key = paramHash(inpFunc_testSpecifications, inpFunc_testSpecifications_params)
+    compiled = testSpecificationsCache.get(key)
+    if compiled is not None:
+        return compiled
+
+    nScenarios = stackedScenarios(inpFunc_testSpecifications_params)
+    if nScenarios is not None:
+        compiledScenarios = [
+            cached_testSpecifications(
+                inpFunc_testSpecifications,
+                select_scenario(inpFunc_testSpecifications_params, scenario),
+            )
+            for scenario in range(nScenarios)
+        ]
+        if any(
+            compiled["testTypes"] != compiledScenarios[0]["testTypes"]
+            for compiled in compiledScenarios
+        ):
+            raise ValueError(
+                "cached_testSpecifications: the test types have to be the same in all scenarios"
+            )
+        compiled = stackScenarioResults(compiledScenarios)
+    else:
+        compiled = compile_testSpecifications(
+            inpFunc_testSpecifications(**inpFunc_testSpecifications_params)
+        )
+        for val in compiled.values():
+            if isinstance(val, np.ndarray):
+                val.setflags(write=False)
+    testSpecificationsCache.put(key, compiled)
+    return compiled
+
+
 # For PCR - we will model this (for now, for fitting we'll plug in real data!), as the sum of two sigmoids:
 #   - initial stage of PHE ramping up its limited capacity (parameterised by total capacity, inflection day and slope of ramp-up)
 #   - second stage of non-PHE labs joining in and ramping up capacity (this hasn't happened yet, but expected soon! same parameterisation)
@@ -893,30 +1265,34 @@ def trFunc_testCapacity(
 ):
 
     # Returns a dictionary with test names and number available at day "t"
+    # (per scenario, if any of the parameters are stacked)
 
     outPCR = (
         # phe phase
         testCapacity_pcr_phe_total
         * expit(
-            (realTime - testCapacity_pcr_phe_inflexday).days
+            daysBetween(testCapacity_pcr_phe_inflexday, realTime)
             / testCapacity_pcr_phe_inflexslope
         )
         +
         # whole country phase
         testCapacity_pcr_country_total
         * expit(
-            (realTime - testCapacity_pcr_country_inflexday).days
+            daysBetween(testCapacity_pcr_country_inflexday, realTime)
             / testCapacity_pcr_country_inflexslope
         )
     )
 
-    if realTime < testCapacity_antibody_country_firstday:
-        outAntiTotal = 0.0
-    else:
-        outAntiTotal = testCapacity_antibody_country_total * expit(
-            (realTime - testCapacity_antibody_country_inflexday).days
+    # No antibody / antigen tests before the first day
+    outAntiTotal = (
+        daysBetween(testCapacity_antibody_country_firstday, realTime) >= 0
+    ) * (
+        testCapacity_antibody_country_total
+        * expit(
+            daysBetween(testCapacity_antibody_country_inflexday, realTime)
             / testCapacity_antibody_country_inflexslope
         )
+    )
 
     return {
         "PCR": outPCR,
@@ -926,16 +1302,29 @@ def trFunc_testCapacity(
 
 
 def inpFunc_testingDataCHESS_PCR(
-    realTime, realTestData=df_CHESS_numTests_regroup, **kwargs
+    realTime,  # a date, or an array of dates
+    realTestData=None,  # Date x nAge table of administered tests, filled in by CoexistModel from the input files
+    **kwargs
 ):
-    def nearest(items, pivot):
-        return min(items, key=lambda x: abs(x - pivot))
+    """
+    The row of realTestData with the date nearest to realTime (the earlier one on ties), named by its date.
+    For an array of dates, the table of the nearest rows.
+    """
+    if not realTestData.index.is_monotonic_increasing:
+        realTestData = realTestData.sort_index()
+    dataDays = pd.DatetimeIndex(realTestData.index).asi8
+    pivots = pd.DatetimeIndex(np.atleast_1d(pd.to_datetime(realTime, format="%Y-%m-%d"))).asi8
+
+    # Binary search for the first date at or after each pivot, then take the nearer of it and the date before
+    after = np.minimum(np.searchsorted(dataDays, pivots), len(dataDays) - 1)
+    before = np.maximum(after - 1, 0)
+    nearest = np.where(
+        np.abs(dataDays[after] - pivots) < np.abs(dataDays[before] - pivots), after, before
+    )
 
-    return df_CHESS_numTests_regroup.loc[
-        nearest(
-            df_CHESS_numTests_regroup.index, pd.to_datetime(realTime, format="%Y-%m-%d")
-        )
-    ]
+    if np.ndim(realTime) == 0:
+        return realTestData.iloc[nearest[0]]
+    return realTestData.iloc[nearest]
 
 
 # Symptom parameters
@@ -980,28 +1369,36 @@ def distTestsSymp(
     """
     distribute tests amongst symptomatic people
     people is nAge x nHS-1 x ... (excluding dead)
+    In batched runs testsAvailable has one entry per scenario, and people (and noncovid_sympRatio) a matching leading scenario axis.
     """
+    nBatch = np.ndim(testsAvailable)
+    nTrailing = np.ndim(people) - nBatch
+    noncovid_sympRatio = expand_scenarioAxes(noncovid_sympRatio, nTrailing)
 
     # Calculate noncovid, but symptomatic people
     peopleSymp = copy.deepcopy(people)
-    peopleSymp[:, : min(symp_HS)] *= noncovid_sympRatio
-    peopleSymp[:, max(symp_HS) :] *= noncovid_sympRatio
+    peopleSymp[(Ellipsis,) + (slice(None), slice(None, min(symp_HS))) + (slice(None),) * (nTrailing - 2)] *= noncovid_sympRatio
+    peopleSymp[(Ellipsis,) + (slice(None), slice(max(symp_HS), None)) + (slice(None),) * (nTrailing - 2)] *= noncovid_sympRatio
 
     # Subtract already tested people
     if alreadyTestedRate is not None:
         peopleSymp -= people * alreadyTestedRate
 
-    # Check if we already tested everyone with a different test
-    if np.sum(peopleSymp) < 1e-6:  # avoid numerical instabilities
-        return (0.0, 0.0)
+    peopleSympTotal = np.sum(peopleSymp, axis=tuple(range(nBatch, np.ndim(people))))
 
-    testedRatio = min(1.0, testsAvailable / np.sum(peopleSymp))
+    # Check if we already tested everyone with a different test
+    # (avoid numerical instabilities, no tests are used then)
+    testedRatio = np.where(
+        peopleSympTotal < 1e-6,
+        0.0,
+        np.minimum(1.0, testsAvailable / np.maximum(peopleSympTotal, 1e-6)),
+    )
 
     return (
         # test rate
-        testedRatio * (peopleSymp / (people + 1e-6)),  # avoid dividing by zero
+        expand_scenarioAxes(testedRatio, nTrailing) * (peopleSymp / (people + 1e-6)),  # avoid dividing by zero
         # tests used to achieve this
-        testedRatio * np.sum(peopleSymp),
+        testedRatio * peopleSympTotal,
     )
 
 
@@ -1045,47 +1442,46 @@ def policyFunc_testing_symptomaticOnly(
 
     # Hospitalised people get priority over PCR tests
     testRate, testsUsed = distTestsSymp(
-        people=stateTensor[
-            :, :-1, 2, 0
+        people=stateTensor[..., :-1, 2, 0
         ],  # hospitalised non-positive people, exclude tested and dead people
         testsAvailable=testsAvailable["PCR"],
         noncovid_sympRatio=cur_noncovid_sympRatio[1],
     )
 
-    out_testRate[:, :-1, 2, 0, testTypes.index("PCR")] += testRate
+    out_testRate[..., :-1, 2, 0, testTypes.index("PCR")] += testRate
     testsAvailable["PCR"] -= testsUsed
 
     # Prioritise hospital workers next:
     # TODO: check if we should do this? In UK policy there was a 15% max for hospital worker testing until ~2 April...
     testRate, testsUsed = distTestsSymp(
-        people=stateTensor[:, :-1, 3, 0],
+        people=stateTensor[..., :-1, 3, 0],
         testsAvailable=testsAvailable["PCR"],
         noncovid_sympRatio=cur_noncovid_sympRatio[0],
     )
 
-    out_testRate[:, :-1, 3, 0, testTypes.index("PCR")] += testRate
+    out_testRate[..., :-1, 3, 0, testTypes.index("PCR")] += testRate
     testsAvailable["PCR"] -= testsUsed
 
     # Distribute PCRs left over the other populations
     testRate, testsUsed = distTestsSymp(
-        people=stateTensor[:, :-1, :2, 0],
+        people=stateTensor[..., :-1, :2, 0],
         testsAvailable=testsAvailable["PCR"],
         noncovid_sympRatio=cur_noncovid_sympRatio[0],
     )
 
-    out_testRate[:, :-1, :2, 0, testTypes.index("PCR")] += testRate
+    out_testRate[..., :-1, :2, 0, testTypes.index("PCR")] += testRate
     testsAvailable["PCR"] -= testsUsed
 
     if distributeRemainingToRandom:
         # Distribute PCRs left over the other populations
         testRate, testsUsed = distTestsSymp(
-            people=stateTensor[:, :-1, :, 0],
+            people=stateTensor[..., :-1, :, 0],
             testsAvailable=testsAvailable["PCR"],
             noncovid_sympRatio=1.0,
-            alreadyTestedRate=out_testRate[:, :-1, :, 0, testTypes.index("PCR")],
+            alreadyTestedRate=out_testRate[..., :-1, :, 0, testTypes.index("PCR")],
         )
 
-        out_testRate[:, :-1, :, 0, testTypes.index("PCR")] += testRate
+        out_testRate[..., :-1, :, 0, testTypes.index("PCR")] += testRate
         testsAvailable["PCR"] -= testsUsed
 
     # Antigen testing
@@ -1093,50 +1489,49 @@ def policyFunc_testing_symptomaticOnly(
 
     # Hospitalised people get priority over PCR tests
     testRate, testsUsed = distTestsSymp(
-        people=stateTensor[
-            :, :-1, 2, 0
+        people=stateTensor[..., :-1, 2, 0
         ],  # hospitalised non-positive people, exclude tested and dead people
         testsAvailable=testsAvailable["Antigen"],
         noncovid_sympRatio=cur_noncovid_sympRatio[1],
-        alreadyTestedRate=out_testRate[:, :-1, 2, 0, testTypes.index("PCR")],
+        alreadyTestedRate=out_testRate[..., :-1, 2, 0, testTypes.index("PCR")],
     )
 
-    out_testRate[:, :-1, 2, 0, testTypes.index("Antigen")] += testRate
+    out_testRate[..., :-1, 2, 0, testTypes.index("Antigen")] += testRate
     testsAvailable["Antigen"] -= testsUsed
 
     # Prioritise hospital workers next:
     # TODO: check if we should do this? In UK policy there was a 15% max for hospital worker testing until ~2 April...
     testRate, testsUsed = distTestsSymp(
-        people=stateTensor[:, :-1, 3, 0],
+        people=stateTensor[..., :-1, 3, 0],
         testsAvailable=testsAvailable["Antigen"],
         noncovid_sympRatio=cur_noncovid_sympRatio[0],
-        alreadyTestedRate=out_testRate[:, :-1, 3, 0, testTypes.index("PCR")],
+        alreadyTestedRate=out_testRate[..., :-1, 3, 0, testTypes.index("PCR")],
     )
 
-    out_testRate[:, :-1, 3, 0, testTypes.index("Antigen")] += testRate
+    out_testRate[..., :-1, 3, 0, testTypes.index("Antigen")] += testRate
     testsAvailable["Antigen"] -= testsUsed
 
     # Distribute Antigen tests left over the other symptomatic people
     testRate, testsUsed = distTestsSymp(
-        people=stateTensor[:, :-1, :2, 0],
+        people=stateTensor[..., :-1, :2, 0],
         testsAvailable=testsAvailable["Antigen"],
         noncovid_sympRatio=cur_noncovid_sympRatio[0],
-        alreadyTestedRate=out_testRate[:, :-1, :2, 0, testTypes.index("PCR")],
+        alreadyTestedRate=out_testRate[..., :-1, :2, 0, testTypes.index("PCR")],
     )
 
-    out_testRate[:, :-1, :2, 0, testTypes.index("Antigen")] += testRate
+    out_testRate[..., :-1, :2, 0, testTypes.index("Antigen")] += testRate
     testsAvailable["Antigen"] -= testsUsed
 
     if distributeRemainingToRandom:
         # Distribute antigen tests left over the other non-symptmatic populations
         testRate, testsUsed = distTestsSymp(
-            people=stateTensor[:, :-1, :, 0],
+            people=stateTensor[..., :-1, :, 0],
             testsAvailable=testsAvailable["Antigen"],
             noncovid_sympRatio=1.0,
-            alreadyTestedRate=out_testRate[:, :-1, :, 0, :].sum(-1),
+            alreadyTestedRate=out_testRate[..., :-1, :, 0, :].sum(-1),
         )
 
-        out_testRate[:, :-1, :, 0, testTypes.index("Antigen")] += testRate
+        out_testRate[..., :-1, :, 0, testTypes.index("Antigen")] += testRate
         testsAvailable["Antigen"] -= testsUsed
 
     # Antibody testing
@@ -1146,56 +1541,56 @@ def policyFunc_testing_symptomaticOnly(
 
         # For now: give to hospital workers first, not taking into account previous tests or symptoms
         testRate, testsUsed = distTestsSymp(
-            people=stateTensor[:, :-1, 3, :2],
+            people=stateTensor[..., :-1, 3, :2],
             testsAvailable=testsAvailable["Antibody"],
             noncovid_sympRatio=1.0,  # basically workers get antibody tested regardless of symptoms
         )
 
-        out_testRate[:, :-1, 3, :2, testTypes.index("Antibody")] += testRate
+        out_testRate[..., :-1, 3, :2, testTypes.index("Antibody")] += testRate
         testsAvailable["Antibody"] -= testsUsed
 
         # Afterwards let's just distribute randomly in the rest of the population
         testRate, testsUsed = distTestsSymp(
-            people=stateTensor[:, :-1, :3, :2],
+            people=stateTensor[..., :-1, :3, :2],
             testsAvailable=testsAvailable["Antibody"],
             noncovid_sympRatio=1.0,  # basically people get antibody tested regardless of symptoms
         )
 
-        out_testRate[:, :-1, :3, :2, testTypes.index("Antibody")] += testRate
+        out_testRate[..., :-1, :3, :2, testTypes.index("Antibody")] += testRate
         testsAvailable["Antibody"] -= testsUsed
 
     if antibody_testing_policy == "virus_positive_only_hospworker_first":
 
         # For now: give to hospital workers first, not taking into account previous tests or symptoms
         testRate, testsUsed = distTestsSymp(
-            people=stateTensor[:, :-1, 3, 1],
+            people=stateTensor[..., :-1, 3, 1],
             testsAvailable=testsAvailable["Antibody"],
             noncovid_sympRatio=1.0,  # basically workers get antibody tested regardless of symptoms
         )
 
-        out_testRate[:, :-1, 3, 1, testTypes.index("Antibody")] += testRate
+        out_testRate[..., :-1, 3, 1, testTypes.index("Antibody")] += testRate
         testsAvailable["Antibody"] -= testsUsed
 
         # Afterwards let's just distribute randomly in the rest of the population
         # TODO: Maybe prioratise people who tested positive for the virus before???
         testRate, testsUsed = distTestsSymp(
-            people=stateTensor[:, :-1, :3, 1],
+            people=stateTensor[..., :-1, :3, 1],
             testsAvailable=testsAvailable["Antibody"],
             noncovid_sympRatio=1.0,  # basically people get antibody tested regardless of symptoms
         )
 
-        out_testRate[:, :-1, :3, 1, testTypes.index("Antibody")] += testRate
+        out_testRate[..., :-1, :3, 1, testTypes.index("Antibody")] += testRate
         testsAvailable["Antibody"] -= testsUsed
 
     if antibody_testing_policy == "virus_positive_only":
 
         testRate, testsUsed = distTestsSymp(
-            people=stateTensor[:, :-1, :, 1],
+            people=stateTensor[..., :-1, :, 1],
             testsAvailable=testsAvailable["Antibody"],
             noncovid_sympRatio=1.0,  # basically people get antibody tested regardless of symptoms
         )
 
-        out_testRate[:, :-1, :, 1, testTypes.index("Antibody")] += testRate
+        out_testRate[..., :-1, :, 1, testTypes.index("Antibody")] += testRate
         testsAvailable["Antibody"] -= testsUsed
 
     if antibody_testing_policy == "none":
@@ -1265,46 +1660,46 @@ def policyFunc_testing_massTesting_with_reTesting(
 
     # Retesting immune positive people
     testRate, testsUsed = distTestsSymp(
-        people=stateTensor[:, :-1, :, 2:],  # immune positive people
+        people=stateTensor[..., :-1, :, 2:],  # immune positive people
         testsAvailable=testsAvailable["Antigen"] * retesting_antigen_immunepos_ratio,
         noncovid_sympRatio=1.0,  # set to 1. for ignoring symptom vs non-symptom
     )
 
-    out_testRate[:, :-1, :, 2:, testTypes.index("Antigen")] += testRate
+    out_testRate[..., :-1, :, 2:, testTypes.index("Antigen")] += testRate
     testsAvailable["Antigen"] -= testsUsed
 
     # Distribute antigen tests left over the other non-symptmatic populations
     # UPDATE <- here we use tests equally distributed among people with negative or positive previous virus tests,
     # as long as they are in non-quarantined state (isoState 0) # TODO - hospital worker testing???
     testRate, testsUsed = distTestsSymp(
-        people=stateTensor[:, :-1, 0, :2],  # non-quarantined virus positive people
+        people=stateTensor[..., :-1, 0, :2],  # non-quarantined virus positive people
         testsAvailable=testsAvailable["Antigen"],
         noncovid_sympRatio=1.0,
-        alreadyTestedRate=out_testRate[:, :-1, 0, :2, testTypes.index("Antigen")]
-        + out_testRate[:, :-1, 0, :2, testTypes.index("PCR")],
+        alreadyTestedRate=out_testRate[..., :-1, 0, :2, testTypes.index("Antigen")]
+        + out_testRate[..., :-1, 0, :2, testTypes.index("PCR")],
     )
 
-    out_testRate[:, :-1, 0, :2, testTypes.index("Antigen")] += testRate
+    out_testRate[..., :-1, 0, :2, testTypes.index("Antigen")] += testRate
     testsAvailable["Antigen"] -= testsUsed
 
     # Antibody testing
     # -----------------
     # Retesting antibody positive people
     testRate, testsUsed = distTestsSymp(
-        people=stateTensor[:, :-1, :, 2:],  # virus positive people
+        people=stateTensor[..., :-1, :, 2:],  # virus positive people
         testsAvailable=testsAvailable["Antibody"] * retesting_antibody_immunepos_ratio,
         noncovid_sympRatio=1.0,  # set to 1. for ignoring symptom vs non-symptom
     )
 
     # Afterwards let's just distribute randomly in the rest of the population
     testRate, testsUsed = distTestsSymp(
-        people=stateTensor[:, :-1, :, :2],
+        people=stateTensor[..., :-1, :, :2],
         testsAvailable=testsAvailable["Antibody"],
         noncovid_sympRatio=1.0,  # basically people get antibody tested regardless of symptoms
-        alreadyTestedRate=out_testRate[:, :-1, :, :2, testTypes.index("Antibody")],
+        alreadyTestedRate=out_testRate[..., :-1, :, :2, testTypes.index("Antibody")],
     )
 
-    out_testRate[:, :-1, :, :2, testTypes.index("Antibody")] += testRate
+    out_testRate[..., :-1, :, :2, testTypes.index("Antibody")] += testRate
     testsAvailable["Antibody"] -= testsUsed
 
     if return_testsAvailable_remaining:
@@ -1322,43 +1717,69 @@ def trFunc_testing(
     inpFunc_testSpecifications=inpFunc_testSpecifications,
     trFunc_testCapacity=trFunc_testCapacity,
     inpFunc_realData_testCapacity=inpFunc_testingDataCHESS_PCR,
+    *,
+    calendar=None,  # SimulationCalendar with the precomputed test specifications, daily test capacity and data (passed by dydt_Complete)
     **kwargs,
 ):
     """
     Returns a tensor of rates transitioning to tested states
+    The stateTensor may have a leading scenario axis, as long as realStartDate is shared by all scenarios.
     """
-    trTensor_testTransitions = np.zeros((nAge, nHS, nIso, nTest, nTest))
+    if np.ndim(realStartDate) > 0:
+        raise NotImplementedError(
+            "trFunc_testing: realStartDate has to be the same in all scenarios of a batched run"
+        )
+    batchShape = stateTensor.shape[:-4]
 
-    testSpecifications = inpFunc_testSpecifications(
-        **kwargs["inpFunc_testSpecifications_params"]
-    )
+    if calendar is not None and calendar.testSpecifications is not None:
+        compiledTestSpecifications = calendar.testSpecifications
+    else:
+        compiledTestSpecifications = cached_testSpecifications(
+            inpFunc_testSpecifications, kwargs["inpFunc_testSpecifications_params"]
+        )
 
-    testTypes = list(set(testSpecifications["Name"]))
+    testTypes = compiledTestSpecifications["testTypes"]
 
     # Check if we have real data on the administered tests
 
     # Add the current data on within-hospital PCRs carried out already
-    curDate = pd.to_datetime(realStartDate, format="%Y-%m-%d") + pd.to_timedelta(
-        int(t), unit="D"
-    )
-    realData_closest = inpFunc_realData_testCapacity(
-        realTime=curDate, **kwargs["inpFunc_realData_testCapacity_params"]
-    )
+    day = int(t)
+    testsAvailable = None
+    if calendar is not None and calendar.covers(day):
+        curDate = calendar.dates[day]
+        hasRealData = calendar.hasRealTestData[day]
+        realTestsByAge = calendar.realTestData[day]
+        if not hasRealData:
+            # (copied, the policies use up the available tests in place)
+            testsAvailable = {
+                testType: capacity[day].copy() for testType, capacity in calendar.testCapacity.items()
+            }
+    else:
+        curDate = pd.to_datetime(realStartDate, format="%Y-%m-%d") + pd.to_timedelta(
+            day, unit="D"
+        )
+        realData_closest = inpFunc_realData_testCapacity(
+            realTime=curDate, **kwargs["inpFunc_realData_testCapacity_params"]
+        )
+        hasRealData = realData_closest.name == curDate
+        realTestsByAge = realData_closest.to_numpy()
 
-    if realData_closest.name == curDate:  # We do have data, just fill it in
+    if hasRealData:  # We do have data, just fill it in
         testsAdministeredRate = np.zeros(stateTensor.shape + (len(testTypes),))
 
         # TODO - fix this very hacky solution accessing symptomatic ratio as a subfunc of the policy func
         noncovid_sympRatio = kwargs["policyFunc_params"]["basic_policyFunc_params"]["f_symptoms_nonCOVID"](curDate, **kwargs["policyFunc_params"]["basic_policyFunc_params"]["f_symptoms_nonCOVID_params"])
 
         noncovid_sympRatio = noncovid_sympRatio[1]  # Use hospitalised patient symptom ratio
-        symptomaticRatePerDiseaseState = np.array([noncovid_sympRatio] * stateTensor.shape[1])
-        symptomaticRatePerDiseaseState[3 : -(nR + 1)] = 1.0  # set the symptomatic ratio of symptomatic states to 1
-        symptomaticPeoplePerDiseaseStateInHospital = stateTensor[:, :-1, 2, 0] * np.expand_dims(symptomaticRatePerDiseaseState[:-1], axis=0)
+        symptomaticRatePerDiseaseState = np.repeat(
+            expand_scenarioAxes(noncovid_sympRatio, 1), stateTensor.shape[-3], axis=-1
+        )
+        symptomaticRatePerDiseaseState[..., 3 : -(nR + 1)] = 1.0  # set the symptomatic ratio of symptomatic states to 1
+        symptomaticPeoplePerDiseaseStateInHospital = stateTensor[..., :-1, 2, 0] * np.expand_dims(symptomaticRatePerDiseaseState[..., :-1], axis=-2)
 
-        testsAdministeredRate[:, :-1, 2, 0, testTypes.index("PCR")] += (
+        testsAdministeredRate[..., :-1, 2, 0, testTypes.index("PCR")] += (
             np.expand_dims(
-                realData_closest.to_numpy(), 1
+                realTestsByAge, 1
             )  # true number of tests on given day per age group
             * (
                 symptomaticPeoplePerDiseaseStateInHospital
@@ -1368,101 +1789,39 @@ def trFunc_testing(
             )
             # Calculate in what ratio we distribute the tests to people along disease states based on symptomatic (age is given in data!)
         ) / (
-            stateTensor[:, :-1, 2, 0] + 1e-10
+            stateTensor[..., :-1, 2, 0] + 1e-10
         )  # Divide by total people in each state to get testing rate
 
     else:  # we don't have data, follow our assumed availability and policy curves
 
+        if testsAvailable is None:
+            testsAvailable = trFunc_testCapacity(
+                realTime=curDate, **kwargs["trFunc_testCapacity_params"]
+            )
+        if batchShape:
+            # One capacity per scenario, such that the policy can distribute the tests in every scenario independently
+            testsAvailable = {
+                testType: np.broadcast_to(available, batchShape).astype(float)
+                for testType, available in testsAvailable.items()
+            }
+
         # policyFunc returns stateTensor x testTypes tensor of test administration rates
         testsAdministeredRate = policyFunc(
             stateTensor,
             realTime=curDate,
             testTypes=testTypes,
-            testsAvailable=trFunc_testCapacity(
-                realTime=curDate, **kwargs["trFunc_testCapacity_params"]
-            ),
+            testsAvailable=testsAvailable,
             **kwargs["policyFunc_params"],
         )
 
-    # Compute the transition ratio to tested states, given the administered tests
-
-    for testType in testTypes:
-        # Get the appropriate slices from testsAdmin. and testSpecs
-        curTestSpecs = testSpecifications[testSpecifications["Name"] == testType]
-
-        for curTS in range(nTest):
-            # Set output positive test state based on current test state
-            if curTS == int(curTestSpecs["OutputTestState"].values[0]):
-                # already positive for the given test
-                outTS_pos = curTS
-            elif curTS == 3:
-                # If already positive for both, stay positive
-                outTS_pos = 3
-            else:
-                # Transition 0->1, 0->2, 1->2, 1->3 or 2->3
-                outTS_pos = curTS + int(curTestSpecs["OutputTestState"].values[0])
-
-            # Where do we go after negative test based on where we are now?
-            if curTS == 0:
-                # Negatives stay negatives
-                outTS_neg = 0
-            elif curTS == 3:
-                # go to only virus or antibody positive from both positive
-                outTS_neg = 3 - int(curTestSpecs["OutputTestState"].values[0])
-            elif curTS == int(curTestSpecs["OutputTestState"].values[0]):
-                # go to 0 if tested for the one you're positive for
-                outTS_neg = 0
-            else:
-                # stay where you are if you test negative for the one you didnt have anyway
-                outTS_neg = curTS
-
-            # Get the transition rates based on current health states
-            for curHS in range(nHS):
-                # Add the true positives * (1-FNR)
-                if curHS in curTestSpecs["TruePosHealthState"].values[0]:
-                    trTensor_testTransitions[
-                        :, curHS, :, curTS, outTS_pos
-                    ] += testsAdministeredRate[
-                        :, curHS, :, curTS, testTypes.index(testType)
-                    ] * (
-                        1
-                        - curTestSpecs[curTestSpecs["InputHealthState"] == curHS][
-                            "FalseNegativeRate"
-                        ].values[0]
-                    )
-
-                else:
-                    # Add the false positives * FPR
-                    trTensor_testTransitions[:, curHS, :, curTS, outTS_pos] += (
-                        testsAdministeredRate[
-                            :, curHS, :, curTS, testTypes.index(testType)
-                        ]
-                        * curTestSpecs[curTestSpecs["InputHealthState"] == curHS][
-                            "FalsePositiveRate"
-                        ].values[0]
-                    )
-
-                # Add the false negatives (FNR)
-                if curHS in curTestSpecs["TruePosHealthState"].values[0]:
-                    trTensor_testTransitions[:, curHS, :, curTS, outTS_neg] += (
-                        testsAdministeredRate[
-                            :, curHS, :, curTS, testTypes.index(testType)
-                        ]
-                        * curTestSpecs[curTestSpecs["InputHealthState"] == curHS][
-                            "FalseNegativeRate"
-                        ].values[0]
-                    )
-
-                else:
-                    # Add the true negatives * (1-FNR)
-                    trTensor_testTransitions[:, curHS, :, curTS, outTS_neg] += (
-                        testsAdministeredRate[
-                            :, curHS, :, curTS, testTypes.index(testType)
-                        ]
-                        * curTestSpecs[curTestSpecs["InputHealthState"] == curHS][
-                            "FalsePositiveRate"
-                        ].values[0]
-                    )
+    # Compute the transition ratio to tested states, given the administered tests:
+    # sum over test types of administered rate x probability of each outcome test state
+    trTensor_testTransitions = np.einsum(
+        "...ijklt,...tjlm->...ijklm",
+        testsAdministeredRate,
+        compiledTestSpecifications["testTransitionProbs"],
+        optimize=True,
+    )
 
     return trTensor_testTransitions  # , testsAdministeredRate
 
@@ -1475,19 +1834,13 @@ def trFunc_testing(
 # positive are home isolated along with families for
 # nDaysInIsolation days. Symptomatic people have a chance of being immediately hospitalised instead of sent into home isolation
 def trFunc_quarantine_caseIsolation(
-    trTensor_complete,
     t,
     trTensor_testing,  # This is used to establish who gets tests and how many of those end up positive.
-    nDaysInHomeIsolation=nDaysInHomeIsolation,
+    nDaysInHomeIsolation=None,  # Filled in by CoexistModel from the user inputs
     timeToIsolation=0.5,  # (days) time from testing positive to actually getting isolated
     # On average this many people get hospitalised (compared to home isolation), but modulated by age (TODO: values > 1? clip for now..)
-    symptomHospitalisedRate_ageAdjusted=np.clip(
-        adjustRatesByAge_KeepAverageRate(
-            0.3, ageRelativeAdjustment=relativeAdmissionRisk_given_COVID_by_age
-        ),
-        0.0,
-        1.0,
-    ),
+    # Filled in by CoexistModel as np.clip(adjustRatesByAge_KeepAverageRate(0.3, relativeAdmissionRisk_given_COVID_by_age), 0., 1.)
+    symptomHospitalisedRate_ageAdjusted=None,
     symptomaticHealthStates=[
         3,
         4,
@@ -1495,57 +1848,56 @@ def trFunc_quarantine_caseIsolation(
     **kwargs,
 ):
     """
-    This function redistributes testing rates, so they dont only create a testing state update, but also an isolation state update
+    This function redistributes testing rates, so they dont only create a testing state update, but also an isolation state update.
+    Returns the nAge x nHS x nIso x nTest x nIso tensor of isolation state transition rates
+    (with the leading scenario axis of trTensor_testing, if any).
     """
-    trTensor_quarantineRate = np.zeros(stateTensor.shape + (nIso,))
+    trTensor_quarantineRate = np.zeros(trTensor_testing.shape[:-1] + (nIso,))
 
-    trTensor_freshlyVirusPositiveRate_inIso0 = copy.deepcopy(
-        trTensor_testing[:, :, 0, :2, 1]
-    )
-    trTensor_freshlyBothPositiveRate_inIso0 = copy.deepcopy(
-        trTensor_testing[:, :, 0, 2:, 3]
-    )
+    # (only read, views are enough)
+    trTensor_freshlyVirusPositiveRate_inIso0 = trTensor_testing[..., :, 0, :2, 1]
+    trTensor_freshlyBothPositiveRate_inIso0 = trTensor_testing[..., :, 0, 2:, 3]
 
-    for curHS in range(stateTensor.shape[1] - 1):  # ignore dead
+    for curHS in range(trTensor_testing.shape[-4] - 1):  # ignore dead
         if curHS in symptomaticHealthStates:
             # Send a fraction of people (normal) who are symptomatic and tested positive to hospital, based on their age
-            trTensor_quarantineRate[:, curHS, 0, :2, 2] += (
-                (1.0 / timeToIsolation)
-                * symptomHospitalisedRate_ageAdjusted[:, np.newaxis]
-                * trTensor_freshlyVirusPositiveRate_inIso0[:, curHS]
+            trTensor_quarantineRate[..., curHS, 0, :2, 2] += (
+                (1.0 / expand_scenarioAxes(timeToIsolation, 2))
+                * symptomHospitalisedRate_ageAdjusted[..., np.newaxis]
+                * trTensor_freshlyVirusPositiveRate_inIso0[..., curHS, :]
             )
-            trTensor_quarantineRate[:, curHS, 0, 2:, 2] += (
-                (1.0 / timeToIsolation)
-                * symptomHospitalisedRate_ageAdjusted[:, np.newaxis]
-                * trTensor_freshlyBothPositiveRate_inIso0[:, curHS]
+            trTensor_quarantineRate[..., curHS, 0, 2:, 2] += (
+                (1.0 / expand_scenarioAxes(timeToIsolation, 2))
+                * symptomHospitalisedRate_ageAdjusted[..., np.newaxis]
+                * trTensor_freshlyBothPositiveRate_inIso0[..., curHS, :]
             )
             # The rest to home isolation
-            trTensor_quarantineRate[:, curHS, 0, :2, 1] += (
-                (1.0 / timeToIsolation)
-                * (1.0 - symptomHospitalisedRate_ageAdjusted[:, np.newaxis])
-                * trTensor_freshlyVirusPositiveRate_inIso0[:, curHS]
+            trTensor_quarantineRate[..., curHS, 0, :2, 1] += (
+                (1.0 / expand_scenarioAxes(timeToIsolation, 2))
+                * (1.0 - symptomHospitalisedRate_ageAdjusted[..., np.newaxis])
+                * trTensor_freshlyVirusPositiveRate_inIso0[..., curHS, :]
             )
-            trTensor_quarantineRate[:, curHS, 0, 2:, 1] += (
-                (1.0 / timeToIsolation)
-                * (1.0 - symptomHospitalisedRate_ageAdjusted[:, np.newaxis])
-                * trTensor_freshlyBothPositiveRate_inIso0[:, curHS]
+            trTensor_quarantineRate[..., curHS, 0, 2:, 1] += (
+                (1.0 / expand_scenarioAxes(timeToIsolation, 2))
+                * (1.0 - symptomHospitalisedRate_ageAdjusted[..., np.newaxis])
+                * trTensor_freshlyBothPositiveRate_inIso0[..., curHS, :]
             )
 
         else:
             # Send all non-symptomatic (normal) who tested freshly positive to home isolation
-            trTensor_quarantineRate[:, curHS, 0, :2, 1] += (
+            trTensor_quarantineRate[..., curHS, 0, :2, 1] += (
                 1.0
-                / timeToIsolation
-                * trTensor_freshlyVirusPositiveRate_inIso0[:, curHS]
+                / expand_scenarioAxes(timeToIsolation, 2)
+                * trTensor_freshlyVirusPositiveRate_inIso0[..., curHS, :]
             )
-            trTensor_quarantineRate[:, curHS, 0, 2:, 1] += (
+            trTensor_quarantineRate[..., curHS, 0, 2:, 1] += (
                 1.0
-                / timeToIsolation
-                * trTensor_freshlyBothPositiveRate_inIso0[:, curHS]
+                / expand_scenarioAxes(timeToIsolation, 2)
+                * trTensor_freshlyBothPositiveRate_inIso0[..., curHS, :]
             )
 
     # Release people from home isolation after isolation period
-    trTensor_quarantineRate[:, :, 1, :, 0] = 1.0 / nDaysInHomeIsolation
+    trTensor_quarantineRate[..., :, 1, :, 0] = 1.0 / expand_scenarioAxes(nDaysInHomeIsolation, 3)
 
     # Hospitalised people are assumed to be released after recovery, with normal rates (TODO: think if this is correct)
 
@@ -1555,62 +1907,578 @@ def trFunc_quarantine_caseIsolation(
     # A simple (slightly incorrect) solution would be to just implement a non-specific "pull" from isoState=0 people to hospital workers to fill up the missing people?
     # But the rate of this pull would be impossible to compute and would still be incorrect. Gotta think more on this.
 
-    # Update the whole tensor accordingly
-    # Make a copy for safety:
-    out_trTensor_complete = copy.deepcopy(trTensor_complete)
-
-    # First remove all the iso 0->0, test 0,1->1, 2,3->3 transitions (as they're all either hospitalised or sent to home isolation)
-    out_trTensor_complete[:, :, 0, :2, :, 0, 1] = 0.0
-    out_trTensor_complete[:, :, 0, 2:, :, 0, 3] = 0.0
-
-    # Newly virus positive, newly home-isolated, diagonal in disease state transition
-    np.einsum("ijkj->ijk", out_trTensor_complete[:, :, 0, :2, :, 1, 1])[
-        :
-    ] = trTensor_quarantineRate[:, :, 0, :2, 1]
-    np.einsum("ijkj->ijk", out_trTensor_complete[:, :, 0, 2:, :, 1, 3])[
-        :
-    ] = trTensor_quarantineRate[:, :, 0, 2:, 1]
-
-    # Newly virus positive, newly hospitalised, diagonal in disease state transition
-    np.einsum("ijkj->ijk", out_trTensor_complete[:, :, 0, :2, :, 2, 1])[
-        :
-    ] = trTensor_quarantineRate[:, :, 0, :2, 2]
-    np.einsum("ijkj->ijk", out_trTensor_complete[:, :, 0, 2:, :, 2, 3])[
-        :
-    ] = trTensor_quarantineRate[:, :, 0, 2:, 2]
-
+    # The full transition tensor is updated accordingly by TransitionOperator.apply_quarantine:
+    # all the iso 0->0, test 0,1->1, 2,3->3 transitions are removed (as they're all either hospitalised or sent to home isolation),
+    # and the rates above are written as transitions that are diagonal in disease state.
     # Home isolated people are "let go" after nDaysInHomeIsolation, without changing disease or testing state
     # (TODO: represent multiple testing / needing negative tests to let go, etc - hard problem!)
     # (UPDATE: multiple testing have now been represented, but for now we'll still let go people based on fixed time rather than negative test, to save tests!)
-    np.einsum("ijkjk->ijk", out_trTensor_complete[:, :, 1, :, :, 0, :])[
-        :
-    ] = trTensor_quarantineRate[:, :, 1, :, 0]
+    return trTensor_quarantineRate
 
-    # Return the full updated tensor (so NOT += outside, but actually =)
-    return out_trTensor_complete
 
+# ## Sparse transition operator
+#
+# The full transition tensor (nAge x nHS x nIso x nTest x nHS x nIso x nTest) is almost entirely structural zeros:
+# people never change age, and every building block below only moves people along one or two axes.
+# We enumerate once which (from-state, to-state) pairs each block can ever fill,
+# store their union as a fixed CSR pattern over the flattened state tensor,
+# and at every evaluation only refill the rates before doing a single sparse mat-vec.
+class TransitionOperator:
+    """
+    Fixed sparsity pattern of the complete transition tensor for the given state dimensions.
+
+    Rates live in a flat "data" vector aligned with the CSR pattern (rows: to-state, columns: from-state).
+    Every block (disease progression, new infections, testing, ...) knows which positions of that vector it fills,
+    in the C-order of the tensor that the corresponding trFunc returns.
+    Transitions from a state to itself are never stored, the diagonal is always derived from the outgoing rates.
+    In batched runs the rate vector has a leading scenario axis (nScenarios x nnz), and the scenarios
+    are advanced together by a single block diagonal mat-vec.
+    """
 
-# ## Full simulation function
-# Function that computes the right side of the non-lin model ODE
-def dydt_Complete(
-    t,
-    stateTensor_flattened,  # Might be double the normal size (as first dimension) _withNewOnlyCopy, if debugReturnNewPerDay
-    realStartDate = testingStartDate,
-    #realStartDate=pd.to_datetime("2020-02-20", format="%Y-%m-%d"),
-    # debug
-    debugTransition=False,
-    debugTimestep=False,
-    debugReturnNewPerDay=True,  # Now implemented by default into state iteration
-    # Dimensions
-    nAge=nAge,
-    nHS=nHS,
-    nI=nI,
-    nR=nR,
-    nIso=nIso,
-    nTest=nTest,
-    # Input functions and tensors
-    # ----------------------------
-    
+    def __init__(self, nAge, nHS, nIso, nTest):
+        self.stateShape = (nAge, nHS, nIso, nTest)
+        self.nStates = nAge * nHS * nIso * nTest
+        idx = np.arange(self.nStates).reshape(self.stateShape)
+
+        # Positive test state after being quarantined (keep antibody positivity): 0,1 -> 1 and 2,3 -> 3
+        quarantineTestState = np.where(np.arange(nTest) < 2, 1, 3)
+
+        # (from, to) flat state indices of every block, broadcast to the shape of the block's rate tensor
+        blockSlots = OrderedDict()
+        # Disease progression, diagonal in isolation and testing state: (i,j,k,l) -> (i,m,k,l)
+        blockSlots["diseaseProgression"] = (
+            idx[:, :, :, :, np.newaxis],
+            np.moveaxis(idx, 1, -1)[:, np.newaxis],
+        )
+        # New infections (S -> E), diagonal in isolation and testing state
+        blockSlots["newInfections"] = (idx[:, 0], idx[:, 1])
+        # Travel infections only affect untested, non-isolated susceptibles
+        blockSlots["travel"] = (idx[:, 0, 0, 0], idx[:, 1, 0, 0])
+        # Hospital admission from non-isolated and home-isolated people
+        blockSlots["hospitalAdmission"] = (idx[:, :, :2, :], idx[:, :, np.newaxis, 2, :])
+        # Hospital discharge, back to non-isolated state
+        blockSlots["hospitalDischarge"] = (idx[:, :, 2, :], idx[:, :, 0, :])
+        # Testing, diagonal in age, health and isolation state: (i,j,k,l) -> (i,j,k,m)
+        blockSlots["testing"] = (idx[..., np.newaxis], idx[:, :, :, np.newaxis, :])
+        # Quarantine policy: freshly positive people to home isolation and hospital, and release from home isolation
+        blockSlots["quarantineIsolation"] = (idx[:, :, 0, :], idx[:, :, 1, quarantineTestState])
+        blockSlots["quarantineHospitalisation"] = (idx[:, :, 0, :], idx[:, :, 2, quarantineTestState])
+        blockSlots["quarantineRelease"] = (idx[:, :, 1, :], idx[:, :, 0, :])
+
+        # Build the union of all off-diagonal slots plus the diagonal, sorted by (to, from)
+        allFrom, allTo, blockSizes = [], [], []
+        self.blockShapes = OrderedDict()
+        self.blockKeep = OrderedDict()
+        for name, (fromIdx, toIdx) in blockSlots.items():
+            fromIdx, toIdx = np.broadcast_arrays(fromIdx, toIdx)
+            keep = (fromIdx != toIdx).reshape(-1)
+            self.blockShapes[name] = fromIdx.shape
+            self.blockKeep[name] = keep
+            allFrom.append(fromIdx.reshape(-1)[keep])
+            allTo.append(toIdx.reshape(-1)[keep])
+            blockSizes.append(int(np.sum(keep)))
+        allFrom.append(np.arange(self.nStates))
+        allTo.append(np.arange(self.nStates))
+        blockSizes.append(self.nStates)
+
+        uniqueKeys, inverse = np.unique(
+            np.concatenate(allTo) * self.nStates + np.concatenate(allFrom),
+            return_inverse=True,
+        )
+        self.rows = uniqueKeys // self.nStates
+        self.indices = uniqueKeys % self.nStates
+        self.indptr = np.concatenate(
+            [[0], np.cumsum(np.bincount(self.rows, minlength=self.nStates))]
+        )
+        self.nnz = len(uniqueKeys)
+
+        blockPositions = np.split(inverse.reshape(-1), np.cumsum(blockSizes)[:-1])
+        self.blockPositions = OrderedDict(zip(blockSlots.keys(), blockPositions[:-1]))
+        self.diagonal = blockPositions[-1]
+
+        # Entries removed while the quarantine policy is on: everyone who would stay in isolation state 0
+        # while becoming (or staying) virus positive is either hospitalised or sent to home isolation instead,
+        # and the quarantine transitions overwrite anything else in their slots
+        fromIso = (self.indices // nTest) % nIso
+        toIso = (self.rows // nTest) % nIso
+        fromTest = self.indices % nTest
+        toTest = self.rows % nTest
+        quarantineRemoved = (
+            (fromIso == 0) & (toIso == 0) & (toTest == quarantineTestState[fromTest])
+        )
+        for name in ["quarantineIsolation", "quarantineHospitalisation", "quarantineRelease"]:
+            quarantineRemoved[self.blockPositions[name]] = True
+        quarantineRemoved[self.diagonal] = False
+        self.quarantineKeep = (~quarantineRemoved).astype(float)
+
+        # Order of the entries by from-state (column), and where each column starts in that order,
+        # to sum the outgoing rates of every from-state with a single reduceat (every column has its diagonal entry)
+        self.byFromState = np.argsort(self.indices, kind="stable")
+        self.fromStateStarts = np.searchsorted(self.indices[self.byFromState], np.arange(self.nStates))
+        self.batchPatterns = {}
+        self.flowMatrices = {}
+
+    def new_rates(self, batchShape=()):
+        """Empty rate vector aligned with the sparsity pattern"""
+        return np.zeros(tuple(batchShape) + (self.nnz,))
+
+    def scatter(self, trRates, block, rates):
+        """Add the rates of a block (any tensor broadcastable to the block's shape) to the rate vector, in place"""
+        batchShape = trRates.shape[:-1]
+        trRates[..., self.blockPositions[block]] += np.broadcast_to(
+            rates, batchShape + self.blockShapes[block]
+        ).reshape(batchShape + (-1,))[..., self.blockKeep[block]]
+        return trRates
+
+    def gather(self, trRates, block):
+        """The entries of a (single) rate vector at the slots of a block, in the shape of the block (0 for its self-transitions)"""
+        out = np.zeros(self.blockShapes[block])
+        out.reshape(-1)[self.blockKeep[block]] = trRates[self.blockPositions[block]]
+        return out
+
+    def apply_quarantine(self, trRates, trTensor_quarantineRate, active=True):
+        """
+        Redirect freshly positive tested people to home isolation / hospital, in place
+        (only in the scenarios where active is True, if it is given per scenario)
+        """
+        if np.all(active):
+            quarantinedRates = trRates
+        else:
+            quarantinedRates = trRates.copy()
+        quarantinedRates *= self.quarantineKeep
+        self.scatter(quarantinedRates, "quarantineIsolation", trTensor_quarantineRate[..., 0, :, 1])
+        self.scatter(quarantinedRates, "quarantineHospitalisation", trTensor_quarantineRate[..., 0, :, 2])
+        self.scatter(quarantinedRates, "quarantineRelease", trTensor_quarantineRate[..., 1, :, 0])
+        if quarantinedRates is not trRates:
+            trRates[...] = np.where(
+                expand_scenarioAxes(active, 1), quarantinedRates, trRates
+            )
+        return trRates
+
+    def finalise(self, trRates, out=None, scratch=None):
+        """
+        Ensure that every "row" of the transition tensor sums to 0 by setting the diagonal
+        (doesn't create new people out of nowhere). Returns the total outgoing rate of every state
+        (written to out, using scratch, an array shaped like trRates, if given).
+        """
+        trRates[..., self.diagonal] = 0.0
+        outgoingRates = np.add.reduceat(
+            np.take(trRates, self.byFromState, axis=-1, out=scratch),
+            self.fromStateStarts,
+            axis=-1,
+            out=out,
+        )
+        trRates[..., self.diagonal] = -outgoingRates
+        return outgoingRates
+
+    def matrix(self, trRates):
+        """CSR matrix M, such that dydt = M @ stateTensor_flattened"""
+        return sparse.csr_matrix(
+            (trRates, self.indices, self.indptr), shape=(self.nStates, self.nStates)
+        )
+
+    def batch_matrix(self, trRates):
+        """CSR matrix of a batch of rate vectors (... x nnz): block diagonal, scenario b maps states [b*nStates, (b+1)*nStates) onto themselves"""
+        if trRates.ndim == 1:
+            return self.matrix(trRates)
+        nBatch = int(np.prod(trRates.shape[:-1]))
+        if nBatch not in self.batchPatterns:
+            offsets = np.arange(nBatch)[:, np.newaxis]
+            self.batchPatterns[nBatch] = (
+                (self.indices + offsets * self.nStates).reshape(-1),
+                np.concatenate(
+                    [[0], (self.indptr[1:] + offsets * self.nnz).reshape(-1)]
+                ),
+            )
+        indices, indptr = self.batchPatterns[nBatch]
+        return sparse.csr_matrix(
+            (trRates.reshape(-1), indices, indptr),
+            shape=(nBatch * self.nStates, nBatch * self.nStates),
+        )
+
+    def matvec(self, trRates, stateTensor_flat):
+        """dydt of every scenario, given their rate vectors (... x nnz) and flattened states (... x nStates)"""
+        return (self.batch_matrix(trRates) @ stateTensor_flat.reshape(-1)).reshape(
+            trRates.shape[:-1] + (self.nStates,)
+        )
+
+    def flow_matrix(self, flowNames):
+        """
+        Sparse (len(flowNames) * nAge) x nnz matrix summing the entries of each flow (see flowDefinitions) per age group,
+        such that the flows are flow_matrix @ (trRates * stateTensor_flat[indices])
+        """
+        flowNames = tuple(flowNames)
+        if flowNames not in self.flowMatrices:
+            fromState = np.unravel_index(self.indices, self.stateShape)
+            toState = np.unravel_index(self.rows, self.stateShape)
+            flowRows, entries = [], []
+            for flow, flowName in enumerate(flowNames):
+                if flowName not in flowDefinitions:
+                    raise ValueError(f"TransitionOperator: unknown flow {flowName}, expected one of {list(flowDefinitions)}")
+                inFlow = flowDefinitions[flowName](fromState, toState, self.stateShape)
+                inFlow[self.diagonal] = False
+                cur_entries = np.flatnonzero(inFlow)
+                flowRows.append(flow * self.stateShape[0] + fromState[0][cur_entries])
+                entries.append(cur_entries)
+            self.flowMatrices[flowNames] = sparse.csr_matrix(
+                (np.ones(sum(map(len, entries))), (np.concatenate(flowRows), np.concatenate(entries))),
+                shape=(len(flowNames) * self.stateShape[0], self.nnz),
+            )
+        return self.flowMatrices[flowNames]
+
+    def flows(self, trRates, stateTensor_flat, flowNames):
+        """Rates of change of the tracked flows (... x len(flowNames) * nAge), given the finalised rates and the flattened states"""
+        batchShape = trRates.shape[:-1]
+        fluxes = (trRates * stateTensor_flat[..., self.indices]).reshape(-1, self.nnz)
+        return (self.flow_matrix(flowNames) @ fluxes.T).T.reshape(batchShape + (-1,))
+
+    def flow_jacobian(self, trRates, flowNames, newInfectionsDerivative):
+        """
+        Jacobian of the (single scenario) flows with respect to the flattened state: the rates times the from-states,
+        plus for newInfections the state dependence of the infection rates (newInfectionsDerivative, rows are the E states)
+        """
+        flowMatrix = self.flow_matrix(flowNames)
+        jacobian = flowMatrix @ sparse.csr_matrix(
+            (trRates, (np.arange(self.nnz), self.indices)), shape=(self.nnz, self.nStates)
+        )
+        if "newInfections" in flowNames:
+            flow = list(flowNames).index("newInfections")
+            exposedStates = np.flatnonzero(np.unravel_index(np.arange(self.nStates), self.stateShape)[1] == 1)
+            toFlow = sparse.csr_matrix(
+                (
+                    np.ones(len(exposedStates)),
+                    (flow * self.stateShape[0] + exposedStates // (self.nStates // self.stateShape[0]), exposedStates),
+                ),
+                shape=(flowMatrix.shape[0], self.nStates),
+            )
+            jacobian = jacobian + toFlow @ newInfectionsDerivative
+        return jacobian
+
+    def to_dense(self, trRates):
+        """The equivalent dense nAge x nHS x nIso x nTest x nHS x nIso x nTest transition tensor (per scenario)"""
+        if trRates.ndim > 1:
+            return np.stack(
+                [self.to_dense(rates) for rates in trRates.reshape(-1, self.nnz)]
+            ).reshape(trRates.shape[:-1] + self.stateShape + self.stateShape[1:])
+        nAge = self.stateShape[0]
+        nPerAge = self.nStates // nAge
+        trTensor_complete = np.zeros((self.nStates, nPerAge))
+        np.add.at(trTensor_complete, (self.indices, self.rows % nPerAge), trRates)
+        return trTensor_complete.reshape(self.stateShape + self.stateShape[1:])
+
+
+@functools.lru_cache(maxsize=None)
+def build_transitionOperator(nAge, nHS, nIso, nTest):
+    """The sparsity pattern only depends on the state dimensions, so it is built once per shape"""
+    return TransitionOperator(nAge, nHS, nIso, nTest)
+
+
+# ## Tracked flows
+#
+# Flows (cumulative numbers of people, per age group) that can be tracked instead of the doubled newOnly state (see trackFlows).
+# Each is a mask over the (from-state, to-state) pairs of the transition operator, given as (age, hs, iso, test) index arrays
+flowDefinitions = OrderedDict([
+    # S -> E, within the population and from travel
+    ("newInfections", lambda fromState, toState, stateShape: (fromState[1] == 0) & (toState[1] == 1)),
+    # Into hospital (isolation state 2), by the hospitalisation rates or the quarantine policy
+    ("hospitalAdmissions", lambda fromState, toState, stateShape: (fromState[2] != 2) & (toState[2] == 2)),
+    # Into the deceased (last) health state
+    ("deaths", lambda fromState, toState, stateShape: (fromState[1] != stateShape[1] - 1) & (toState[1] == stateShape[1] - 1)),
+    # Positive virus tests: 0 -> 1 (neg_noTest -> pos_test) and 2 -> 3 (pos_antibody -> pos_both)
+    ("positiveTests", lambda fromState, toState, stateShape: (fromState[3] % 2 == 0) & (toState[3] == fromState[3] + 1)),
+])
+
+
+class RHSWorkspace:
+    """
+    Buffers of dydt_Complete for one transition operator and batch shape, allocated once and refilled in place
+    by every evaluation (solveSystem sets one up per run): the rate vector, the outgoing rates, and the
+    (block diagonal, if batched) CSR matrix, whose data is the rate vector itself.
+    Values read from the workspace are only valid until the next evaluation.
+    staticRates are the time-invariant rates of the run (see rhs_workspace), looked up by every evaluation if None.
+    """
+
+    def __init__(self, trOperator, batchShape=(), staticRates=None):
+        self.trOperator = trOperator
+        self.batchShape = tuple(batchShape)
+        self.staticRates = staticRates
+        self.rates = trOperator.new_rates(self.batchShape)
+        self.sortedRates = np.empty_like(self.rates)
+        self.outgoingRates = np.zeros(self.batchShape + (trOperator.nStates,))
+        self.matrix = trOperator.batch_matrix(self.rates)
+        self.matrix.data = self.rates.reshape(-1)  # (shared, never copied)
+
+    def matches(self, trOperator, batchShape):
+        return self.trOperator is trOperator and self.batchShape == tuple(batchShape)
+
+
+class RunProfile:
+    """
+    Opt-in instrumentation of a run (solveSystem(..., profile=RunProfile())): the statistics of every integrated segment,
+    and, if timeStages, the cumulative time and number of calls of each stage of dydt_Complete.
+    """
+
+    def __init__(self, timeStages=True):
+        self.timeStages = timeStages
+        self.stageTimes = OrderedDict()
+        self.stageCalls = OrderedDict()
+        self.rhsCalls = 0
+        self.segments = []
+        self._last = None
+
+    def start(self):
+        """Start timing a right hand side evaluation"""
+        self.rhsCalls += 1
+        self._last = time.perf_counter()
+
+    def lap(self, stage):
+        """Attribute the time since the previous lap (or start) to stage"""
+        now = time.perf_counter()
+        self.stageTimes[stage] = self.stageTimes.get(stage, 0.0) + (now - self._last)
+        self.stageCalls[stage] = self.stageCalls.get(stage, 0) + 1
+        self._last = now
+
+    def solver(self, method):
+        """The scipy solver class of method, counting its accepted steps (passed to solve_ivp instead of the name)"""
+        profile = self
+        baseSolver = getattr(integrate, method) if isinstance(method, str) else method
+
+        class CountingSolver(baseSolver):
+            def step(self):
+                message = super().step()
+                if self.status != "failed":
+                    profile._steps += 1
+                return message
+
+        self._steps = 0
+        return CountingSolver
+
+    def add_segment(self, t_start, t_end, method, solution):
+        """Record the statistics of a solve_ivp solution over [t_start, t_end]"""
+        segment = OrderedDict([
+            ("t_start", float(t_start)),
+            ("t_end", float(t_end)),
+            ("method", method if isinstance(method, str) else method.__name__),
+            ("status", int(solution.status)),
+            ("message", solution.message),
+            ("nfev", int(solution.nfev)),
+            ("njev", int(solution.njev)),
+            ("nlu", int(solution.nlu)),
+            ("steps", self._steps),
+            ("rejectedSteps", None),
+        ])
+        solverClass = getattr(integrate, method, None) if isinstance(method, str) else method
+        nStages = getattr(solverClass, "n_stages", None)
+        if nStages is not None:
+            # Explicit Runge-Kutta: 2 evaluations to start (f(t_start) and the initial step size), then n_stages per attempted step
+            segment["rejectedSteps"] = max(0, (segment["nfev"] - 2) // nStages - self._steps)
+        self.segments.append(segment)
+
+    def add_euler(self, t_start, t_end, samplesPerDay):
+        """Record the fixed step Euler integration of solveSystem (one evaluation per step, none rejected)"""
+        nSteps = (t_end - t_start) * samplesPerDay
+        self.segments.append(OrderedDict([
+            ("t_start", float(t_start)),
+            ("t_end", float(t_end)),
+            ("method", "Euler"),
+            ("status", 0),
+            ("message", f"Fixed step 1/{samplesPerDay}"),
+            ("nfev", nSteps),
+            ("njev", 0),
+            ("nlu", 0),
+            ("steps", nSteps),
+            ("rejectedSteps", 0),
+        ]))
+
+    def report(self):
+        """Summary of the run, as a json serialisable dictionary"""
+        totals = OrderedDict(
+            (key, sum(segment[key] for segment in self.segments))
+            for key in ["nfev", "njev", "nlu", "steps"]
+        )
+        rejected = [segment["rejectedSteps"] for segment in self.segments]
+        totals["rejectedSteps"] = None if None in rejected else sum(rejected)
+        totals["status"] = max([segment["status"] for segment in self.segments], default=0, key=abs)
+        rhsTime = sum(self.stageTimes.values())
+        return OrderedDict([
+            ("solver", totals),
+            ("segments", self.segments),
+            ("rhsCalls", self.rhsCalls),
+            ("rhsTime", rhsTime),
+            ("stages", OrderedDict(
+                (stage, OrderedDict([
+                    ("calls", self.stageCalls[stage]),
+                    ("time", stageTime),
+                    ("fraction", stageTime / rhsTime if rhsTime > 0 else 0.0),
+                ]))
+                for stage, stageTime in self.stageTimes.items()
+            )),
+        ])
+
+    def write(self, path, **extra):
+        """Write the report (and any extra entries, e.g. the run settings) to a json file"""
+        report = OrderedDict(extra)
+        report.update(self.report())
+        with open(path, "w") as jf:
+            json.dump(report, jf, indent=2, default=str)
+
+
+def progress_solver(method, report):
+    """The scipy solver class of method, calling report(t) after every accepted step (passed to solve_ivp instead of the name)"""
+    baseSolver = getattr(integrate, method) if isinstance(method, str) else method
+
+    class ProgressSolver(baseSolver):
+        def step(self):
+            message = super().step()
+            if self.status != "failed":
+                report(self.t)
+            return message
+
+    return ProgressSolver
+
+
+def print_progress(event):
+    """Progress callback of solveSystem printing the simulated day (as the command line run does)"""
+    print(f" Sim Day: {event['day']}", end="\r", flush=True)
+
+
+def _noLap(stage):
+    """Stand-in for RunProfile.lap when the stages are not timed"""
+
+
+# Disease progression, hospital admission and discharge do not depend on time or the current state,
+# so they are computed (and scattered into the transition operator) once per parameter set,
+# and shared by every run in the same process with identical parameters
+staticTransitionCache = LRUCache(maxsize=64)
+
+
+def cached_staticTransitions(
+    trOperator,
+    trFunc_diseaseProgression,
+    trFunc_HospitalAdmission,
+    trFunc_HospitalDischarge,
+    trFunc_diseaseProgression_params,
+    trFunc_HospitalAdmission_params,
+    trFunc_HospitalDischarge_params,
+):
+    """
+    Returns a dictionary of the (read-only) time-invariant transition blocks,
+    and their summed contribution to the rate vector of trOperator.
+    If any of the parameter dictionaries are stacked (see stack_paramDicts), the blocks and rates have a leading scenario axis.
+    """
+    key = paramHash(
+        trOperator.stateShape,
+        trFunc_diseaseProgression,
+        trFunc_HospitalAdmission,
+        trFunc_HospitalDischarge,
+        trFunc_diseaseProgression_params,
+        trFunc_HospitalAdmission_params,
+        trFunc_HospitalDischarge_params,
+    )
+
+    cached = staticTransitionCache.get(key)
+    if cached is not None:
+        return cached
+
+    nScenarios = stackedScenarios(
+        trFunc_diseaseProgression_params,
+        trFunc_HospitalAdmission_params,
+        trFunc_HospitalDischarge_params,
+    )
+    if nScenarios is not None:
+        cached = stackScenarioResults(
+            [
+                cached_staticTransitions(
+                    trOperator,
+                    trFunc_diseaseProgression,
+                    trFunc_HospitalAdmission,
+                    trFunc_HospitalDischarge,
+                    select_scenario(trFunc_diseaseProgression_params, scenario),
+                    select_scenario(trFunc_HospitalAdmission_params, scenario),
+                    select_scenario(trFunc_HospitalDischarge_params, scenario),
+                )
+                for scenario in range(nScenarios)
+            ]
+        )
+        staticTransitionCache.put(key, cached)
+    else:
+        staticBlocks = {
+            "diseaseProgression": trFunc_diseaseProgression(
+                **trFunc_diseaseProgression_params
+            ),
+            "hospitalAdmission": trFunc_HospitalAdmission(
+                **trFunc_HospitalAdmission_params
+            ),
+            "hospitalDischarge": trFunc_HospitalDischarge(
+                **trFunc_HospitalDischarge_params
+            ),
+        }
+
+        staticRates = trOperator.new_rates()
+        # all non-hospitalised disease progression is same, no isolation or test transition ("diagonal along those")
+        trOperator.scatter(
+            staticRates,
+            "diseaseProgression",
+            np.expand_dims(staticBlocks["diseaseProgression"], 3),
+        )
+        trOperator.scatter(
+            staticRates,
+            "hospitalAdmission",
+            np.expand_dims(staticBlocks["hospitalAdmission"], [2, 3]),
+        )
+        trOperator.scatter(
+            staticRates,
+            "hospitalDischarge",
+            np.expand_dims(staticBlocks["hospitalDischarge"], 2),
+        )
+
+        for arr in list(staticBlocks.values()) + [staticRates]:
+            arr.setflags(write=False)
+        cached = (staticBlocks, staticRates)
+        staticTransitionCache.put(key, cached)
+
+    return cached
+
+
+def rhs_workspace(stateShape, **kwargs):
+    """
+    The RHSWorkspace of a run of dydt_Complete with the parameters kwargs, on states of stateShape (with any leading
+    scenario axis), with the time-invariant rates of the parameters looked up once for the whole run
+    """
+    trOperator = build_transitionOperator(*stateShape[-4:])
+    _, staticRates = cached_staticTransitions(
+        trOperator,
+        kwargs.get("trFunc_diseaseProgression", trFunc_diseaseProgression),
+        kwargs.get("trFunc_HospitalAdmission", trFunc_HospitalAdmission),
+        kwargs.get("trFunc_HospitalDischarge", trFunc_HospitalDischarge),
+        kwargs["trFunc_diseaseProgression_params"],
+        kwargs["trFunc_HospitalAdmission_params"],
+        kwargs["trFunc_HospitalDischarge_params"],
+    )
+    return RHSWorkspace(trOperator, stateShape[:-4], staticRates=staticRates)
+
+
+# ## Full simulation function
+# Function that computes the right side of the non-lin model ODE
+def dydt_Complete(
+    t,
+    stateTensor_flattened,  # Might be double the normal size (as first dimension) _withNewOnlyCopy, if debugReturnNewPerDay
+    realStartDate=None,  # Filled in by CoexistModel as the testingStartDate of the user inputs
+    #realStartDate=pd.to_datetime("2020-02-20", format="%Y-%m-%d"),
+    # debug
+    debugTransition=False,
+    debugTimestep=False,
+    debugReturnNewPerDay=True,  # Now implemented by default into state iteration
+    # Dimensions
+    nAge=nAge,
+    nHS=nHS,
+    nI=nI,
+    nR=nR,
+    nIso=nIso,
+    nTest=nTest,
+    # Input functions and tensors
+    # ----------------------------
+    
     # Health state updates
     trFunc_diseaseProgression=trFunc_diseaseProgression,
     trFunc_newInfections=trFunc_newInfections_Complete,
@@ -1623,12 +2491,13 @@ def dydt_Complete(
     trFunc_HospitalDischarge=trFunc_HospitalDischarge,
     
     # Policy changes (on social distancing for now) (TODO - possibly make more changes)
-    tStartSocialDistancing=tStartSocialDistancing,
-    tStopSocialDistancing=tStopSocialDistancing,
-    tStartImmunityPassports=tStartImmunityPassports,
-    tStopImmunityPassports=tStopImmunityPassports,
-    tStartQuarantineCaseIsolation=tStartQuarantineCaseIsolation,
-    tStopQuarantineCaseIsolation=tStopQuarantineCaseIsolation,
+    # (dates filled in by CoexistModel from the user inputs)
+    tStartSocialDistancing=None,
+    tStopSocialDistancing=None,
+    tStartImmunityPassports=None,
+    tStopImmunityPassports=None,
+    tStartQuarantineCaseIsolation=None,
+    tStopQuarantineCaseIsolation=None,
     trFunc_quarantine=trFunc_quarantine_caseIsolation,
     
     # Testing
@@ -1637,93 +2506,122 @@ def dydt_Complete(
     # testSpecifications = testSpecifications,
     # trFunc_testCapacity = trFunc_testCapacity,
     # trFunc_testCapacity_param_testCapacity_antigenratio_country = 0.3
+    *,
+    # Settings of the run, passed by solveSystem (not model parameters, so not part of build_paramDict)
+    # Also return the (sparse) Jacobian of the returned dydt, see jacobian_Complete
+    returnJacobian=False,
+    # Batched runs: number of scenarios stacked in the state (nScenarios x [2 x] stateTensor), see solveSystem_ensemble
+    nScenarios=None,
+    # Dates of the parameters as simulation days (SimulationCalendar)
+    calendar=None,
+    # Reused buffers (RHSWorkspace)
+    workspace=None,
+    # Names of flows (see flowDefinitions) to accumulate after the state (per age group), instead of the newOnly copy
+    trackFlows=None,
+    # RunProfile timing the stages below
+    profile=None,
     **kwargs,
 ):
 
-    # print out sim day while running
-    tt = round(t,)
-    used = []
-    if tt % 5 == 0:
-        if t not in used:
-            print(f" Sim Day: {tt}", end="\r")
-            used.append(t)
-
     if debugTimestep:
         print(t)
 
+    if profile is not None and profile.timeStages:
+        profile.start()
+        lap = profile.lap
+    else:
+        lap = _noLap
+
     # Initialise return
+    batchShape = () if nScenarios is None else (nScenarios,)
     if (
         debugReturnNewPerDay
     ):  # the input has 2 copies of the state tensor, second copy being the cumulative incomings
-        stateTensor = np.reshape(stateTensor_flattened, [2, nAge, nHS, nIso, nTest])[0]
+        stateTensor = np.reshape(
+            stateTensor_flattened, batchShape + (2, nAge, nHS, nIso, nTest)
+        )[..., 0, :, :, :, :]
+    elif trackFlows:  # the input is the state tensor followed by the flows
+        stateTensor = np.reshape(
+            np.reshape(stateTensor_flattened, batchShape + (-1,))[..., : nAge * nHS * nIso * nTest],
+            batchShape + (nAge, nHS, nIso, nTest),
+        )
     else:
-        stateTensor = np.reshape(stateTensor_flattened, [nAge, nHS, nIso, nTest])
-
-    dydt = np.zeros_like(stateTensor)
+        stateTensor = np.reshape(stateTensor_flattened, batchShape + (nAge, nHS, nIso, nTest))
 
-    # Initialise the full transition tensor
-    trTensor_complete = np.zeros((nAge, nHS, nIso, nTest, nHS, nIso, nTest))
+    # Initialise the (sparse) full transition tensor
+    trOperator = build_transitionOperator(nAge, nHS, nIso, nTest)
+    if workspace is None or not workspace.matches(trOperator, batchShape):
+        workspace = RHSWorkspace(trOperator, batchShape)
+    lap("setup")
 
-    # Disease condition updates
+    # Time-invariant updates (looked up once per run, see rhs_workspace)
     # ---------------------------
-    trTensor_diseaseProgression = trFunc_diseaseProgression(
-        **kwargs["trFunc_diseaseProgression_params"]
-    )
-
-    # Get disease condition updates with no isolation or test transition ("diagonal along those")
-    for k1 in [0, 1, 2, 3]:
-        np.einsum("ijlml->ijlm", trTensor_complete[:, :, k1, :, :, k1, :])[
-            :
-        ] += np.expand_dims(
-            trTensor_diseaseProgression[:, :, k1, :], [2]
-        )  # all non-hospitalised disease progression is same
-
-    # Compute new infections (0->1 in HS) with no isolation or test transition ("diagonal along those")
-    cur_policySocialDistancing = (
-        t >= (tStartSocialDistancing - realStartDate).days
-    ) * (t < (tStopSocialDistancing - realStartDate).days)
-    cur_policyImmunityPassports = (
-        t >= (tStartImmunityPassports - realStartDate).days
-    ) * (t < (tStopImmunityPassports - realStartDate).days)
-    np.einsum("iklkl->ikl", trTensor_complete[:, 0, :, :, 1, :, :])[
-        :
-    ] += trFunc_newInfections(
-        stateTensor,
-        policySocialDistancing=cur_policySocialDistancing,
-        policyImmunityPassports=cur_policyImmunityPassports,
-        **kwargs["trFunc_newInfections_params"],
-    )
-
-    # Also add new infected from travelling of healthy people, based on time-within-simulation (this is correct with all (0,0) states, as tested or isolated people dont travel)
-    trTensor_complete[:, 0, 0, 0, 1, 0, 0] += trFunc_travelInfectionRate_ageAdjusted(
-        t, **kwargs["trFunc_travelInfectionRate_ageAdjusted_params"]
-    )
-
-    # Hospitalisation state updates
-    # -----------------------
-
-    # Hospitalisation and recovery rates
-    # We assume for now that these only depend on age and disease progression, not on testing state
+    # Disease condition updates with no isolation or test transition ("diagonal along those"),
+    # and hospitalisation / recovery rates, that for now only depend on age and disease progression, not on testing state
     # (TODO - update this given new policies)
-
     # The disease and testing states don't change due to hospitalisation.
     # Hospital staff is treated as already hospitalised from all aspects expect social mixing, should suffice for now
     # TODO - Could try to devise a scheme in which hospital staff gets hospitalised and some recoveries from hospitalised state go back to hospital staff.
     # TODO - same issue with hospital staff home isolating; that's probably more important question!
-    for k1 in [0, 1]:
-        np.einsum("ijljl->ijl", trTensor_complete[:, :, k1, :, :, 2, :])[
-            :
-        ] += np.expand_dims(
-            trFunc_HospitalAdmission(**kwargs["trFunc_HospitalAdmission_params"]), [2]
+    # TODO - again here (for now) we assume all discharged people go back to "normal state" instead of home isolation, have to think more on this
+    staticRates = workspace.staticRates
+    if staticRates is None:
+        _, staticRates = cached_staticTransitions(
+            trOperator,
+            trFunc_diseaseProgression,
+            trFunc_HospitalAdmission,
+            trFunc_HospitalDischarge,
+            kwargs["trFunc_diseaseProgression_params"],
+            kwargs["trFunc_HospitalAdmission_params"],
+            kwargs["trFunc_HospitalDischarge_params"],
         )
+    trRates = workspace.rates
+    np.copyto(trRates, staticRates)
+    lap("staticTransitions")  # disease progression, hospital admission and discharge
+
+    if calendar is None:
+        calendar = SimulationCalendar(
+            0,
+            realStartDate,
+            tStartSocialDistancing=tStartSocialDistancing,
+            tStopSocialDistancing=tStopSocialDistancing,
+            tStartImmunityPassports=tStartImmunityPassports,
+            tStopImmunityPassports=tStopImmunityPassports,
+            tStartQuarantineCaseIsolation=tStartQuarantineCaseIsolation,
+            tStopQuarantineCaseIsolation=tStopQuarantineCaseIsolation,
+        )
+    policyDays = calendar.policyDays
 
-    # Add recovery from hospital rates
-    # TODO - again here (for now) we assume all discharged people go back to "normal state" instead of home isolation, have to think more on this
-    np.einsum("ijljl->ijl", trTensor_complete[:, :, 2, :, :, 0, :])[
-        :
-    ] += np.expand_dims(
-        trFunc_HospitalDischarge(**kwargs["trFunc_HospitalDischarge_params"]), [2]
+    # Compute new infections (0->1 in HS) with no isolation or test transition ("diagonal along those")
+    # (policies are on / off per scenario, if their dates are stacked)
+    cur_policySocialDistancing = (
+        t >= policyDays["tStartSocialDistancing"]
+    ) * (t < policyDays["tStopSocialDistancing"])
+    cur_policyImmunityPassports = (
+        t >= policyDays["tStartImmunityPassports"]
+    ) * (t < policyDays["tStopImmunityPassports"])
+    lap("policies")
+    trOperator.scatter(
+        trRates,
+        "newInfections",
+        trFunc_newInfections(
+            stateTensor,
+            policySocialDistancing=cur_policySocialDistancing,
+            policyImmunityPassports=cur_policyImmunityPassports,
+            **kwargs["trFunc_newInfections_params"],
+        ),
+    )
+    lap("newInfections")
+
+    # Also add new infected from travelling of healthy people, based on time-within-simulation (this is correct with all (0,0) states, as tested or isolated people dont travel)
+    trOperator.scatter(
+        trRates,
+        "travel",
+        trFunc_travelInfectionRate_ageAdjusted(
+            t, calendar=calendar, **kwargs["trFunc_travelInfectionRate_ageAdjusted_params"]
+        ),
     )
+    lap("travel")
 
     # Testing state updates
     # ---------------------
@@ -1734,24 +2632,31 @@ def dydt_Complete(
     # Diagonal (no transitions) in age, health state and isolation state
     # (for now, probably TODO: testing positive correlates with new hospitalisation!)
     trTensor_testing = trFunc_testing(
-        stateTensor, t, realStartDate, **kwargs["trFunc_testing_params"]
+        stateTensor, t, realStartDate, calendar=calendar, **kwargs["trFunc_testing_params"]
     )
 
-    np.einsum("ijkljkm->ijklm", trTensor_complete)[:] += trTensor_testing
+    trOperator.scatter(trRates, "testing", trTensor_testing)
+    lap("testing")
 
     # Quarantine policy
     # ------------------
 
     # Check if policy is "on"
-    if (t >= (tStartQuarantineCaseIsolation - realStartDate).days) * (
-        t < (tStopQuarantineCaseIsolation - realStartDate).days
-    ):
+    cur_policyQuarantine = (
+        t >= policyDays["tStartQuarantineCaseIsolation"]
+    ) * (t < policyDays["tStopQuarantineCaseIsolation"])
+    if np.any(cur_policyQuarantine):
         # New quarantining only happens to people who are transitioning already from untested to virus positive state
         # Therefore here we DO use non-diagonal transitions, and we
         #     redistribute the transtion rates given the testing (which was previously assumed not to create transition in isolation state)
-        trTensor_complete = trFunc_quarantine(
-            trTensor_complete, t, trTensor_testing, **kwargs["trFunc_quarantine_params"]
+        trOperator.apply_quarantine(
+            trRates,
+            trFunc_quarantine(
+                t, trTensor_testing, **kwargs["trFunc_quarantine_params"]
+            ),
+            active=cur_policyQuarantine,
         )
+    lap("quarantine")
 
     # Final corrections
     # -----------------
@@ -1759,15 +2664,19 @@ def dydt_Complete(
     # TODO: simulate aging and normal birth / death (not terribly important on these time scales, but should be quite simple)
 
     # Ensure that every "row" sums to 0 by adding to the diagonal (doesn't create new people out of nowhere)
-    # Extract (writable) diagonal array and subtract the "row"-sums for each initial state
-    np.einsum("ijkljkl->ijkl", trTensor_complete)[:] -= np.einsum(
-        "...jkl->...", trTensor_complete
+    outgoingRates = trOperator.finalise(
+        trRates, out=workspace.outgoingRates, scratch=workspace.sortedRates
     )
+    lap("diagonalCorrection")
 
     # Compute the actual derivatives
-    dydt = np.einsum(
-        "ijkl,ijklmnp->imnp", stateTensor, trTensor_complete
-    )  # contract the HS axis, keep age
+    # (into a newly allocated output, the integrators keep references to returned derivatives)
+    stateTensor_flat = np.reshape(stateTensor, batchShape + (-1,))
+    dydt_current = np.reshape(
+        workspace.matrix @ np.reshape(stateTensor_flat, -1), batchShape + (trOperator.nStates,)
+    )
+    dydt = dydt_current
+    lap("contraction")
 
     if debugReturnNewPerDay:
         """
@@ -1783,39 +2692,485 @@ def dydt_Complete(
                 but only represent the “new incomings” for each state)
         """
 
-        trTensor_complete_newOnly = copy.deepcopy(trTensor_complete)
-
         # TODO - Think - this is probably unnecessary actually, artifically reduces "new" rates?
         #         # Devide each row by the absolute diagonal rate (that is the sum of the row), but only if its larger than 1
-        #         trTensor_complete_newOnly /= (
-        #             np.expand_dims(
-        #                 np.clip(np.abs(np.einsum('ijkljkl->ijkl', trTensor_complete_newOnly)), a_min=1., a_max=np.inf),
-        #                 axis=[4,5,6]
-        #             )
-        #         )
 
-        # Set the diagonals to zero (no preservation, no outgoing, will end up being the incoming only)
-        np.einsum("ijkljkl->ijkl", trTensor_complete_newOnly)[:] = 0.0
-
-        dydt_newOnly = np.einsum(
-            "ijkl,ijklmnp->imnp", stateTensor, trTensor_complete_newOnly
+        # Setting the diagonal to zero (no preservation, no outgoing) leaves the incoming only,
+        # which is the same as adding back the outgoing people to dydt
+        dydt = np.empty(batchShape + (2, trOperator.nStates))
+        dydt_newOnly = np.multiply(outgoingRates, stateTensor_flat, out=dydt[..., 1, :])
+        dydt_newOnly += dydt_current
+        dydt[..., 0, :] = dydt_current
+
+    elif trackFlows:
+        # Only the flows we report are accumulated, from the rates and states we already have
+        dydt = np.concatenate(
+            [dydt_current, trOperator.flows(trRates, stateTensor_flat, trackFlows)], axis=-1
         )
-
-        dydt = np.stack([dydt, dydt_newOnly], axis=0)
+    lap("newOnlyAndFlows")
 
     if debugTransition:
-        return np.reshape(dydt, -1), trTensor_complete
+        return np.reshape(dydt, -1), trOperator.to_dense(trRates)
+
+    if returnJacobian:
+        jacobians = []
+        for scenario in range(nScenarios or 1):
+            inScenario = (lambda val: val) if nScenarios is None else (
+                lambda val: val[scenario] if np.ndim(val) > 0 else val
+            )
+            newInfectionsParams = (
+                kwargs["trFunc_newInfections_params"]
+                if nScenarios is None
+                else select_scenario(kwargs["trFunc_newInfections_params"], scenario)
+            )
+            # the quarantine policy removes some of the new infection transitions
+            fluxScale = (
+                trOperator.gather(trOperator.quarantineKeep, "newInfections")
+                if inScenario(cur_policyQuarantine)
+                else 1.0
+            )
+            regionCoupling = newInfectionsParams.get("regionCoupling")
+            if regionCoupling is not None:
+                # Metapopulations: only the coupling of each region to itself enters its (block of the) Jacobian,
+                # the infections driven by the other regions are neglected like the population normalisation
+                newInfectionsParams = OrderedDict(newInfectionsParams, regionCoupling=None)
+                fluxScale = fluxScale * regionCoupling[scenario, scenario]
+            jacobians.append(
+                jacobian_Complete(
+                    trOperator,
+                    inScenario(trRates),
+                    inScenario(outgoingRates),
+                    newInfections_derivative(
+                        trFunc_newInfections,
+                        stateTensor if nScenarios is None else stateTensor[scenario],
+                        nI,
+                        policySocialDistancing=inScenario(cur_policySocialDistancing),
+                        policyImmunityPassports=inScenario(cur_policyImmunityPassports),
+                        fluxScale=fluxScale,
+                        trFunc_newInfections_params=newInfectionsParams,
+                    ),
+                    debugReturnNewPerDay,
+                    trackFlows=trackFlows,
+                )
+            )
+        jacobian = sparse.block_diag(jacobians, format="csc")
+        lap("jacobian")
+        return np.reshape(dydt, -1), jacobian
 
     return np.reshape(dydt, -1)
 
 
-def solveSystem(stateTensor_init, total_days, samplesPerDay=np.inf, **kwargs):
+# ## Jacobian of the right hand side
+#
+# With the transition rates fixed, dydt = M @ stateTensor is linear. The rates only depend on the state through
+# the new infections (linear in the infectious states, normalised by the total population) and the testing policies.
+# The Jacobian is therefore M plus the derivative of the S -> E infection flux with respect to the infectious states;
+# the state dependence of the testing rates and of the population normalisation is neglected.
+# Implicit solvers only use the Jacobian in their Newton iterations, so this does not affect the accuracy of the solution.
+# (Finite differences on a structural sparsity pattern are no alternative: the testing policies distribute tests
+# proportionally to group totals, which couples every tested state to all the others.)
+@functools.lru_cache(maxsize=None)
+def infectiousStateBasis(nAge, nHS, nI, nIso, nTest):
+    """Flat indices of the infectious states, and a stack of unit state tensors, one for each of them"""
+    idx = np.arange(nAge * nHS * nIso * nTest).reshape((nAge, nHS, nIso, nTest))
+    infectiousIdx = idx[:, 1 : (nI + 1)].reshape(-1)
+    basis = np.zeros((len(infectiousIdx), idx.size))
+    basis[np.arange(len(infectiousIdx)), infectiousIdx] = 1.0
+    basis = basis.reshape((-1, nAge, nHS, nIso, nTest))
+    for arr in [infectiousIdx, basis]:
+        arr.setflags(write=False)
+    return infectiousIdx, basis
+
+
+def newInfections_derivative(
+    trFunc_newInfections,
+    stateTensor,
+    nI,
+    policySocialDistancing,
+    policyImmunityPassports,
+    trFunc_newInfections_params,
+    fluxScale=1.0,
+):
+    """
+    Sparse nStates x nStates derivative of the new infection flux into the exposed states (S -> E)
+    with respect to the infectious states. The flux out of the susceptible states is its negative.
+    fluxScale (nAge x nIso x nTest) is the fraction of the new infection rates that ends up in the transition operator.
+    """
+    infectiousIdx, basis = infectiousStateBasis(*stateTensor.shape[:2], nI, *stateTensor.shape[2:])
+    # New infection rates are linear in the infectious states, so evaluating them with a single (unit) infectious
+    # person gives their derivative, up to the normalisation by the total population
+    basisRates = trFunc_newInfections(
+        basis,
+        policySocialDistancing=policySocialDistancing,
+        policyImmunityPassports=policyImmunityPassports,
+        **trFunc_newInfections_params,
+    )
+    fluxDerivative = fluxScale * stateTensor[:, 0] * basisRates / np.sum(stateTensor)
+
+    nStates = stateTensor.size
+    toExposed = np.arange(nStates).reshape(stateTensor.shape)[:, 1].reshape(-1)
+    fluxDerivative = fluxDerivative.reshape(len(infectiousIdx), -1)
+    nonzero = np.nonzero(fluxDerivative)
+    return sparse.csr_matrix(
+        (fluxDerivative[nonzero], (toExposed[nonzero[1]], infectiousIdx[nonzero[0]])),
+        shape=(nStates, nStates),
+    )
+
+
+def jacobian_Complete(trOperator, trRates, outgoingRates, newInfectionsDerivative, debugReturnNewPerDay, trackFlows=None):
+    """
+    Jacobian of the (single scenario) dydt returned by dydt_Complete, given its finalised rates.
+    With debugReturnNewPerDay the state is [stateTensor, newOnly], and newOnly (the incoming people) only depends on stateTensor.
+    With trackFlows the state is [stateTensor, flows], and the flows also only depend on stateTensor.
+    """
+    # S -> E: the exposed states gain what the susceptible states lose
+    healthStateStride = trOperator.stateShape[2] * trOperator.stateShape[3]
+    toSusceptible = sparse.eye(
+        trOperator.nStates, k=healthStateStride, format="csr"
+    )  # moves the exposed state rows onto the susceptible states (one health state earlier)
+    infectionJacobian = newInfectionsDerivative - toSusceptible @ newInfectionsDerivative
+    jacobian = trOperator.matrix(trRates) + infectionJacobian
+
+    if trackFlows:
+        flowJacobian = trOperator.flow_jacobian(trRates, trackFlows, newInfectionsDerivative)
+        return sparse.bmat(
+            [
+                [jacobian, None],
+                [flowJacobian, sparse.csr_matrix((flowJacobian.shape[0], flowJacobian.shape[0]))],
+            ],
+            format="csc",
+        )
+
+    if not debugReturnNewPerDay:
+        return jacobian
+
+    # The diagonal (outgoing people) is added back, and the susceptibles have no incoming infections
+    jacobian_newOnly = (
+        trOperator.matrix(trRates) + sparse.diags(outgoingRates) + newInfectionsDerivative
+    )
+    return sparse.bmat(
+        [
+            [jacobian, sparse.csr_matrix(jacobian.shape)],
+            [jacobian_newOnly, sparse.csr_matrix(jacobian.shape)],
+        ],
+        format="csc",
+    )
+
+
+# Implicit integrators, that use the Jacobian of the system
+implicitMethods = ["BDF", "Radau", "LSODA"]
+
+# Dates (parameters of dydt_Complete) at which a policy is switched on or off
+policyDateNames = [
+    "tStartSocialDistancing",
+    "tStopSocialDistancing",
+    "tStartImmunityPassports",
+    "tStopImmunityPassports",
+    "tStartQuarantineCaseIsolation",
+    "tStopQuarantineCaseIsolation",
+]
+
+
+def policySwitchDays(realStartDate, **kwargs):
+    """Simulation day of each policy switch date of the parameters (see policyDateNames), per scenario if stacked"""
+    return OrderedDict(
+        (dateName, daysBetween(realStartDate, kwargs[dateName]))
+        for dateName in policyDateNames
+        if kwargs.get(dateName) is not None
+    )
+
+
+class SimulationCalendar:
+    """
+    The dates of a parameter set (the keyword arguments of dydt_Complete) converted to whole days since realStartDate, set up once
+    per solveSystem call: the policy switch days, and for days 0 .. nDays-1 the date, the modelled test capacity (trFunc_testCapacity)
+    and the nearest real testing data (inpFunc_realData_testCapacity). dydt_Complete and trFunc_testing look these up by day
+    instead of redoing the date arithmetic on every call. For nDays > 0 it also holds the travel importation table (see
+    travel_table) and the compiled test specifications (see cached_testSpecifications) of the parameters, so the right
+    hand side does not look them up by parameter hash.
+    """
+
+    def __init__(self, nDays, realStartDate=None, **kwargs):
+        self.nDays = nDays
+        self.policyDays = policySwitchDays(realStartDate, **kwargs)
+
+        travelParams = kwargs.get("trFunc_travelInfectionRate_ageAdjusted_params")
+        self.travelTable = travel_table(travelParams) if nDays > 0 and travelParams is not None else None
+
+        testingParams = kwargs.get("trFunc_testing_params")
+        self.testSpecifications = None
+        if nDays > 0 and testingParams is not None and "inpFunc_testSpecifications_params" in testingParams:
+            self.testSpecifications = cached_testSpecifications(
+                testingParams.get("inpFunc_testSpecifications", inpFunc_testSpecifications),
+                testingParams["inpFunc_testSpecifications_params"],
+            )
+
+        self.dates = None
+        if nDays <= 0 or testingParams is None or realStartDate is None or np.ndim(realStartDate) > 0:
+            return
+        self.dates = pd.to_datetime(realStartDate, format="%Y-%m-%d") + pd.to_timedelta(np.arange(nDays), unit="D")
+
+        # Capacity on each day (nDays [x nScenarios] per test type)
+        capacityFunc = testingParams.get("trFunc_testCapacity", trFunc_testCapacity)
+        capacities = [
+            capacityFunc(realTime=date, **testingParams.get("trFunc_testCapacity_params", {}))
+            for date in self.dates
+        ]
+        self.testCapacity = OrderedDict(
+            (testType, np.stack([np.asarray(capacity[testType], dtype=float) for capacity in capacities]))
+            for testType in capacities[0]
+        )
+
+        # Nearest real data on each day (nDays x nAge), which is used on the days it is exactly for
+        realDataFunc = testingParams.get("inpFunc_realData_testCapacity", inpFunc_testingDataCHESS_PCR)
+        realDataParams = testingParams.get("inpFunc_realData_testCapacity_params", {})
+        realData = realDataFunc(realTime=self.dates, **realDataParams)
+        if isinstance(realData, pd.DataFrame):
+            self.hasRealTestData = np.asarray(pd.DatetimeIndex(realData.index) == self.dates)
+            self.realTestData = realData.to_numpy(dtype=float)
+        else:  # only takes single dates
+            realData = [realDataFunc(realTime=date, **realDataParams) for date in self.dates]
+            self.hasRealTestData = np.array([row.name == date for row, date in zip(realData, self.dates)])
+            self.realTestData = np.stack([row.to_numpy(dtype=float) for row in realData])
+
+        for arr in list(self.testCapacity.values()) + [self.hasRealTestData, self.realTestData]:
+            arr.setflags(write=False)
+
+    def covers(self, day):
+        """Whether the testing data of the (whole) day is precomputed"""
+        return self.dates is not None and 0 <= day < self.nDays
+
+
+def breakpoints_Complete(total_days, realStartDate=None, dailyBreakpoints=False, **kwargs):
+    """
+    Sorted times in [0, total_days] (including both ends) at which the right hand side of dydt_Complete jumps:
+    the policy switches (per scenario, if the dates are stacked), and if dailyBreakpoints the day boundaries
+    (the travel infections and the testing are evaluated per whole day, but these jumps are small)
+    """
+    points = [0.0, float(total_days)]
+    if dailyBreakpoints:
+        points += list(range(1, total_days))
+    for days in policySwitchDays(realStartDate, **kwargs).values():
+        points += list(np.ravel(days))
+    points = np.unique(np.asarray(points, dtype=float))
+    return points[(points >= 0.0) & (points <= total_days)]
+
+
+# ## Checkpoints
+#
+# A checkpoint is the integrated state vector of solveSystem at the start of a day (including the newOnly copy or the
+# tracked flows), with what is needed to check that a run continuing from it is compatible
+# Entries of the solveSystem keyword arguments that are set up per run, and are not parameters of the model
+runtimeKwargs = ["calendar", "workspace", "profile", "nScenarios", "trackFlows", "returnJacobian"]
+
+
+def checkpoint_paramHash(kwargs):
+    """Hash (see paramHash) of the parameters of a run, saved with its checkpoints"""
+    return paramHash(OrderedDict((key, val) for key, val in kwargs.items() if key not in runtimeKwargs))
+
+
+def save_checkpoint(path, checkpoint):
+    """Write a checkpoint (dictionary with the state vector and its description) to an .npz file"""
+    meta = OrderedDict((key, val) for key, val in checkpoint.items() if key != "state")
+    np.savez(path, state=np.asarray(checkpoint["state"], dtype=float), meta=np.array(json.dumps(meta)))
+
+
+def load_checkpoint(path):
+    """Read a checkpoint written by save_checkpoint"""
+    with np.load(path) as npz:
+        checkpoint = json.loads(str(npz["meta"]), object_pairs_hook=OrderedDict)
+        checkpoint["state"] = npz["state"]
+    return checkpoint
+
+
+def check_checkpoint(
+    checkpoint, stateTensor_init, total_days, runParamHash, allowParameterChange=False, trackFlows=None, **kwargs
+):
+    """Raise a ValueError if a run (stateTensor_init, total_days, trackFlows, parameters) cannot continue from checkpoint"""
+    if list(np.shape(stateTensor_init)) != list(checkpoint["stateShape"]):
+        raise ValueError(
+            f"solveSystem: the checkpoint has states of shape {checkpoint['stateShape']}, the run {list(np.shape(stateTensor_init))}"
+        )
+    layout = (bool(kwargs["debugReturnNewPerDay"]) and not trackFlows, list(trackFlows) if trackFlows else None)
+    if layout != (checkpoint["debugReturnNewPerDay"] and not checkpoint["trackFlows"], checkpoint["trackFlows"]):
+        raise ValueError("solveSystem: the checkpoint and the run differ in debugReturnNewPerDay or trackFlows")
+    if checkpoint["day"] >= total_days:
+        raise ValueError(f"solveSystem: the checkpoint is at day {checkpoint['day']}, the run ends at day {total_days}")
+    if checkpoint["paramHash"] != runParamHash and not allowParameterChange:
+        raise ValueError(
+            "solveSystem: the parameters differ from those of the checkpoint (pass allowParameterChange=True to continue with them)"
+        )
+
+
+# ## Result cache
+#
+# Outputs of solveSystem stored under a hash of everything they depend on: the initial state and the parameter tree
+# (which are built from the input json files and the mixing matrices), total_days, the solver options, and the source
+# of this module. Recently used outputs are kept in memory as well.
+@functools.lru_cache(maxsize=None)
+def _sourceHash():
+    with open(__file__, "rb") as src:
+        return hashlib.sha1(src.read()).hexdigest()
+
+
+class ResultCache:
+    """
+    Outputs of solveSystem (arrays, or the (states, flows) tuples of trackFlows) stored as .npz files in directory,
+    with the memorySize most recently used ones also kept in memory. Once the files take more than maxBytes, the least
+    recently used are deleted. The outputs returned are copies, so the stored ones cannot be modified by the caller.
+    """
+
+    def __init__(self, directory, maxBytes=2**30, memorySize=8):
+        self.directory = os.fspath(directory)
+        self.maxBytes = maxBytes
+        self.memory = LRUCache(maxsize=memorySize)
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, *values):
+        return paramHash(_sourceHash(), *values)
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def get(self, key):
+        """The output stored under key (a copy), or None"""
+        result = self.memory.get(key)
+        if result is None and os.path.exists(self.path(key)):
+            try:
+                with np.load(self.path(key)) as npz:
+                    parts = [npz[f"part{ii}"] for ii in range(len(npz.files))]
+            except (OSError, ValueError, KeyError):  # partly written or removed by another process
+                parts = None
+            if parts is not None:
+                os.utime(self.path(key))  # most recently used
+                result = tuple(parts) if len(parts) > 1 else parts[0]
+                self.memory.put(key, result)
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return tuple(np.array(part) for part in result) if isinstance(result, tuple) else np.array(result)
+
+    def put(self, key, result):
+        """Store an output under key, and evict the least recently used files beyond maxBytes"""
+        parts = result if isinstance(result, tuple) else (result,)
+        parts = tuple(np.array(part) for part in parts)
+        self.memory.put(key, parts if isinstance(result, tuple) else parts[0])
+        # Written to a temporary file first, so that other processes never read a partial file
+        tmpPath = f"{self.path(key)}.{os.getpid()}.tmp"
+        with open(tmpPath, "wb") as out:
+            np.savez(out, **{f"part{ii}": part for ii, part in enumerate(parts)})
+        os.replace(tmpPath, self.path(key))
+        self.evict()
+
+    def evict(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npz"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        totalBytes = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if totalBytes <= self.maxBytes:
+                break
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            totalBytes -= size
+
+    def clear(self):
+        """Delete every stored output"""
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npz"):
+                with contextlib.suppress(OSError):
+                    os.remove(entry.path)
+        self.memory.clear()
+
+
+def solveSystem(
+    stateTensor_init,
+    total_days,
+    samplesPerDay=np.inf,
+    method="RK23",
+    rtol=1e-3,  # default 1e-3
+    atol=1e-3,  # default 1e-6
+    jacobian="analytic",  # implicit methods only: "analytic" (jacobian_Complete) or None (finite differences)
+    piecewise=True,  # restart the integrator at every policy switch (see breakpoints_Complete)
+    dailyBreakpoints=False,  # and at every day boundary (more accurate, but about twice the right hand side evaluations)
+    profile=None,  # a RunProfile, filled with the solver statistics (and right hand side stage timings) of the run
+    checkpointDays=(),  # days at which the integrated state is saved (see save_checkpoint) ...
+    checkpointPath=None,  # ... to checkpointPath.format(day=day), e.g. "results/run.day{day}.checkpoint.npz" (or into a dictionary of day -> checkpoint)
+    resumeFrom=None,  # a checkpoint (or its path) to continue from, the output then starts at its day
+    allowParameterChange=False,  # resume with parameters that differ from those of the checkpoint (see solveSystem_branches)
+    cache=None,  # a ResultCache, which returns the stored output of an identical run (not used with checkpoints)
+    progress=None,  # called with {"day", "total_days", "elapsed"} as the integration completes days, at most once per day (see print_progress)
+    trackFlows=None,  # names of flows (see flowDefinitions) to accumulate per age group instead of the newOnly copy, the output is then (states, flows)
+    **kwargs,
+):
+    # The parameters of the run, as saved with its checkpoints
+    if checkpointDays or resumeFrom is not None:
+        runParamHash = checkpoint_paramHash(kwargs)
+
+    # An identical run (initial state, parameters, total_days and solver options) may have been stored already
+    cacheKey = None
+    if cache is not None and not checkpointDays and resumeFrom is None:
+        cacheKey = cache.key(
+            stateTensor_init,
+            total_days,
+            OrderedDict([
+                ("samplesPerDay", float(samplesPerDay)), ("method", method), ("rtol", rtol), ("atol", atol),
+                ("jacobian", jacobian), ("piecewise", piecewise), ("dailyBreakpoints", dailyBreakpoints),
+                ("trackFlows", list(trackFlows) if trackFlows else None),
+            ]),
+            OrderedDict((key, val) for key, val in kwargs.items() if key not in runtimeKwargs),
+        )
+        cached = cache.get(cacheKey)
+        if cached is not None:
+            if progress is not None:
+                progress(OrderedDict([("day", total_days), ("total_days", total_days), ("elapsed", 0.0)]))
+            return cached
+
+    # A stateTensor_init with a leading scenario axis (nScenarios x nAge x nHS x nIso x nTest)
+    # advances all scenarios together (see solveSystem_ensemble)
+    if np.ndim(stateTensor_init) == 5:
+        kwargs["nScenarios"] = stateTensor_init.shape[0]
+
+    # Convert the dates of the parameters to simulation days once, for the whole run
+    if kwargs.get("calendar") is None:
+        kwargs["calendar"] = SimulationCalendar(total_days + 1, **kwargs)
+    # and allocate the buffers (and look up the time-invariant rates) of the right hand side once
+    kwargs["workspace"] = rhs_workspace(np.shape(stateTensor_init), **kwargs)
+
+    # Tracked flows replace the newOnly copy of the state, and are accumulated after the state of every scenario
+    if trackFlows:
+        kwargs["trackFlows"] = list(trackFlows)
+        kwargs["debugReturnNewPerDay"] = False
+        nFlowValues = len(trackFlows) * np.shape(stateTensor_init)[-4]
+
+    if profile is not None:
+        kwargs["profile"] = profile
+
     # Run the simulation
-    if kwargs["debugReturnNewPerDay"]:  # Keep the second copy as well
+    if trackFlows:
+        cur_stateTensor = np.reshape(
+            np.concatenate(
+                [
+                    np.reshape(stateTensor_init, np.shape(stateTensor_init)[:-4] + (-1,)),
+                    np.zeros(np.shape(stateTensor_init)[:-4] + (nFlowValues,)),
+                ],
+                axis=-1,
+            ),
+            -1,
+        )
+    elif kwargs["debugReturnNewPerDay"]:  # Keep the second copy as well
         cur_stateTensor = np.reshape(
             np.stack(
                 [copy.deepcopy(stateTensor_init), copy.deepcopy(stateTensor_init)],
-                axis=0,
+                axis=-5,
             ),
             -1,
         )
@@ -1823,110 +3178,1005 @@ def solveSystem(stateTensor_init, total_days, samplesPerDay=np.inf, **kwargs):
         # print("else 1")
         cur_stateTensor = np.reshape(copy.deepcopy(stateTensor_init), -1)
 
+    # Continue from a checkpoint: its state replaces the initial state, and only the days from its day on are computed
+    startDay = 0
+    if resumeFrom is not None:
+        checkpoint = load_checkpoint(resumeFrom) if isinstance(resumeFrom, (str, os.PathLike)) else resumeFrom
+        check_checkpoint(
+            checkpoint, stateTensor_init, total_days, runParamHash, allowParameterChange=allowParameterChange, **kwargs
+        )
+        cur_stateTensor = np.array(checkpoint["state"], dtype=float)
+        startDay = int(checkpoint["day"])
+
+    checkpointDays = sorted(set(int(day) for day in checkpointDays))
+    if checkpointDays and checkpointPath is None:
+        raise ValueError("solveSystem: checkpointDays need a checkpointPath")
+    if any(day <= startDay or day > total_days for day in checkpointDays):
+        raise ValueError(f"solveSystem: checkpointDays must be after day {startDay} and at most total_days ({total_days})")
+
+    # Progress is reported by the solver loop (see progress_solver), once the integration has passed a new day
+    progressStart = time.time()
+    lastReportedDay = [startDay]
+
+    def reportProgress(t):
+        day = min(int(np.floor(t)), total_days)
+        if day > lastReportedDay[0]:
+            lastReportedDay[0] = day
+            progress(OrderedDict([
+                ("day", day), ("total_days", total_days), ("elapsed", time.time() - progressStart),
+            ]))
+
+    def saveCheckpoint(day, state):
+        checkpoint = OrderedDict([
+            ("day", day),
+            ("state", np.array(state)),
+            ("stateShape", list(np.shape(stateTensor_init))),
+            ("debugReturnNewPerDay", bool(kwargs["debugReturnNewPerDay"])),
+            ("trackFlows", list(trackFlows) if trackFlows else None),
+            ("paramHash", runParamHash),
+            ("solver", OrderedDict([
+                ("method", str(method)), ("rtol", rtol), ("atol", atol), ("samplesPerDay", float(samplesPerDay)),
+            ])),
+        ])
+        if isinstance(checkpointPath, dict):
+            checkpointPath[day] = checkpoint
+        else:
+            save_checkpoint(checkpointPath.format(day=day), checkpoint)
+
     if np.isinf(samplesPerDay):
         # print("if 2")
         # Run precise integrator - used for all simulations
-        out = integrate.solve_ivp(
-            fun=lambda t, y: dydt_Complete(t, y, **kwargs),
-            t_span=(0.0, total_days),
-            y0=cur_stateTensor,
-            method="RK23",
-            t_eval=range(total_days),
-            rtol=1e-3,  # default 1e-3
-            atol=1e-3,  # default 1e-6
-        )
-        # print(out)
-        out = out.y
+        if jacobian not in ["analytic", None]:
+            raise ValueError(f"solveSystem: unknown jacobian option {jacobian}")
+
+        def solveSegment(t_start, t_end, y0, t_eval, tMax):
+            # The right hand side is only evaluated on the piece [t_start, tMax], at tMax = t_end the
+            # left limit is used, so the integrator never sees a jump
+            jacArgs = {}
+            if method in implicitMethods and jacobian == "analytic":
+                jacArgs["jac"] = lambda t, y: dydt_Complete(
+                    min(t, tMax), y, **{**kwargs, "returnJacobian": True}
+                )[1]
+                if method == "LSODA":  # LSODA only takes dense Jacobians
+                    jacArgs["jac"] = lambda t, y, jac=jacArgs["jac"]: jac(t, y).toarray()
+            solverMethod = method if profile is None else profile.solver(method)
+            if progress is not None:
+                solverMethod = progress_solver(solverMethod, reportProgress)
+            solution = integrate.solve_ivp(
+                fun=lambda t, y: dydt_Complete(min(t, tMax), y, **kwargs),
+                t_span=(t_start, t_end),
+                y0=y0,
+                method=solverMethod,
+                t_eval=t_eval,
+                rtol=rtol,
+                atol=atol,
+                **jacArgs,
+            )
+            if profile is not None:
+                profile.add_segment(t_start, t_end, method, solution)
+            return solution
+
+        if piecewise:
+            breakpoints = breakpoints_Complete(
+                total_days, dailyBreakpoints=dailyBreakpoints, **kwargs
+            )
+        else:
+            breakpoints = np.array([0.0, total_days])
+        # The integrator is also restarted at the checkpoints, so that resuming from them gives the same results
+        breakpoints = np.union1d(breakpoints[breakpoints > startDay], [startDay] + checkpointDays)
+
+        # Integrate between consecutive breakpoints, restarting the integrator at each of them
+        out = np.zeros((cur_stateTensor.size, total_days - startDay))
+        for t_start, t_end in zip(breakpoints[:-1], breakpoints[1:]):
+            days = np.arange(np.ceil(t_start), min(t_end, total_days))
+            segment = solveSegment(
+                t_start,
+                t_end,
+                cur_stateTensor,
+                np.append(days, t_end),
+                np.nextafter(t_end, t_start) if piecewise else np.inf,
+            )
+            if not segment.success:
+                raise RuntimeError(
+                    f"solveSystem: integration failed between days {t_start} and {t_end}: {segment.message}"
+                )
+            out[:, (days - startDay).astype(int)] = segment.y[:, :-1]
+            cur_stateTensor = segment.y[:, -1]
+            if t_end in checkpointDays:
+                saveCheckpoint(int(t_end), cur_stateTensor)
 
     else:
         # print("else 2")
         # Run simple Euler method with given step size (1/samplesPerDay) for quickly investigating code behavior
         deltaT = 1.0 / samplesPerDay
-        out = np.zeros((np.prod(stateTensor_init.shape), total_days))
+        out = np.zeros((cur_stateTensor.size, total_days - startDay))
 
-        for tt in range(total_days * samplesPerDay):
+        for tt in range(startDay * samplesPerDay, total_days * samplesPerDay):
             if tt % samplesPerDay == 0:
-                out[:, int(tt / samplesPerDay)] = cur_stateTensor
+                day = tt // samplesPerDay
+                out[:, day - startDay] = cur_stateTensor
+                if day in checkpointDays:
+                    saveCheckpoint(day, cur_stateTensor)
+                if progress is not None:
+                    reportProgress(day)
 
             cur_stateTensor += deltaT * dydt_Complete(
                 (tt * 1.0) / (1.0 * samplesPerDay), cur_stateTensor, **kwargs
             )
+        if total_days in checkpointDays:
+            saveCheckpoint(total_days, cur_stateTensor)
+        if progress is not None:
+            reportProgress(total_days)
+
+        if profile is not None:
+            profile.add_euler(startDay, total_days, samplesPerDay)
 
     # Reshape to reasonable format
-    if kwargs["debugReturnNewPerDay"]:
-        out = np.reshape(out, (2,) + stateTensor_init.shape + (-1,))
+    if trackFlows:
+        # (states, flows), with the flows as cumulative numbers of people (... x nFlows x nAge x days)
+        batchShape = np.shape(stateTensor_init)[:-4]
+        out = np.reshape(out, batchShape + (-1, total_days - startDay))
+        out = (
+            np.reshape(out[..., :-nFlowValues, :], np.shape(stateTensor_init) + (-1,)),
+            np.reshape(
+                out[..., -nFlowValues:, :],
+                batchShape + (len(trackFlows), np.shape(stateTensor_init)[-4], -1),
+            ),
+        )
+    elif kwargs["debugReturnNewPerDay"]:
+        out = np.reshape(
+            out, stateTensor_init.shape[:-4] + (2,) + stateTensor_init.shape[-4:] + (-1,)
+        )
     else:
         out = np.reshape(out, stateTensor_init.shape + (-1,))
 
+    if cacheKey is not None:
+        cache.put(cacheKey, out)
     return out
 
+
+def solveSystem_ensemble(stateTensor_init, total_days, paramDicts, samplesPerDay=np.inf, **solverKwargs):
+    """
+    Solve the system for a list of parameter dictionaries (scenarios) in a single integration.
+
+    The scenarios are stacked (see stack_paramDicts) and every right hand side evaluation computes all of them at once.
+    stateTensor_init is either shared by all scenarios, or has a leading scenario axis.
+    Returns nScenarios x (the output of solveSystem). Note that the integrator chooses a single step size for the
+    whole ensemble, so the results agree with separate runs up to the integration tolerance.
+    solverKwargs (method, rtol, atol, jacobian, trackFlows) are passed on to solveSystem.
+    """
+    stackedParams = stack_paramDicts(paramDicts)
+    nScenarios = len(paramDicts)
+    if np.ndim(stateTensor_init) == 4:
+        stateTensor_init = np.broadcast_to(
+            stateTensor_init, (nScenarios,) + np.shape(stateTensor_init)
+        )
+    return solveSystem(
+        np.array(stateTensor_init, dtype=float),
+        total_days,
+        samplesPerDay=samplesPerDay,
+        **solverKwargs,
+        **stackedParams,
+    )
+
+
+def solveSystem_metapopulation(stateTensors_init, total_days, paramDicts, regionCoupling, samplesPerDay=np.inf, **solverKwargs):
+    """
+    Solve the system for coupled regions (one parameter dictionary and initial state each) as a single integration.
+    The regions are an ensemble (see solveSystem_ensemble, so they share the age groups and realStartDate),
+    whose community infections are coupled by regionCoupling (nRegions x nRegions, dense or sparse, see region_coupling).
+    Returns nRegions x (the output of solveSystem).
+    """
+    nRegions = len(paramDicts)
+    if np.shape(regionCoupling) != (nRegions, nRegions):
+        raise ValueError(f"solveSystem_metapopulation: regionCoupling must be {nRegions} x {nRegions}, got {np.shape(regionCoupling)}")
+    if sparse.issparse(regionCoupling):
+        regionCoupling = sparse.csr_matrix(regionCoupling, dtype=float)
+    else:
+        regionCoupling = np.asarray(regionCoupling, dtype=float)
+
+    regionParamDicts = []
+    for paramDict in paramDicts:
+        paramDict = OrderedDict(paramDict)
+        paramDict["trFunc_newInfections_params"] = OrderedDict(
+            paramDict["trFunc_newInfections_params"], regionCoupling=regionCoupling
+        )
+        regionParamDicts.append(paramDict)
+
+    return solveSystem_ensemble(
+        np.stack(stateTensors_init, axis=0), total_days, regionParamDicts, samplesPerDay=samplesPerDay, **solverKwargs
+    )
+
+
+# ## Scenario trees
+#
+# Scenarios that only differ after some day share the integration of the days before it: the state on the branch day
+# is kept as a checkpoint (in memory), and each scenario continues from the checkpoint of the run it branches off
+def branch_day(paramDict, otherParamDict, total_days):
+    """
+    Day up to which two parameter dictionaries give the same dynamics (at most total_days): if they only differ in
+    policy dates (see policyDateNames), the earliest day on which one of the differing policies switches, otherwise 0
+    """
+    realStartDate = paramDict.get("realStartDate")
+    if realStartDate is None or np.ndim(realStartDate) > 0:
+        return 0
+    sameDates = OrderedDict(otherParamDict)
+    for name in policyDateNames:
+        if name in paramDict:
+            sameDates[name] = paramDict[name]
+        else:
+            sameDates.pop(name, None)
+    if checkpoint_paramHash(sameDates) != checkpoint_paramHash(paramDict):
+        return 0
+
+    day = total_days
+    for name in policyDateNames:
+        dates = [paramDict.get(name), otherParamDict.get(name)]
+        if paramHash(dates[0]) == paramHash(dates[1]):
+            continue
+        for date in dates:
+            if date is not None:
+                day = min(day, max(int(np.min(daysBetween(realStartDate, date))), 0))
+    return day
+
+
+def solveSystem_branches(stateTensor_init, total_days, paramDict, leaves, branchDays=None, samplesPerDay=np.inf, **solverKwargs):
+    """
+    Solve the system for a family of scenarios (leaves: dictionary of name -> parameter dictionary) that share their
+    first days with paramDict (or with each other), integrating the shared days only once.
+
+    A leaf with a branchDays[name] follows paramDict up to that day, and its own parameters from then on. Every other
+    leaf branches off paramDict, or off an earlier leaf, on the last day up to which they give the same dynamics
+    (see branch_day): e.g. leaves that only change tStopSocialDistancing share the days before the earliest of the
+    changed dates. Leaves that differ in anything else from the start are run in full.
+    Returns a dictionary of name -> the output of solveSystem for the leaf over total_days. As the integrator is
+    restarted on the branch days, the results agree with separate runs up to the integration tolerance.
+    solverKwargs (method, rtol, atol, jacobian, trackFlows) are passed on to solveSystem.
+    """
+    branchDays = branchDays or {}
+    names = list(leaves)
+
+    def firstDays(result, nDays):
+        if isinstance(result, tuple):  # (states, flows) of trackFlows
+            return tuple(firstDays(part, nDays) for part in result)
+        return result[..., :nDays]
+
+    def joinDays(prefix, result):
+        if isinstance(result, tuple):
+            return tuple(joinDays(*parts) for parts in zip(prefix, result))
+        return np.concatenate([prefix, result], axis=-1)
+
+    # The tree: node 0 is paramDict, node i is leaf i - 1, which continues from node parents[i] on day startDays[i]
+    nodeParams = [paramDict] + [leaves[name] for name in names]
+    parents, startDays = [None], [0]
+    for node, name in enumerate(names, start=1):
+        if name in branchDays:
+            parent, day = 0, int(branchDays[name])
+            if not 0 <= day <= total_days:
+                raise ValueError(f"solveSystem_branches: the branch day of {name} must be in [0, {total_days}], got {day}")
+        else:
+            parent, day = 0, branch_day(paramDict, nodeParams[node], total_days)
+            for other in range(1, node):
+                if names[other - 1] in branchDays:  # its parameters do not describe its first days
+                    continue
+                otherDay = branch_day(nodeParams[other], nodeParams[node], total_days)
+                if otherDay > max(day, startDays[other]):
+                    parent, day = other, otherDay
+        parents.append(parent)
+        startDays.append(day)
+
+    # paramDict itself is only run as far as its leaves need it
+    horizons = [max([0] + [day for node, day in zip(parents, startDays) if node == 0])] + [total_days] * len(names)
+    lastChild = OrderedDict((parent, node) for node, parent in enumerate(parents) if parent is not None)
+    nodeResults, nodeCheckpoints = [], []
+    for node, params in enumerate(nodeParams):
+        nodeCheckpoints.append(OrderedDict())
+        parent, day = parents[node], startDays[node]
+        if day == horizons[node]:  # nothing left to run (or paramDict not needed)
+            nodeResults.append(firstDays(nodeResults[parent], day) if node > 0 else None)
+            continue
+        result = solveSystem(
+            stateTensor_init,
+            horizons[node],
+            samplesPerDay=samplesPerDay,
+            checkpointDays=sorted(
+                set(start for other, start in zip(parents, startDays) if other == node and day < start < total_days)
+            ),
+            checkpointPath=nodeCheckpoints[node],
+            resumeFrom=nodeCheckpoints[parent][day] if day > 0 else None,
+            allowParameterChange=True,
+            **solverKwargs,
+            **params,
+        )
+        nodeResults.append(joinDays(firstDays(nodeResults[parent], day), result) if day > 0 else result)
+        if node > 0 and node == lastChild[parent]:  # the checkpoints of the parent are no longer needed
+            nodeCheckpoints[parent].clear()
+
+    return OrderedDict(zip(names, nodeResults[1:]))
+
+# ## Output tables
+#
+# The output has one row per (simDay, arrivalType, ageGroup, healthState), summed over the isolation and testing states,
+# sorted by these columns (the labels alphabetically)
+healthStateNames = ["susceptible", "exposed", "asymptomatic", "infected1", "infected2", "recovered1", "recovered2", "deceased"]
+arrivalTypes = ["current", "new"]
+isoStateNames = ["distancing", "quarantined", "hospitalized", "hospStaff"]
+testStateNames = ["neg_noTest", "pos_test", "pos_antibody", "pos_both"]
+
+
+def reduce_result(result):
+    """Sum a solveSystem output (... x nAge x nHS x nIso x nTest x days) over the isolation and testing states"""
+    return np.sum(result, axis=(-3, -2))
+
+
+def result_frame(reduced, ageGroups=ageGroups, startDate=None, firstDay=1):
+    """
+    Long format table of a reduced output (2 x nAge x nHS x days, see reduce_result).
+    simDay starts at firstDay; with a startDate the table starts with a timestamp column (startDate + simDay).
+    """
+    nArrival, nAgeOut, nHSOut, nDays = reduced.shape
+    arrivalOrder = np.argsort(arrivalTypes[:nArrival], kind="stable")
+    ageOrder = np.argsort(ageGroups, kind="stable")
+    hsOrder = np.argsort(healthStateNames[:nHSOut], kind="stable")
+    values = np.moveaxis(reduced, -1, 0)[:, arrivalOrder][:, :, ageOrder][:, :, :, hsOrder]
+
+    simDays = np.arange(firstDay, firstDay + nDays)
+    nPerDay = nArrival * nAgeOut * nHSOut
+    table = OrderedDict()
+    if startDate is not None:
+        table["timestamp"] = np.repeat(
+            (pd.Timestamp(startDate) + pd.to_timedelta(simDays, unit="D")).strftime("%Y-%m-%d").to_numpy(),
+            nPerDay,
+        )
+    table["simDay"] = np.repeat(simDays, nPerDay)
+    table["arrivalType"] = np.tile(np.repeat(np.asarray(arrivalTypes)[arrivalOrder], nAgeOut * nHSOut), nDays)
+    table["ageGroup"] = np.tile(np.repeat(np.asarray(ageGroups)[ageOrder], nHSOut), nDays * nArrival)
+    table["healthState"] = np.tile(np.asarray(healthStateNames)[hsOrder], nDays * nArrival * nAgeOut)
+    table["value"] = values.reshape(-1)
+    return pd.DataFrame(table)
+
+
+def flows_frame(flows, flowNames, ageGroups=ageGroups, startDate=None, firstDay=1):
+    """
+    Long format table of tracked flows (nFlows x nAge x days, see trackFlows), one row per (simDay, flow, ageGroup),
+    with the cumulative number of people as value. Columns as in result_frame.
+    """
+    nFlows, nAgeOut, nDays = flows.shape
+    ageOrder = np.argsort(ageGroups, kind="stable")
+    simDays = np.arange(firstDay, firstDay + nDays)
+    table = OrderedDict()
+    if startDate is not None:
+        table["timestamp"] = np.repeat(
+            (pd.Timestamp(startDate) + pd.to_timedelta(simDays, unit="D")).strftime("%Y-%m-%d").to_numpy(),
+            nFlows * nAgeOut,
+        )
+    table["simDay"] = np.repeat(simDays, nFlows * nAgeOut)
+    table["flow"] = np.tile(np.repeat(np.asarray(flowNames), nAgeOut), nDays)
+    table["ageGroup"] = np.tile(np.asarray(ageGroups)[ageOrder], nDays * nFlows)
+    table["value"] = np.moveaxis(flows, -1, 0)[:, :, ageOrder].reshape(-1)
+    return pd.DataFrame(table)
+
+
+def write_result_csv(
+    path_or_buf, result, startDate, ageGroups=ageGroups, chunkDays=60, extraColumns=None, header=True, firstDay=1
+):
+    """
+    Write the long format table of a solveSystem output to a csv file, chunkDays days at a time.
+    extraColumns (name -> value) are prepended to every row; with header=False rows are appended to an existing file.
+    The first day of result is simDay firstDay (e.g. checkpoint day + 1 for a run resumed from a checkpoint).
+    """
+    reduced = reduce_result(result)
+    with (open(path_or_buf, "w" if header else "a", newline="") if isinstance(path_or_buf, (str, os.PathLike)) else contextlib.nullcontext(path_or_buf)) as out:
+        for chunkStart in range(0, reduced.shape[-1], chunkDays):
+            df = result_frame(
+                reduced[..., chunkStart : chunkStart + chunkDays], ageGroups, startDate=startDate, firstDay=firstDay + chunkStart
+            )
+            for col, (name, value) in enumerate((extraColumns or {}).items()):
+                df.insert(col, name, value)
+            df.to_csv(out, header=header and chunkStart == 0, index=False)
+
+
+# Formats of the results table, by file extension (parquet and feather need pyarrow), any other extension is csv
+tableFormats = {".csv": "csv", ".parquet": "parquet", ".feather": "feather", ".arrow": "feather"}
+# Formats of the full output tensor: .npy can be memory mapped, .npz is compressed
+tensorFormats = [".npy", ".npz"]
+# Packages of which one is needed to write each table format
+tableFormatPackages = {"parquet": ["pyarrow", "fastparquet"], "feather": ["pyarrow"]}
+
+
+def result_format(path):
+    """Format written for path: "tensor" (see tensorFormats), or a table format (see tableFormats, csv by default)"""
+    ext = os.path.splitext(os.fspath(path))[1].lower()
+    if ext in tensorFormats:
+        return "tensor"
+    return tableFormats.get(ext, "csv")
+
+
+def check_result_format(path):
+    """Raise an ImportError if the format of path (see result_format) needs a package that is not installed"""
+    fmt = result_format(path)
+    packages = tableFormatPackages.get(fmt, [])
+    if packages and not any(importlib.util.find_spec(package) is not None for package in packages):
+        raise ImportError(f"writing {fmt} files ({path}) needs {' or '.join(packages)}")
+
+
+def write_result_table(path, result, startDate, ageGroups=ageGroups, firstDay=1):
+    """Write the long format results table, in the format given by the extension of path (see tableFormats, csv by default)"""
+    fmt = result_format(path)
+    if fmt == "tensor":
+        raise ValueError(f"write_result_table: {path} is a tensor format, the full output is saved by save_result_tensor")
+    if fmt == "csv":
+        return write_result_csv(path, result, startDate, ageGroups=ageGroups, firstDay=firstDay)
+    df = result_frame(reduce_result(result), ageGroups, startDate=startDate, firstDay=firstDay)
+    # Stored dictionary encoded
+    df = df.astype({col: "category" for col in ["timestamp", "arrivalType", "ageGroup", "healthState"]})
+    try:
+        if fmt == "parquet":
+            df.to_parquet(path, index=False)
+        else:
+            df.to_feather(path)
+    except ImportError as err:
+        raise ImportError(f"write_result_table: writing {fmt} files needs pyarrow ({err})") from err
+
+
+def result_axes(result, startDate, ageGroups=ageGroups, firstDay=1):
+    """Description of the axes of a solveSystem output (2 x nAge x nHS x nIso x nTest x days)"""
+    return OrderedDict([
+        ("axes", ["arrivalType", "ageGroup", "healthState", "isoState", "testState", "simDay"]),
+        ("shape", list(result.shape)),
+        ("dtype", np.dtype(result.dtype).str),
+        ("labels", OrderedDict([
+            ("arrivalType", arrivalTypes),
+            ("ageGroup", list(ageGroups)),
+            ("healthState", healthStateNames),
+            ("isoState", isoStateNames),
+            ("testState", testStateNames),
+        ])),
+        ("firstSimDay", int(firstDay)),
+        ("startDate", str(pd.Timestamp(startDate).date())),
+    ])
+
+
+def save_result_tensor(path, result, startDate, ageGroups=ageGroups, firstDay=1):
+    """
+    Save the full solveSystem output to path (.npy or .npz), with a json sidecar (path + ".json") describing the axes.
+    Returns the sidecar path.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in tensorFormats:
+        raise ValueError(f"save_result_tensor: unknown tensor format {path}, expected one of {tensorFormats}")
+    result = np.asarray(result)
+    if ext == ".npy":
+        np.save(path, result)
+    else:
+        np.savez_compressed(path, result=result)
+    sidecar = path + ".json"
+    with open(sidecar, "w") as jf:
+        json.dump(result_axes(result, startDate, ageGroups, firstDay=firstDay), jf, indent=2)
+    return sidecar
+
+
+def load_result_tensor(path, mmap_mode="r"):
+    """
+    Open an output saved by save_result_tensor. Returns (result, axes) with axes the content of the json sidecar.
+    .npy files are memory mapped (mmap_mode, None reads the whole file); .npz files are always read into memory.
+    """
+    with open(path + ".json") as jf:
+        axes = json.load(jf, object_pairs_hook=OrderedDict)
+    if os.path.splitext(path)[1].lower() == ".npz":
+        with np.load(path) as npz:
+            result = npz["result"]
+    else:
+        result = np.load(path, mmap_mode=mmap_mode)
+    if list(result.shape) != axes["shape"]:
+        raise ValueError(f"load_result_tensor: {path} has shape {result.shape}, its sidecar says {axes['shape']}")
+    return result, axes
+
+
+def read_result_table(path, **kwargs):
+    """Read a results table written by write_result_table (parquet, feather, otherwise csv)"""
+    fmt = result_format(path)
+    if fmt == "tensor":
+        raise ValueError(f"read_result_table: {path} is a tensor format, the full output is opened by load_result_tensor")
+    if fmt == "parquet":
+        return pd.read_parquet(path, **kwargs)
+    if fmt == "feather":
+        return pd.read_feather(path, **kwargs)
+    return pd.read_csv(path, **kwargs)
+
 ### df Clean up for folding on all states except Health States
-def array_to_df(total_days, result):
-    
-    reshape = 2*nAge*nHS*nIso*nTest*total_days
-    sim_days = [x+1 for x in range(total_days)]
-
-    iterables=[['current','new'],
-               ["0-9","10-19","20-29","30-39","40-49","50-59","60-69","70-79","80+"],
-               ["susceptible", "exposed", "asymptomatic", "infected1", "infected2", "recovered1", "recovered2", "deceased"],
-               ['distancing','quarantined','hospitalized','hospStaff'],
-               ["neg_noTest", "pos_test","pos_antibody", "pos_both"],
-               sim_days
-          ]
-    index = pd.MultiIndex.from_product(iterables, names=['arrivalType','ageGroup','healthState','isoState','testState','simDay'])
-
-    df = pd.DataFrame(result.reshape(reshape, 1),index=index).stack().reset_index().rename(columns={0: "value"})
-
-    #delete phantom column "level_6"
-    for col in df.columns.to_list():
-        if "level" in col:
-            del df[col]
-    
-    df = df.groupby(['simDay','arrivalType', 'ageGroup', 'healthState',], as_index=False)["value"].sum()
-    
-    return df
+def array_to_df(total_days, result, ageGroups=ageGroups):
+    return result_frame(
+        reduce_result(np.reshape(result, (2, len(ageGroups), nHS, nIso, nTest, total_days))),
+        ageGroups,
+    )
 
 # convert int simday to datetime
 def num_to_date(testingStartDate, simDay):
     temp_date = testingStartDate + timedelta(days=simDay)
     return str(temp_date.date())
 
-# call num_to_date and reorder columns
-def clean_df(df):
-    df['timestamp'] = df.simDay.apply(lambda x: num_to_date(testingStartDate, x)) 
-
-    ts = df['timestamp']
-    df.drop(labels=['timestamp'], axis=1,inplace = True)
+# add the timestamps and reorder columns
+def clean_df(df, testingStartDate):
+    ts = (pd.Timestamp(testingStartDate) + pd.to_timedelta(df["simDay"], unit="D")).dt.strftime("%Y-%m-%d")
     df.insert(0, 'timestamp', ts)
 
     return df    
 
-if __name__ == "__main__":
+
+# ## Model inputs
+class CoexistModel:
+    """
+    The input data of a model instantiation (SME parameters, user parameters and social mixing matrices),
+    and everything derived from them: the initial state tensor and the data-dependent default parameters.
+
+    Build it from an input directory containing sme_input.json, user_input.json,
+    social_mixing_BASELINE.csv and social_mixing_DISTANCE.csv, and / or from already loaded inputs
+    (any input passed explicitly takes precedence over the file). Nothing is read until first use,
+    so a single process can hold a model and run many simulations with it.
+    """
+
+    def __init__(
+        self,
+        data_dir=None,
+        sme_input=None,  # dict, same format as sme_input.json
+        user_input=None,  # dict, same format as user_input.json
+        socialMixingBaseline=None,  # nAge x nAge array, or DataFrame in the format of social_mixing_BASELINE.csv
+        socialMixingDistancing=None,  # nAge x nAge array, or DataFrame in the format of social_mixing_DISTANCE.csv
+    ):
+        if data_dir is None and any(
+            inp is None
+            for inp in [sme_input, user_input, socialMixingBaseline, socialMixingDistancing]
+        ):
+            raise ValueError(
+                "CoexistModel needs either a data_dir, or all of sme_input, user_input and the social mixing matrices"
+            )
+        self.data_dir = data_dir
+        self._sme_input = sme_input
+        self._user_input = user_input
+        self._socialMixingBaseline = socialMixingBaseline
+        self._socialMixingDistancing = socialMixingDistancing
+        self._inputs = None
+
+    @classmethod
+    def from_inputs(cls, inputs):
+        """A model around an already derived inputs dictionary (see inputs), e.g. one shared between processes"""
+        model = cls(
+            sme_input=inputs["sme_input"],
+            user_input=inputs["user_input"],
+            socialMixingBaseline=inputs["ageSocialMixingBaseline"],
+            socialMixingDistancing=inputs["ageSocialMixingDistancing"],
+        )
+        model._inputs = inputs
+        return model
+
+    def __repr__(self):
+        return f"CoexistModel(data_dir={self.data_dir!r}, loaded={self._inputs is not None})"
+
+    @property
+    def inputs(self):
+        """Dictionary of all input-derived values, keyed by the parameter names used in the model functions"""
+        if self._inputs is None:
+            self._inputs = self._load()
+        return self._inputs
+
+    @property
+    def stateTensor_init(self):
+        return self.inputs["stateTensor_init"]
+
+    @property
+    def testingStartDate(self):
+        return self.inputs["testingStartDate"]
+
+    @property
+    def ageGroups(self):
+        return self.inputs["ageGroups"]
+
+    def _read_json(self, fname):
+        with open(os.path.join(self.data_dir, fname)) as jf:
+            return json.load(jf)
+
+    def _read_mixing(self, inp, fname, argName):
+        # source of the matrix, for the error messages
+        source = fname if inp is None else argName
+        if inp is None:
+            inp = pd.read_csv(os.path.join(self.data_dir, fname), sep=",")
+        labels = None
+        if isinstance(inp, pd.DataFrame):
+            # The first column has the age group labels, if any (e.g. mixing_data/zimbabwe.csv has none)
+            if not pd.api.types.is_numeric_dtype(inp.iloc[:, 0]):
+                labels = inp.iloc[:, 0].astype(str).tolist()
+                inp = inp.iloc[:, 1:]
+            inp = inp.values
+        inp = np.asarray(inp, dtype=float)
+        if np.isnan(inp).any():
+            missingRows = np.flatnonzero(np.isnan(inp).any(axis=1))
+            raise ValueError(
+                f"CoexistModel: the social mixing matrix {source} has missing values in rows "
+                f"{[labels[row] if labels else int(row) for row in missingRows]} "
+                "(mixing_data/zambia.csv and mixing_data/southAfrica.csv have an all-NA [0,9) row, fill it in before using them)"
+            )
+        return (inp + inp.T) / 2.0
+
+    def _load(self):
+        ############# Static Input Parameters#############  ref: "baked_in_parameters.ipynb"
+        sme_input = self._sme_input if self._sme_input is not None else self._read_json("sme_input.json")
+        user_input = self._user_input if self._user_input is not None else self._read_json("user_input.json")
+
+        inp = OrderedDict()
+        inp["sme_input"] = sme_input
+        inp["user_input"] = user_input
+
+        # Population by Age (0-9, 10-19, ... 70-79, 80+) ref: https://en.wikipedia.org/wiki/Demographics_of_Ethiopia "AGE STRUCTURE"
+        agePopulationTotal = np.array(sme_input["agePopulationTotal"])
+        agePopulationRatio = agePopulationTotal / np.sum(agePopulationTotal)
+        inp["agePopulationTotal"] = agePopulationTotal
+        inp["agePopulationRatio"] = agePopulationRatio
+        inp["nAge"] = len(agePopulationTotal)
+        inp["ageGroups"] = list(sme_input.get("age_group", ageGroups))
+
+        ## Social Mixing Matrices
+        # BASELINE and SOCIAL DISTANCING
+        ageSocialMixingBaseline = self._read_mixing(self._socialMixingBaseline, "social_mixing_BASELINE.csv", "socialMixingBaseline")
+        inp["ageSocialMixingBaseline"] = ageSocialMixingBaseline
+        inp["ageSocialMixingDistancing"] = self._read_mixing(self._socialMixingDistancing, "social_mixing_DISTANCE.csv", "socialMixingDistancing")
+
+        ### Hospitalization
+
+        # Hospitalization rate by age: mapped UK to ETH population (see "baked_in_parameters")
+        yearly_baseline_admissions = np.array(sme_input["yearly_baseline_admissions"])
+        ageHospitalisationRateBaseline = yearly_baseline_admissions / (365 * agePopulationTotal)
+        inp["ageHospitalisationRateBaseline"] = ageHospitalisationRateBaseline
+
+        # Average days in the hospital by age
+        ageHospitalMeanLengthOfStay = np.array(sme_input["ageHospitalMeanLengthOfStay"])
+        ageHospitalisationRecoveryRateBaseline = 1.0 / ageHospitalMeanLengthOfStay
+        inp["ageHospitalisationRecoveryRateBaseline"] = ageHospitalisationRecoveryRateBaseline
+
+        # Ratio of Hospital Staff by Age
+        ageNhsClinicalStaffPopulationRatio = np.array(sme_input["ageNhsClinicalStaffPopulationRatio"])
+        inp["ageNhsClinicalStaffPopulationRatio"] = ageNhsClinicalStaffPopulationRatio
+
+        # Rate of transmission given contact for differnt states [exposed, asymptomatic, I1 (symptomatic early), I2 (symptomatic late)]
+        inp["transmissionInfectionStage"] = np.array(sme_input["transmissionInfectionStage"])
+
+        ############# USER INPUT PARAMETERS ############# from "USER_build_data.ipynb"
+
+        # Number of Days in Isolation
+        inp["nDaysInHomeIsolation"] = user_input["nDaysInHomeIsolation"]
+
+        for dateName in [
+            "tStartSocialDistancing",
+            "tStopSocialDistancing",
+            "tStartImmunityPassports",
+            "tStopImmunityPassports",
+            "tStartQuarantineCaseIsolation",
+            "tStopQuarantineCaseIsolation",
+        ]:
+            inp[dateName] = pd.to_datetime(user_input[dateName], format="%Y-%m-%d")
+        inp["CONST_DATA_START_DATE"] = user_input["CONST_DATA_START_DATE"]
+        inp["CONST_DATA_CUTOFF_DATE"] = user_input["CONST_DATA_CUTOFF_DATE"]
+
+        # Risk of Admission by age
+        totalCOVIDAdmitted_byAge_regroup = user_input["percent_admitted"] * agePopulationTotal
+        relativeAdmissionRisk_given_COVID_by_age = (totalCOVIDAdmitted_byAge_regroup / agePopulationTotal)
+        relativeAdmissionRisk_given_COVID_by_age /= np.mean(relativeAdmissionRisk_given_COVID_by_age)
+        relativeAdmissionRisk_given_COVID_by_age -= 1
+        inp["relativeAdmissionRisk_given_COVID_by_age"] = relativeAdmissionRisk_given_COVID_by_age
+
+        # Risk of Death by Age
+        totalDeaths_byAge_regroupLinear = user_input["deaths_by_age"]
+        relativeDeathRisk_given_COVID_by_age = (totalDeaths_byAge_regroupLinear / agePopulationTotal)
+        relativeDeathRisk_given_COVID_by_age /= np.mean(relativeDeathRisk_given_COVID_by_age)
+        relativeDeathRisk_given_COVID_by_age -= 1
+        inp["relativeDeathRisk_given_COVID_by_age"] = relativeDeathRisk_given_COVID_by_age
+
+        # Death Rate by Age
+        inp["caseFatalityRatioHospital_given_COVID_by_age"] = (totalDeaths_byAge_regroupLinear / totalCOVIDAdmitted_byAge_regroup)
+
+        # ageRelativeRecoverySpeed = np.array([0.2]*5+[-0.1, -0.2, -0.3, -0.5]) # TODO - this is a guess, find data and fix
+        inp["ageRelativeRecoverySpeed"] = np.zeros(len(agePopulationTotal))  # For now we make it same for everyone, makes calculations easier
+
+        # Social Mixing WHILE Isolating (rule-breakers)
+        inp["percent_not_isolating"] = np.array(user_input["percent_not_isolating"])
+
+        # ageSocialMixingIsolation = percent_isolating_mat*ageSocialMixingDistancing
+        inp["ageSocialMixingIsolation"] = np.zeros_like(ageSocialMixingBaseline)  # OR PERFECT ISOLATION
+
+        # Getting Infected in the Hospital
+        inp["withinHospitalSocialMixing"] = elevatedMixingRatioInHospital * np.sum(np.dot(agePopulationRatio, ageSocialMixingBaseline))
+
+        # Calculate initial hospitalisation (occupancy), that will be used to initialise the model
+        initBaselineHospitalOccupancyEquilibriumAgeRatio = ageHospitalisationRateBaseline / (ageHospitalisationRateBaseline + ageHospitalisationRecoveryRateBaseline)
+
+        # Extra rate of hospitalisation due to COVID-19 infection stages; Symptom to hospitalisation is 5.76 days on average (Imperial #8)
+        inp["infToHospitalExtra"] = np.array(sme_input["infToHospitalExtra"])
+
+        # We do know at least how age affects these risks:
+        # For calculations see data_cleaning_py.ipynb, calculations from CHESS dataset as per 05 Apr
+        riskOfAEAttandance_by_age = np.array(sme_input["riskOfAEAttandance_by_age"])
+        inp["riskOfAEAttandance_by_age"] = riskOfAEAttandance_by_age
+        inp["ageRelativeExtraAdmissionRiskToCovid"] = relativeAdmissionRisk_given_COVID_by_age * riskOfAEAttandance_by_age
+
+        # On average this many people get hospitalised (compared to home isolation), but modulated by age (TODO: values > 1? clip for now..)
+        inp["symptomHospitalisedRate_ageAdjusted"] = np.clip(
+            adjustRatesByAge_KeepAverageRate(
+                0.3,
+                ageRelativeAdjustment=relativeAdmissionRisk_given_COVID_by_age,
+                agePopulationRatio=agePopulationRatio,
+            ),
+            0.0,
+            1.0,
+        )
+
+        testingStartDate = pd.to_datetime(user_input["testingStartDate"], format="%Y-%m-%d")
+        inp["testingStartDate"] = testingStartDate
+        inp["realStartDate"] = testingStartDate
+        inp["df_CHESS_numTests_regroup"] = pd.DataFrame({testingStartDate: sme_input["ageTestingData"]}).T
+        inp["realTestData"] = inp["df_CHESS_numTests_regroup"]
+
+        # ## Initialise the model
+
+        # Initialise state
+        stateTensor_init = np.zeros((len(agePopulationTotal), nHS, nIso, nTest))
+        # Populate
+        stateTensor_init[:, 0, 0, 0] = agePopulationTotal
+        # Move hospital staff to working in hospital
+        stateTensor_init[:, 0, 0, 0] -= ageNhsClinicalStaffPopulationRatio * agePopulationTotal
+        stateTensor_init[:, 0, 3, 0] += ageNhsClinicalStaffPopulationRatio * agePopulationTotal
+        # Move people to hospital according to baseline occupation (move only from normal people, not hospital staff!)
+        stateTensor_init[:, 0, 2, 0] += (
+            initBaselineHospitalOccupancyEquilibriumAgeRatio * stateTensor_init[:, 0, 0, 0]
+        )
+        stateTensor_init[:, 0, 0, 0] -= (
+            initBaselineHospitalOccupancyEquilibriumAgeRatio * stateTensor_init[:, 0, 0, 0]
+        )
+        inp["stateTensor_init"] = stateTensor_init
+
+        return inp
+
+    def build_paramDict(self, cur_func=None):
+        """
+        The default parameter dictionary of cur_func (dydt_Complete by default, see build_paramDict),
+        with every parameter that is derived from the inputs filled in from this model
+        """
+        paramDict = build_paramDict(dydt_Complete if cur_func is None else cur_func)
+
+        def fillRecurse(cur_dict):
+            for key, value in cur_dict.items():
+                if key.endswith("_params"):
+                    fillRecurse(value)
+                elif key in self.inputs:
+                    cur_dict[key] = copy.deepcopy(self.inputs[key])
+
+        fillRecurse(paramDict)
+        return paramDict
+
+    def run(self, total_days, paramDict=None, **kwargs):
+        """Solve the system for total_days, with the default parameters of this model or the given paramDict"""
+        if paramDict is None:
+            paramDict = self.build_paramDict()
+        return solveSystem(self.stateTensor_init, total_days, **paramDict, **kwargs)
+
+    def run_ensemble(self, total_days, paramDicts, stateTensor_init=None, **kwargs):
+        """
+        Solve the system for a list of parameter dictionaries in a single batched integration (see solveSystem_ensemble).
+        The result of scenario i is result[i], in the same format as the output of run.
+        """
+        return solveSystem_ensemble(
+            self.stateTensor_init if stateTensor_init is None else stateTensor_init,
+            total_days,
+            paramDicts,
+            **kwargs,
+        )
+
+    def run_branches(self, total_days, leaves, paramDict=None, branchDays=None, **kwargs):
+        """
+        Solve the system for a family of scenarios that share their first days with paramDict (default parameters of this
+        model if None), integrating the shared days only once (see solveSystem_branches). Returns name -> result.
+        """
+        if paramDict is None:
+            paramDict = self.build_paramDict()
+        return solveSystem_branches(self.stateTensor_init, total_days, paramDict, leaves, branchDays=branchDays, **kwargs)
+
+    def read_travelImportedCases(self, path):
+        """Daily imported infections for the travelImportedCases parameter, see read_travelImportedCases"""
+        return read_travelImportedCases(path, self.inputs["agePopulationRatio"], ageGroups=self.ageGroups)
+
+    def results_df(self, result, firstDay=1):
+        """Long format results table (see Output Description in the README)"""
+        return result_frame(
+            reduce_result(result), self.ageGroups, startDate=self.testingStartDate, firstDay=firstDay
+        )
+
+    def flows_df(self, flows, flowNames, firstDay=1):
+        """Long format table of the flows returned by run with trackFlows (see flows_frame)"""
+        return flows_frame(flows, flowNames, self.ageGroups, startDate=self.testingStartDate, firstDay=firstDay)
+
+    def branches_df(self, results, firstDay=1):
+        """Results tables of the scenarios returned by run_branches, concatenated with a leading scenario column"""
+        dfs = []
+        for name, result in results.items():
+            df = self.results_df(result, firstDay=firstDay)
+            df.insert(0, "scenario", name)
+            dfs.append(df)
+        return pd.concat(dfs, ignore_index=True)
+
+    def write_results(self, result, path_or_buf, firstDay=1, **kwargs):
+        """
+        Write the results, in the format given by the file extension: the full output tensor for .npy/.npz (see save_result_tensor),
+        otherwise the long format results table (see write_result_table, csv files and buffers are written by write_result_csv)
+        """
+        fmt = result_format(path_or_buf) if isinstance(path_or_buf, (str, os.PathLike)) else "csv"
+        if fmt == "tensor":
+            save_result_tensor(
+                os.fspath(path_or_buf), result, self.testingStartDate, ageGroups=self.ageGroups, firstDay=firstDay
+            )
+        elif fmt == "csv":
+            write_result_csv(
+                path_or_buf, result, self.testingStartDate, ageGroups=self.ageGroups, firstDay=firstDay, **kwargs
+            )
+        else:
+            write_result_table(
+                os.fspath(path_or_buf), result, self.testingStartDate, ageGroups=self.ageGroups, firstDay=firstDay
+            )
+
+
+class Metapopulation:
+    """
+    Several regions, each a CoexistModel with its own inputs (population, mixing matrices, policy dates, ...),
+    integrated as one system whose new infections are coupled by regionCoupling (see solveSystem_metapopulation).
+    Without a coupling the regions are independent (the identity coupling).
+    The regions have to share the age groups and the testing start date.
+    """
+
+    def __init__(self, regions, regionCoupling=None):
+        # regions: dictionary of region name -> CoexistModel, or a list of CoexistModels
+        if not isinstance(regions, dict):
+            regions = OrderedDict((f"region{ii}", model) for ii, model in enumerate(regions))
+        self.regions = OrderedDict(regions)
+        self.regionCoupling = (
+            sparse.identity(len(self.regions), format="csr") if regionCoupling is None else regionCoupling
+        )
+
+    def __repr__(self):
+        return f"Metapopulation(regions={list(self.regions)!r})"
+
+    @property
+    def regionNames(self):
+        return list(self.regions)
+
+    @property
+    def stateTensor_init(self):
+        return np.stack([model.stateTensor_init for model in self.regions.values()], axis=0)
+
+    def build_paramDicts(self):
+        """Default parameters of every region, see CoexistModel.build_paramDict"""
+        return [model.build_paramDict() for model in self.regions.values()]
+
+    def run(self, total_days, paramDicts=None, **kwargs):
+        """Solve the coupled system for total_days, with the default parameters of the regions or the given paramDicts"""
+        if paramDicts is None:
+            paramDicts = self.build_paramDicts()
+        return solveSystem_metapopulation(
+            [model.stateTensor_init for model in self.regions.values()],
+            total_days,
+            paramDicts,
+            self.regionCoupling,
+            **kwargs,
+        )
+
+    def results_df(self, result, firstDay=1):
+        """Results tables of the regions (see CoexistModel.results_df), concatenated with a leading region column"""
+        dfs = []
+        for (regionName, model), regionResult in zip(self.regions.items(), result):
+            df = model.results_df(regionResult, firstDay=firstDay)
+            df.insert(0, "region", regionName)
+            dfs.append(df)
+        return pd.concat(dfs, ignore_index=True)
+
+
+# Legacy module level access to the inputs (e.g. coexist.stateTensor_init), read from the working directory on first use
+_defaultModel = None
+
+
+def __getattr__(name):
+    global _defaultModel
+    if name.startswith("__"):
+        raise AttributeError(name)
+    if _defaultModel is None:
+        _defaultModel = CoexistModel(os.path.join(os.getcwd(), data_folder))
+    if name in _defaultModel.inputs:
+        return _defaultModel.inputs[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def main(argv=None):
+    ################### COMMAND LINE ARGS
+    parser = argparse.ArgumentParser(description="Get number of days to run simulation")
+    parser.add_argument("-days", dest="total_days", type=int, help="Number of days to run simulation")
+    parser.add_argument("-out", dest="outfile", type=str, help="Name of output file, its extension sets the format: .parquet, .feather, .npy/.npz for the full output tensor, otherwise csv")
+    parser.add_argument("-method", dest="method", type=str, default="RK23", help="Integrator, e.g. RK23 (default) or BDF (implicit, with analytic Jacobian)")
+    parser.add_argument("-report", dest="report", action="store_true", help="Write the solver statistics of the run to results/<out>.report.json")
+    parser.add_argument("-profile", dest="profile", action="store_true", help="Also time the stages of the right hand side (implies -report), and write a cProfile dump next to the run report")
+    parser.add_argument("-checkpoint", dest="checkpoint", type=str, default="", help="Comma separated days at which to save a checkpoint, e.g. 90,180 (results/<out>.day<d>.checkpoint.npz)")
+    parser.add_argument("-resume", dest="resume", type=str, default=None, help="Checkpoint (in results/) to continue from, only the days after it are computed")
+    parser.add_argument("-append", dest="append", action="store_true", help="Append the resumed days to an existing csv output instead of overwriting it")
+    parser.add_argument("-cache", dest="cache", type=str, nargs="?", const="results/cache", default=None, help="Reuse the stored result of an identical run, from this directory (default results/cache)")
+    parser.add_argument("-cacheSize", dest="cacheSize", type=float, default=1024, help="Size (MB) above which the least recently used cached results are deleted")
+
+    args = parser.parse_args(argv)
+
+    total_days = args.total_days
+    outfile = args.outfile
+
+    # The output format is checked before the run, not after it
+    if args.append and result_format(outfile) != "csv":
+        parser.error("-append is only supported for csv outputs")
+    try:
+        check_result_format(outfile)
+    except ImportError as err:
+        parser.error(str(err))
+
+    # Set Working/Data dirs
+    workdir = os.getcwd()
+    data_dir = f"{workdir}/{data_folder}"
 
     print("\n")
     start_it = datetime.now()
     print(f"Started at {start_it}")
     print("Running model...")
 
-    # # Build a dictionary out of arguments with defaults
-    paramDict_default = build_paramDict(dydt_Complete)
-    paramDict_default["dydt_Complete"] = dydt_Complete
-    paramDict_default["INIT_stateTensor_init"] = stateTensor_init
-
-    paramDict_current = copy.deepcopy(paramDict_default)
+    model = CoexistModel(data_dir)
 
-    result = solveSystem(stateTensor_init, total_days, **paramDict_current)
-
-    df = clean_df(array_to_df(total_days, result))
+    # # Build a dictionary out of arguments with defaults
+    paramDict_current = model.build_paramDict()
+
+    # The solver statistics are only collected for the report, the stage timings only with -profile
+    profile = RunProfile(timeStages=args.profile) if args.report or args.profile else None
+    reportStem = f"{workdir}/results/{os.path.splitext(outfile)[0]}"
+
+    # Checkpoints of the run, and the checkpoint it continues from
+    runKwargs = dict(method=args.method, profile=profile, progress=print_progress)
+    if args.cache is not None:
+        runKwargs["cache"] = ResultCache(os.path.join(workdir, args.cache), maxBytes=args.cacheSize * 2**20)
+    if args.checkpoint:
+        runKwargs["checkpointDays"] = [int(day) for day in args.checkpoint.split(",")]
+        runKwargs["checkpointPath"] = reportStem + ".day{day}.checkpoint.npz"
+    firstDay = 1
+    if args.resume is not None:
+        runKwargs["resumeFrom"] = load_checkpoint(f"{workdir}/results/{args.resume}")
+        firstDay = runKwargs["resumeFrom"]["day"] + 1
+
+    if args.profile:
+        profiler = cProfile.Profile()
+        result = profiler.runcall(model.run, total_days, paramDict_current, **runKwargs)
+        profiler.dump_stats(f"{reportStem}.pstats")
+    else:
+        result = model.run(total_days, paramDict_current, **runKwargs)
 
-    print(df.tail())
-    df.to_csv(f"{workdir}/results/{outfile}", index=False)
+    print(model.results_df(result[..., -1:], firstDay=firstDay + result.shape[-1] - 1).tail())
+    if args.append:
+        model.write_results(result, f"{workdir}/results/{outfile}", firstDay=firstDay, header=False)
+    else:
+        model.write_results(result, f"{workdir}/results/{outfile}", firstDay=firstDay)
     
     end_it = datetime.now()
+    if profile is not None:
+        profile.write(
+            f"{reportStem}.report.json",
+            total_days=total_days,
+            firstDay=firstDay,
+            method=args.method,
+            cached=args.cache is not None and runKwargs["cache"].hits > 0,
+            outfile=outfile,
+            runtime=(end_it - start_it).total_seconds(),
+        )
     print(f"Runtime = {end_it-start_it}")
     print("\n")
     print(f"Results written to {workdir}/results/{outfile}")
     print("\n")
 
 
-
+if __name__ == "__main__":
+    main()
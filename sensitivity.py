@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+
+"""
+Global sensitivity analysis: Sobol indices (Saltelli design) or Morris elementary effects of scalar outputs of a run
+(peak hospital occupancy, cumulative deaths, ...) with respect to parameters of the flattened parameter tree.
+
+################### COMMAND LINE RUN
+# $ python3 sensitivity.py -list                                     # the numeric parameters and their default values
+# $ python3 sensitivity.py -days=180 -spec=sensitivity.json -out=sensitivity.csv -workers=4 -batch=16
+#
+# sensitivity.json gives the varied parameters, named as the columns of paramDict_toTable(build_paramDict(dydt_Complete)),
+# with their ranges (as the fitted parameters of calibrate.py: mode "value", "scale" or "shift", "index", "log"),
+# and the analysis:
+#     {"parameters": {
+#         "trFunc_newInfections_params_transmissionInfectionStage": {"mode": "scale", "bounds": [0.5, 2.0]},
+#         "trFunc_diseaseProgression_params_infect_to_symptoms": [3.0, 8.0],
+#         "tStartSocialDistancing": {"mode": "shift", "bounds": [-14, 14]}},
+#      "method": "sobol", "samples": 256,
+#      "outputs": ["peakHospitalOccupancy", "cumulativeDeaths"]}
+# method "sobol" runs samples x (nParameters + 2) simulations, "morris" runs samples (trajectories) x (nParameters + 1),
+# on "levels" (default 4) grid levels. The outputs are the keys of sensitivityOutputs (default: all of them).
+#
+# The runs are integrated in batches (one ensemble each, see CoexistModel.run_ensemble) spread over a process pool
+# that shares the inputs (see sweep.SharedInputs). The indices are written as one row per (output, parameter).
+"""
+
+import argparse
+import copy
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import coexist
+import sweep
+from calibrate import CalibrationParameter, get_param
+
+try:
+    from scipy.stats import qmc  # scipy >= 1.7
+except ImportError:
+    qmc = None
+
+
+# ## Outputs
+def covidHospitalOccupancy(states):
+    """Infected (exposed, asymptomatic and symptomatic) people in hospital on every day (... x days)"""
+    return np.sum(states[..., 1 : (coexist.nI + 1), 2, :, :], axis=(-4, -3, -2))
+
+
+# Scalar outputs of a run, from its states (... x nAge x nHS x nIso x nTest x days)
+sensitivityOutputs = OrderedDict([
+    # Most infected patients in hospital (isolation state 2, the baseline non-COVID patients are not counted) on any day
+    ("peakHospitalOccupancy", lambda states: np.max(covidHospitalOccupancy(states), axis=-1)),
+    # Output day (simDay) of the peak hospital occupancy
+    ("peakHospitalDay", lambda states: np.argmax(covidHospitalOccupancy(states), axis=-1) + 1.0),
+    # Deceased (last health state) on the last day
+    ("cumulativeDeaths", lambda states: np.sum(states[..., -1, :, :, -1], axis=(-3, -2, -1))),
+    # Decrease of the susceptible population over the run
+    ("cumulativeInfections", lambda states: np.sum(states[..., 0, :, :, 0] - states[..., 0, :, :, -1], axis=(-3, -2, -1))),
+    # Most infected people (exposed, asymptomatic and symptomatic) on any day
+    ("peakInfected", lambda states: np.max(np.sum(states[..., 1 : (coexist.nI + 1), :, :, :], axis=(-5, -4, -3, -2)), axis=-1)),
+])
+
+
+def table_path(name):
+    """Dot separated paramDict path of a paramDict_toTable column name (see paramTable_toDict)"""
+    return name.replace("_params_", "_params.")
+
+
+class SensitivityAnalysis:
+    """
+    Scalar outputs (see sensitivityOutputs) of total_days long runs of a CoexistModel, as a function of the search
+    coordinates of the varied parameters (CalibrationParameters, named by their paramDict_toTable column).
+    Many samples are evaluated by batched runs, sharing everything else (and the caches of the static transitions).
+    """
+
+    def __init__(self, model, parameters, total_days, outputs=None, paramDict=None, solverKwargs=None):
+        self.model = model
+        self.names = list(parameters)
+        self.parameters = []
+        for name, spec in parameters.items():
+            spec = dict(spec) if isinstance(spec, dict) else {"bounds": spec}
+            self.parameters.append(CalibrationParameter(table_path(name), **spec))
+        self.outputs = list(sensitivityOutputs) if outputs is None else list(outputs)
+        unknown = [output for output in self.outputs if output not in sensitivityOutputs]
+        if unknown:
+            raise ValueError(f"sensitivity: unknown outputs {unknown}, use any of {list(sensitivityOutputs)}")
+        self.total_days = total_days
+        self.solverKwargs = dict(solverKwargs or {})
+        self.solverKwargs.pop("trackFlows", None)
+
+        # (a copy, the caller's paramDict is left as it is)
+        self.paramDict = model.build_paramDict() if paramDict is None else copy.copy(paramDict)
+        # Only the states are needed, not the second (newOnly) copy
+        self.paramDict["debugReturnNewPerDay"] = False
+        self.defaults = [copy.deepcopy(get_param(self.paramDict, param.path)) for param in self.parameters]
+
+    def analysis_args(self):
+        """Everything but the model, to rebuild the analysis in a worker process"""
+        return OrderedDict([
+            ("parameters", OrderedDict(
+                (name, {key: val for key, val in param.to_spec().items() if key != "path"})
+                for name, param in zip(self.names, self.parameters)
+            )),
+            ("total_days", self.total_days),
+            ("outputs", self.outputs),
+            ("paramDict", self.paramDict),
+            ("solverKwargs", self.solverKwargs),
+        ])
+
+    def search_coordinates(self, unitSamples):
+        """Search coordinates of samples in the unit cube (nSamples x nParameters)"""
+        lower, upper = np.array([param.searchBounds for param in self.parameters]).T
+        return lower + np.asarray(unitSamples) * (upper - lower)
+
+    def paramDict_for(self, x):
+        """Full parameter dictionary of the search coordinates x"""
+        paramDict = copy.deepcopy(self.paramDict)
+        for param, xi, default in zip(self.parameters, x, self.defaults):
+            param.apply(paramDict, xi, default)
+        return paramDict
+
+    def evaluate(self, X):
+        """Outputs (nSamples x nOutputs) of the samples (rows of X, search coordinates), NaN where the integration fails"""
+        X = np.atleast_2d(X)
+        try:
+            states = self.model.run_ensemble(self.total_days, [self.paramDict_for(x) for x in X], **self.solverKwargs)
+        except RuntimeError:
+            if len(X) == 1:
+                return np.full((1, len(self.outputs)), np.nan)
+            # A single failing sample would fail the whole batch, so evaluate them separately
+            return np.concatenate([self.evaluate(x) for x in X])
+        return np.stack([sensitivityOutputs[output](states) for output in self.outputs], axis=-1)
+
+
+# ## Sample designs
+# Both return samples in the unit cube (nRuns x nParameters), mapped to the parameter ranges by SensitivityAnalysis
+def sobol_design(nSamples, nParameters, seed=None):
+    """
+    Saltelli design: the base samples A, B (nSamples each, from a scrambled Sobol sequence if available),
+    and for every parameter i the samples AB_i (A with the column i of B), stacked as A, B, AB_0, ..., AB_{d-1}
+    """
+    if qmc is not None:
+        base = qmc.Sobol(d=2 * nParameters, scramble=True, seed=seed).random(nSamples)
+    else:
+        base = np.random.default_rng(seed).random((nSamples, 2 * nParameters))
+    A, B = base[:, :nParameters], base[:, nParameters:]
+    AB = np.repeat(A[None], nParameters, axis=0)
+    AB[np.arange(nParameters), :, np.arange(nParameters)] = B.T
+    return np.concatenate([A, B, AB.reshape(-1, nParameters)], axis=0)
+
+
+def morris_design(nTrajectories, nParameters, levels=4, seed=None):
+    """
+    Morris one-at-a-time trajectories: from a random start on the levels grid, every parameter is moved once
+    (in random order) by delta = levels / (2 (levels - 1)), in whichever direction stays in [0, 1] (random if both do).
+    Returns the samples (nTrajectories * (nParameters + 1) x nParameters), and the parameter moved in each step
+    of each trajectory (nTrajectories x nParameters).
+    """
+    rng = np.random.default_rng(seed)
+    delta = levels / (2.0 * (levels - 1))
+    grid = np.arange(levels) / (levels - 1.0)
+    start = rng.choice(grid, size=(nTrajectories, nParameters))
+    order = np.argsort(rng.random((nTrajectories, nParameters)), axis=1)
+    # every parameter is moved once, so it moves from its start value
+    startOfMoved = np.take_along_axis(start, order, axis=1)
+    upValid = startOfMoved + delta <= 1.0 + 1e-12
+    downValid = startOfMoved - delta >= -1e-12
+    steps = np.where(
+        upValid & downValid,
+        np.where(rng.random((nTrajectories, nParameters)) < 0.5, delta, -delta),
+        np.where(upValid, delta, -delta),
+    )
+
+    samples = np.repeat(start[:, None, :], nParameters + 1, axis=1)
+    for step in range(nParameters):
+        moved = np.zeros((nTrajectories, nParameters))
+        np.put_along_axis(moved, order[:, step : step + 1], steps[:, step : step + 1], axis=1)
+        samples[:, step + 1] = samples[:, step] + moved
+    return samples.reshape(-1, nParameters), order
+
+
+# ## Indices
+def sobol_indices(Y, nSamples, nParameters, nBootstrap=100, seed=None):
+    """
+    First order (Saltelli 2010) and total (Jansen) Sobol indices of the outputs Y (runs of sobol_design x nOutputs),
+    with the half width of their 95% bootstrap confidence intervals. Returns arrays of nParameters x nOutputs.
+    """
+    Y = np.asarray(Y, dtype=float)
+    fA, fB = Y[:nSamples], Y[nSamples : 2 * nSamples]
+    fAB = Y[2 * nSamples :].reshape(nParameters, nSamples, -1)
+
+    def indices(sample):
+        A, B, AB = fA[sample], fB[sample], fAB[:, sample]
+        # runs that failed are left out
+        valid = np.isfinite(A) & np.isfinite(B) & np.isfinite(AB)
+        variance = np.nanvar(np.concatenate([A, B]), axis=0)
+        nValid = np.maximum(np.sum(valid, axis=-2), 1)
+        firstOrder = np.sum(np.where(valid, B * (AB - A), 0.0), axis=-2) / nValid / variance
+        total = 0.5 * np.sum(np.where(valid, (A - AB) ** 2, 0.0), axis=-2) / nValid / variance
+        return firstOrder, total
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        S1, ST = indices(np.arange(nSamples))
+        rng = np.random.default_rng(seed)
+        boot = [indices(rng.integers(0, nSamples, nSamples)) for _ in range(nBootstrap)]
+    return OrderedDict([
+        ("S1", S1),
+        ("S1_conf", 1.96 * np.nanstd([b[0] for b in boot], axis=0)),
+        ("ST", ST),
+        ("ST_conf", 1.96 * np.nanstd([b[1] for b in boot], axis=0)),
+    ])
+
+
+def morris_indices(Y, X, order):
+    """
+    Mean (mu), mean absolute value (mu_star) and standard deviation (sigma) of the elementary effects
+    (output change per unit step of the search coordinate) of every parameter. Returns arrays of nParameters x nOutputs.
+    """
+    nTrajectories, nParameters = order.shape
+    Y = np.asarray(Y, dtype=float).reshape(nTrajectories, nParameters + 1, -1)
+    X = np.asarray(X).reshape(nTrajectories, nParameters + 1, nParameters)
+    # the moved search coordinate changes by the step times the width of its range
+    stepSize = np.take_along_axis(X[:, 1:] - X[:, :-1], order[:, :, None], axis=2)[..., 0]
+    effects = np.diff(Y, axis=1) / stepSize[..., None]
+    # back to the parameter order (nTrajectories x nParameters x nOutputs)
+    effects = np.take_along_axis(effects, np.argsort(order, axis=1)[..., None], axis=1)
+    with np.errstate(invalid="ignore"):
+        return OrderedDict([
+            ("mu", np.nanmean(effects, axis=0)),
+            ("mu_star", np.nanmean(np.abs(effects), axis=0)),
+            ("sigma", np.nanstd(effects, axis=0, ddof=1) if nTrajectories > 1 else np.full(effects.shape[1:], np.nan)),
+        ])
+
+
+def indices_table(indices, parameterNames, outputNames):
+    """Long format table of the indices: one row per (output, parameter), one column per index"""
+    table = OrderedDict([
+        ("output", np.repeat(outputNames, len(parameterNames))),
+        ("parameter", np.tile(parameterNames, len(outputNames))),
+    ])
+    for name, values in indices.items():
+        table[name] = np.asarray(values).T.reshape(-1)
+    return pd.DataFrame(table)
+
+
+# ## Parallel evaluation
+# State of each worker process, set up once by init_worker
+_workerAnalysis = None
+_workerBlocks = []
+
+
+def init_worker(arrays, other, analysisArgs):
+    global _workerAnalysis, _workerBlocks
+    inputs, _workerBlocks = sweep.SharedInputs.attach(arrays, other)
+    _workerAnalysis = SensitivityAnalysis(coexist.CoexistModel.from_inputs(inputs), **analysisArgs)
+
+
+def _evaluate_task(X):
+    return _workerAnalysis.evaluate(X)
+
+
+def evaluate_samples(analysis, X, batchSize=16, workers=1, progress=None):
+    """
+    Outputs of every sample (rows of X), in batches of batchSize samples (spread over a pool of workers processes).
+    progress is called with {"done", "total"} (numbers of runs) after every batch.
+    """
+    X = np.atleast_2d(X)
+    batches = [X[start : start + batchSize] for start in range(0, len(X), batchSize)]
+
+    def reportProgress(results):
+        if progress is not None:
+            progress(OrderedDict([("done", sum(len(res) for res in results)), ("total", len(X))]))
+
+    if workers == 1:
+        results = []
+        for batch in batches:
+            results.append(analysis.evaluate(batch))
+            reportProgress(results)
+        return np.concatenate(results)
+
+    results = []
+    with sweep.SharedInputs(analysis.model.inputs) as shared:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_worker,
+            initargs=(shared.arrays, shared.other, analysis.analysis_args()),
+        ) as executor:
+            for res in executor.map(_evaluate_task, batches):
+                results.append(res)
+                reportProgress(results)
+    return np.concatenate(results)
+
+
+def run_analysis(analysis, method="sobol", samples=64, levels=4, workers=1, batchSize=16, seed=None, progress=None):
+    """
+    Sample, run and analyse. Returns the indices table (see indices_table),
+    and the table of all runs (the varied parameter values, or multipliers, and the outputs).
+    progress is called as the runs complete (see evaluate_samples).
+    """
+    nParameters = len(analysis.parameters)
+    if method == "sobol":
+        unitSamples = sobol_design(samples, nParameters, seed=seed)
+    elif method == "morris":
+        unitSamples, order = morris_design(samples, nParameters, levels=levels, seed=seed)
+    else:
+        raise ValueError(f"sensitivity: unknown method {method}, use sobol or morris")
+
+    X = analysis.search_coordinates(unitSamples)
+    Y = evaluate_samples(analysis, X, batchSize=batchSize, workers=workers, progress=progress)
+
+    if method == "sobol":
+        indices = sobol_indices(Y, samples, nParameters, seed=seed)
+    else:
+        indices = morris_indices(Y, X, order)
+
+    runs = pd.DataFrame(
+        [[param.value(xi) for param, xi in zip(analysis.parameters, x)] for x in X], columns=analysis.names
+    )
+    for col, output in enumerate(analysis.outputs):
+        runs[output] = Y[:, col]
+    return indices_table(indices, analysis.names, analysis.outputs), runs
+
+
+def numeric_parameters(paramDict):
+    """Names and default values of the numeric entries of the flattened parameter tree (candidates for the analysis)"""
+    table = coexist.paramDict_toTable(paramDict)
+    rows = []
+    for name in table.columns:
+        value = table.at[0, name]
+        # realStartDate is shared by the runs of a batch (see coexist.stack_paramDicts)
+        if isinstance(value, (bool, np.bool_)) or name in ["nAge", "nHS", "nI", "nR", "nIso", "nTest", "realStartDate"]:
+            continue
+        if isinstance(value, (int, float, np.number, np.ndarray, pd.Timestamp)):
+            rows.append((name, value if np.ndim(value) == 0 else f"array {np.shape(value)}"))
+    return pd.DataFrame(rows, columns=["parameter", "default"])
+
+
+def main(argv=None):
+    ################### COMMAND LINE ARGS
+    parser = argparse.ArgumentParser(description="Run a global sensitivity analysis")
+    parser.add_argument("-days", dest="total_days", type=int, help="Number of days to run simulation")
+    parser.add_argument("-spec", dest="specfile", type=str, help="json file with the varied parameters and the analysis")
+    parser.add_argument("-out", dest="outfile", type=str, help="Name of output file (indices)")
+    parser.add_argument("-runs", dest="runsfile", type=str, default=None, help="Name of output file for the parameters and outputs of every run")
+    parser.add_argument("-workers", dest="workers", type=int, default=1, help="Number of worker processes (default: 1, in this process)")
+    parser.add_argument("-batch", dest="batch", type=int, default=16, help="Number of runs integrated together")
+    parser.add_argument("-seed", dest="seed", type=int, default=None, help="Random seed of the sample design")
+    parser.add_argument("-method", dest="method", type=str, default="RK23", help="Integrator, e.g. RK23 (default) or BDF")
+    parser.add_argument("-list", dest="list", action="store_true", help="List the numeric parameters and exit")
+
+    args = parser.parse_args(argv)
+
+    # Set Working/Data dirs
+    workdir = os.getcwd()
+    data_dir = f"{workdir}/{coexist.data_folder}"
+    model = coexist.CoexistModel(data_dir)
+
+    if args.list:
+        with pd.option_context("display.max_rows", None, "display.max_colwidth", None):
+            print(numeric_parameters(model.build_paramDict()).to_string(index=False))
+        return
+
+    with open(args.specfile) as jf:
+        spec = json.load(jf)
+
+    print("\n")
+    start_it = datetime.now()
+    print(f"Started at {start_it}")
+    print("Running sensitivity analysis...")
+
+    analysis = SensitivityAnalysis(
+        model,
+        spec["parameters"],
+        args.total_days,
+        outputs=spec.get("outputs"),
+        solverKwargs={"method": args.method},
+    )
+    table, runs = run_analysis(
+        analysis,
+        method=spec.get("method", "sobol"),
+        samples=spec.get("samples", 64),
+        levels=spec.get("levels", 4),
+        workers=args.workers,
+        batchSize=args.batch,
+        seed=args.seed,
+        progress=lambda event: print(f" Runs done: {event['done']} / {event['total']}", end="\r"),
+    )
+    table.to_csv(f"{workdir}/results/{args.outfile}", index=False)
+    if args.runsfile is not None:
+        runs.to_csv(f"{workdir}/results/{args.runsfile}", index=False)
+
+    end_it = datetime.now()
+    print(f"Runtime = {end_it-start_it}")
+    print("\n")
+    print(table.to_string(index=False))
+    print(f"Results of {len(runs)} runs written to {workdir}/results/{args.outfile}")
+    print("\n")
+
+
+if __name__ == "__main__":
+    main()
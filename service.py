@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+
+"""
+Simulation service: a local HTTP/JSON server that queues COEXIST runs and executes them on a pool of warm worker processes.
+
+################### COMMAND LINE RUN
+# $ python3 service.py -port=8080 -workers=2 -cache
+#
+# POST   /runs               {"days": 180, "overrides": {"user_input.nDaysInHomeIsolation": 10}}  ->  202 {"id": ..., "status": "queued", ...}
+# GET    /runs               the status of every job
+# GET    /runs/<id>          the status of a job: queued, running, done, failed (with the error) or cancelled
+# GET    /runs/<id>/events   the events of a job as a server-sent event stream (text/event-stream), until it is finished:
+#                            status changes, and the progress of the simulation (at most one event per simulated day)
+# GET    /runs/<id>/result   the results table as csv, ?format=json for a list of rows, ?format=npy for the full output tensor
+# DELETE /runs/<id>          cancel a queued job, or forget a finished one
+#
+# The overrides are those of sweep.py (paths of the input json files, or of the build_paramDict(dydt_Complete) tree),
+# and are checked when the run is submitted. The inputs are read once at startup, the workers get their arrays through
+# shared memory (see sweep.SharedInputs) and keep the imported, warmed up model, so a request only costs its simulation.
+# With -cache, the results of identical runs are reused (see coexist.ResultCache).
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import multiprocessing
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+import coexist
+import sweep
+
+
+# Formats of GET /runs/<id>/result
+resultFormats = OrderedDict([("csv", "text/csv"), ("json", "application/json"), ("npy", "application/octet-stream")])
+maxRequestBytes = 2**20
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+# ## Worker processes
+# State of each worker process, set up once by init_worker
+_workerCache = None
+_workerProgress = None
+
+
+def init_worker(arrays, other, cacheDir, progressQueue):
+    global _workerCache, _workerProgress
+    sweep.init_worker(arrays, other)
+    if cacheDir is not None:
+        _workerCache = coexist.ResultCache(cacheDir)
+    _workerProgress = progressQueue
+
+
+def _warm_task():
+    # A one day run fills the per process caches (static transitions, test specifications, travel tables)
+    sweep._workerModel.run(1)
+    return os.getpid()
+
+
+def _run_task(jobId, overrides, total_days):
+    inputOverrides, paramOverrides = sweep.split_overrides(overrides)
+    model = sweep.scenario_model(sweep._workerModel, inputOverrides)
+    paramDict = sweep.apply_paramOverrides(model.build_paramDict(), paramOverrides)
+    result = model.run(
+        total_days, paramDict, cache=_workerCache, progress=lambda event: _workerProgress.put((jobId, event))
+    )
+    return result, str(model.testingStartDate.date()), list(model.ageGroups)
+
+
+# ## Jobs
+class Job:
+    """A submitted run, with its status, its events (see emit) and, once done, its result"""
+
+    finishedStates = ["done", "failed", "cancelled"]
+
+    def __init__(self, total_days, overrides):
+        self.id = uuid.uuid4().hex[:12]
+        self.total_days = total_days
+        self.overrides = overrides
+        self.status = None
+        self.times = OrderedDict()  # status -> time it was entered
+        self.error = None
+        self.result = None  # (output of solveSystem, startDate, ageGroups)
+        self.events = []
+        self._waiters = set()
+        self.set_status("queued")
+
+    @property
+    def finished(self):
+        return self.status in self.finishedStates
+
+    def emit(self, event):
+        """Add an event (dictionary) and wake up the event streams"""
+        self.events.append(OrderedDict([("id", self.id), ("time", datetime.now().isoformat(timespec="milliseconds"))], **event))
+        for waiter in self._waiters:
+            waiter.set()
+
+    def set_status(self, status, **extra):
+        self.status = status
+        self.times[status] = datetime.now().isoformat(timespec="milliseconds")
+        self.emit(OrderedDict([("type", "status"), ("status", status)], **extra))
+
+    async def iter_events(self):
+        """Events of the job, the past ones first, until it is finished"""
+        sent = 0
+        while True:
+            while sent < len(self.events):
+                sent += 1
+                yield self.events[sent - 1]
+            if self.finished:
+                return
+            waiter = asyncio.Event()
+            self._waiters.add(waiter)
+            try:
+                await waiter.wait()
+            finally:
+                self._waiters.discard(waiter)
+
+    def describe(self):
+        return OrderedDict([
+            ("id", self.id),
+            ("status", self.status),
+            ("days", self.total_days),
+            ("overrides", self.overrides),
+            ("times", self.times),
+            ("error", self.error),
+            ("result", f"/runs/{self.id}/result" if self.status == "done" else None),
+        ])
+
+
+# ## Service
+class SimulationService:
+    """
+    Queue of jobs run by a pool of worker processes, each with the model of the inputs (and its caches) already set up.
+    At most keepJobs finished jobs (and their results) are kept, the oldest are forgotten first.
+    """
+
+    def __init__(self, model, workers=None, cacheDir=None, keepJobs=100):
+        self.model = model
+        self.workers = workers or os.cpu_count() or 1
+        self.cacheDir = cacheDir
+        self.keepJobs = keepJobs
+        self.jobs = OrderedDict()
+        self.queue = None
+        self.executor = None
+        self.shared = None
+        self.progressQueue = None
+        self.dispatchers = []
+
+    async def start(self):
+        """Start the worker processes (and wait until they are warmed up) and the dispatchers of the queue"""
+        loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.shared = sweep.SharedInputs(self.model.inputs)
+        # Progress events of the workers: (job id, event), None stops forward_progress
+        self.progressQueue = multiprocessing.Queue()
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=init_worker,
+            initargs=(self.shared.arrays, self.shared.other, self.cacheDir, self.progressQueue),
+        )
+        await asyncio.gather(*[loop.run_in_executor(self.executor, _warm_task) for _ in range(self.workers)])
+        self.dispatchers = [asyncio.ensure_future(self.dispatch()) for _ in range(self.workers)]
+        threading.Thread(target=self.forward_progress, args=(loop,), daemon=True).start()
+
+    def close(self):
+        for dispatcher in self.dispatchers:
+            dispatcher.cancel()
+        if self.progressQueue is not None:
+            self.progressQueue.put(None)
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        if self.shared is not None:
+            self.shared.close()
+
+    def submit(self, request):
+        """Check a run request ({"days": ..., "overrides": {...}}) and queue it. Returns the job"""
+        if not isinstance(request, dict):
+            raise HTTPError(400, "the request has to be a json object")
+        total_days = request.get("days")
+        if not isinstance(total_days, int) or isinstance(total_days, bool) or total_days < 1:
+            raise HTTPError(400, "days has to be a positive integer")
+        overrides = request.get("overrides", {})
+        if not isinstance(overrides, dict):
+            raise HTTPError(400, "overrides has to be a json object of path -> value")
+        inputOverrides, paramOverrides = sweep.split_overrides(overrides)
+        for fileName, fileOverrides in inputOverrides.items():
+            for inputName in fileOverrides:
+                if inputName not in self.model.inputs[fileName]:
+                    raise HTTPError(400, f"{fileName}.{inputName} is not an input of the model")
+        try:
+            sweep.apply_paramOverrides(self.model.build_paramDict(), paramOverrides)
+        except (KeyError, ValueError, TypeError) as err:
+            raise HTTPError(400, str(err).strip("'\""))
+
+        job = Job(total_days, OrderedDict(overrides))
+        self.jobs[job.id] = job
+        self.queue.put_nowait(job)
+        return job
+
+    async def dispatch(self):
+        """Run the queued jobs one at a time on the worker processes (one dispatcher per worker)"""
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            if job.status != "queued":  # cancelled
+                continue
+            job.set_status("running")
+            try:
+                job.result = await loop.run_in_executor(self.executor, _run_task, job.id, job.overrides, job.total_days)
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                job.error = f"{type(err).__name__}: {err}"
+                job.set_status("failed", error=job.error)
+            else:
+                job.set_status("done", result=f"/runs/{job.id}/result")
+            self.forget_old()
+
+    def forward_progress(self, loop):
+        """Hand the progress events of the workers over to the event loop (runs in a thread, until None is received)"""
+        while True:
+            item = self.progressQueue.get()
+            if item is None:
+                return
+            try:
+                loop.call_soon_threadsafe(self.add_progress, *item)
+            except RuntimeError:  # the loop is closed
+                return
+
+    def add_progress(self, jobId, event):
+        job = self.jobs.get(jobId)
+        if job is not None and job.status == "running":
+            job.emit(OrderedDict([("type", "progress")], **event))
+
+    def forget_old(self):
+        finished = [jobId for jobId, job in self.jobs.items() if job.finished]
+        for jobId in finished[: max(len(finished) - self.keepJobs, 0)]:
+            del self.jobs[jobId]
+
+    def get_job(self, jobId):
+        if jobId not in self.jobs:
+            raise HTTPError(404, f"no run {jobId}")
+        return self.jobs[jobId]
+
+    # ## HTTP
+    async def handle(self, reader, writer):
+        try:
+            try:
+                method, path, query, body = await read_request(reader)
+                await self.route(writer, method, path, query, body)
+            except HTTPError as err:
+                await send_json(writer, err.status, OrderedDict([("error", str(err))]))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, writer, method, path, query, body):
+        parts = [part for part in path.split("/") if part]
+        if not parts or parts[0] != "runs" or len(parts) > 3:
+            raise HTTPError(404, f"no resource {path}")
+
+        if len(parts) == 1:
+            if method == "GET":
+                return await send_json(writer, 200, [job.describe() for job in self.jobs.values()])
+            if method == "POST":
+                try:
+                    request = json.loads(body.decode("utf-8") or "null")
+                except ValueError as err:
+                    raise HTTPError(400, f"invalid json: {err}")
+                return await send_json(writer, 202, self.submit(request).describe())
+            raise HTTPError(405, f"{method} is not supported on /runs")
+
+        job = self.get_job(parts[1])
+        if len(parts) == 2:
+            if method == "GET":
+                return await send_json(writer, 200, job.describe())
+            if method == "DELETE":
+                if job.status == "running":
+                    raise HTTPError(409, f"run {job.id} is running")
+                if job.status == "queued":
+                    job.set_status("cancelled")
+                else:
+                    del self.jobs[job.id]
+                return await send_json(writer, 200, job.describe())
+            raise HTTPError(405, f"{method} is not supported on /runs/<id>")
+
+        if method != "GET":
+            raise HTTPError(405, f"{method} is not supported on {path}")
+        if parts[2] == "events":
+            return await send_events(writer, job)
+        if parts[2] == "result":
+            fmt = query.get("format", ["csv"])[0]
+            if fmt not in resultFormats:
+                raise HTTPError(400, f"unknown format {fmt}, expected one of {list(resultFormats)}")
+            if job.status != "done":
+                raise HTTPError(409, f"run {job.id} is {job.status}")
+            # Rendering the table takes a moment, so it is done off the event loop
+            content = await asyncio.get_running_loop().run_in_executor(None, render_result, job.result, fmt)
+            return await send(writer, 200, content, resultFormats[fmt])
+        raise HTTPError(404, f"no resource {path}")
+
+
+def render_result(jobResult, fmt):
+    """The result of a job as the bytes of a csv table, json list of rows, or npy file"""
+    result, startDate, ageGroups = jobResult
+    if fmt == "npy":
+        out = io.BytesIO()
+        np.save(out, result)
+        return out.getvalue()
+    if fmt == "json":
+        df = coexist.result_frame(coexist.reduce_result(result), ageGroups, startDate=startDate)
+        return df.to_json(orient="records").encode()
+    out = io.StringIO()
+    coexist.write_result_csv(out, result, startDate, ageGroups=ageGroups)
+    return out.getvalue().encode()
+
+
+async def read_request(reader):
+    """(method, path, query dictionary, body) of an HTTP/1.1 request"""
+    try:
+        method, target, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise HTTPError(400, "malformed request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise HTTPError(400, "invalid Content-Length")
+    if length > maxRequestBytes:
+        raise HTTPError(413, f"requests are limited to {maxRequestBytes} bytes")
+    body = await reader.readexactly(length) if length > 0 else b""
+    url = urlsplit(target)
+    return method.upper(), url.path, parse_qs(url.query), body
+
+
+def response_head(status, contentType, length=None):
+    head = f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\nContent-Type: {contentType}\r\n"
+    if length is not None:
+        head += f"Content-Length: {length}\r\n"
+    else:
+        head += "Cache-Control: no-cache\r\n"
+    return (head + "Connection: close\r\n\r\n").encode("latin-1")
+
+
+async def send(writer, status, content, contentType):
+    writer.write(response_head(status, contentType, len(content)) + content)
+    await writer.drain()
+
+
+async def send_json(writer, status, value):
+    await send(writer, status, json.dumps(value).encode(), "application/json")
+
+
+async def send_events(writer, job):
+    """Stream the events of a job as server-sent events, until it is finished"""
+    writer.write(response_head(200, "text/event-stream"))
+    async for event in job.iter_events():
+        writer.write(f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode())
+        await writer.drain()
+
+
+async def serve(service, host, port):
+    await service.start()
+    server = await asyncio.start_server(service.handle, host, port)
+    print(f"Serving on http://{host}:{port} with {service.workers} workers", flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    ################### COMMAND LINE ARGS
+    parser = argparse.ArgumentParser(description="Serve COEXIST runs over HTTP")
+    parser.add_argument("-host", dest="host", type=str, default="127.0.0.1", help="Address to listen on (0.0.0.0 in a container)")
+    parser.add_argument("-port", dest="port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument("-workers", dest="workers", type=int, default=None, help="Number of worker processes (default: number of cores)")
+    parser.add_argument("-cache", dest="cache", type=str, nargs="?", const="results/cache", default=None, help="Reuse the stored results of identical runs, from this directory (default results/cache)")
+    parser.add_argument("-keep", dest="keep", type=int, default=100, help="Number of finished runs whose results are kept")
+
+    args = parser.parse_args(argv)
+
+    # Set Working/Data dirs
+    workdir = os.getcwd()
+    data_dir = f"{workdir}/{coexist.data_folder}"
+
+    model = coexist.CoexistModel(data_dir)
+    service = SimulationService(
+        model,
+        workers=args.workers,
+        cacheDir=None if args.cache is None else os.path.join(workdir, args.cache),
+        keepJobs=args.keep,
+    )
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+"""
+Scenario sweeps: run the COEXIST model for a grid (or list) of parameter overrides in a process pool.
+
+################### COMMAND LINE RUN
+# $ python3 sweep.py -days=180 -grid=sweep.json -out=sweep.csv -workers=4
+#
+# sweep.json is either a grid, whose cartesian product is run:
+#     {"user_input.nDaysInHomeIsolation": [7, 14],
+#      "trFunc_newInfections_params.transmissionInfectionStage": [[0.001, 0.1, 0.6, 0.5], [0.002, 0.2, 1.2, 1.0]]}
+# or a list of scenarios:
+#     [{"tStartSocialDistancing": "2021-01-01"}, {"tStartSocialDistancing": "2021-02-01"}]
+#
+# Override paths starting with "user_input." or "sme_input." replace entries of the input json files
+# (everything derived from them is recomputed), any other path is a (dot separated) key of the
+# build_paramDict(dydt_Complete) parameter tree, e.g. "trFunc_testing_params.trFunc_testCapacity_params.testCapacity_pcr_phe_total".
+#
+# The inputs are read once, and their arrays (mixing matrices, initial state, ...) are handed to the workers
+# through shared memory. The transition operator pattern and the time-invariant transition blocks are cheaper to
+# build than to copy, so every worker builds them once (see coexist.rhs_workspace) and reuses them for its scenarios.
+# Every finished scenario is appended to the single output table as it arrives.
+#
+# $ python3 sweep.py -days=365 -grid=exits.json -out=exits.csv -branch
+#
+# runs the scenarios as a scenario tree in this process instead (see coexist.solveSystem_branches): the days that
+# scenarios share are integrated only once. A "branchDay" entry of a scenario is the day from which its overrides apply;
+# without it, scenarios that only override policy dates branch off on the first day the dates change anything.
+"""
+
+import argparse
+import copy
+import itertools
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+import coexist
+
+
+# ## Scenario definitions
+def expand_grid(grid):
+    """
+    List of scenarios (dictionaries of override path -> value) from either
+    a dictionary of override path -> list of values (all combinations are returned),
+    or a list of scenarios (returned as they are)
+    """
+    if isinstance(grid, dict):
+        paths = list(grid.keys())
+        return [
+            OrderedDict(zip(paths, values))
+            for values in itertools.product(*[grid[path] for path in paths])
+        ]
+    return [OrderedDict(overrides) for overrides in grid]
+
+
+def split_overrides(overrides):
+    """Separate the overrides of the input json files from the overrides of the parameter tree"""
+    inputOverrides = OrderedDict([("sme_input", OrderedDict()), ("user_input", OrderedDict())])
+    paramOverrides = OrderedDict()
+    for path, value in overrides.items():
+        fileName, _, inputName = path.partition(".")
+        if fileName in inputOverrides and inputName:
+            inputOverrides[fileName][inputName] = value
+        else:
+            paramOverrides[path] = value
+    return inputOverrides, paramOverrides
+
+
+def convert_like(value, default):
+    """Convert a (json) override value to the type of the parameter it replaces"""
+    if isinstance(default, pd.Timestamp):
+        return pd.to_datetime(value, format="%Y-%m-%d")
+    if isinstance(default, np.ndarray):
+        return np.asarray(value, dtype=default.dtype)
+    return value
+
+
+def apply_paramOverrides(paramDict, paramOverrides):
+    """Set the (dot separated) paths of paramDict to the override values, in place"""
+    for path, value in paramOverrides.items():
+        keys = path.split(".")
+        cur_dict = paramDict
+        for key in keys[:-1]:
+            if not isinstance(cur_dict.get(key), dict):
+                raise KeyError(f"sweep: {path} is not a parameter of the model")
+            cur_dict = cur_dict[key]
+        if keys[-1] not in cur_dict:
+            raise KeyError(f"sweep: {path} is not a parameter of the model")
+        cur_dict[keys[-1]] = convert_like(value, cur_dict[keys[-1]])
+    return paramDict
+
+
+# ## Shared inputs
+class SharedInputs:
+    """
+    The inputs dictionary of a CoexistModel, with every numeric array moved to a shared memory block.
+    Workers attach to the blocks by name (see attach), so the arrays are neither re-read nor re-pickled per task.
+    Use as a context manager, the blocks are freed on exit.
+    """
+
+    def __init__(self, inputs):
+        self.blocks = []
+        self.arrays = OrderedDict()  # input name -> (block name, shape, dtype)
+        self.other = OrderedDict()  # everything else (json inputs, dates, tables), pickled once per worker
+        for key, value in inputs.items():
+            if isinstance(value, np.ndarray) and value.dtype != object and value.nbytes > 0:
+                block = shared_memory.SharedMemory(create=True, size=value.nbytes)
+                np.ndarray(value.shape, dtype=value.dtype, buffer=block.buf)[...] = value
+                self.blocks.append(block)
+                self.arrays[key] = (block.name, value.shape, value.dtype.str)
+            else:
+                self.other[key] = value
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    @staticmethod
+    def attach(arrays, other):
+        """Rebuild the inputs dictionary from the shared blocks (read-only views) and the rest. Returns (inputs, blocks)"""
+        inputs = OrderedDict(other)
+        blocks = []
+        for key, (blockName, shape, dtype) in arrays.items():
+            block = shared_memory.SharedMemory(name=blockName)
+            value = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+            value.setflags(write=False)
+            inputs[key] = value
+            blocks.append(block)
+        return inputs, blocks
+
+
+# State of each worker process, set up once by init_worker
+_workerModel = None
+_workerBlocks = []
+
+
+def init_worker(arrays, other):
+    global _workerModel, _workerBlocks
+    inputs, _workerBlocks = SharedInputs.attach(arrays, other)
+    _workerModel = coexist.CoexistModel.from_inputs(inputs)
+
+
+def scenario_model(baseModel, inputOverrides):
+    """The base model, or a new model with overridden json inputs (sharing the mixing matrices of the base model)"""
+    if not any(inputOverrides.values()):
+        return baseModel
+    sme_input = copy.deepcopy(baseModel.inputs["sme_input"])
+    sme_input.update(inputOverrides["sme_input"])
+    user_input = copy.deepcopy(baseModel.inputs["user_input"])
+    user_input.update(inputOverrides["user_input"])
+    return coexist.CoexistModel(
+        sme_input=sme_input,
+        user_input=user_input,
+        socialMixingBaseline=baseModel.inputs["ageSocialMixingBaseline"],
+        socialMixingDistancing=baseModel.inputs["ageSocialMixingDistancing"],
+    )
+
+
+def run_scenario(baseModel, overrides, total_days, asTable=False):
+    """Solve the system for a single scenario. Returns the solveSystem output, or the results table if asTable"""
+    inputOverrides, paramOverrides = split_overrides(overrides)
+    model = scenario_model(baseModel, inputOverrides)
+    paramDict = apply_paramOverrides(model.build_paramDict(), paramOverrides)
+    result = model.run(total_days, paramDict)
+    if asTable:
+        return model.results_df(result)
+    return result
+
+
+def _run_task(scenario, overrides, total_days, asTable):
+    return scenario, run_scenario(_workerModel, overrides, total_days, asTable=asTable)
+
+
+# ## Sweep runners
+def iter_sweep(model, grid, total_days, max_workers=None, asTable=False):
+    """
+    Run every scenario of the grid (see expand_grid) in a process pool,
+    yielding (scenario index, overrides, result) in order of completion
+    """
+    scenarios = expand_grid(grid)
+    with SharedInputs(model.inputs) as shared:
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=init_worker,
+            initargs=(shared.arrays, shared.other),
+        ) as executor:
+            futures = [
+                executor.submit(_run_task, scenario, overrides, total_days, asTable)
+                for scenario, overrides in enumerate(scenarios)
+            ]
+            for future in as_completed(futures):
+                scenario, result = future.result()
+                yield scenario, scenarios[scenario], result
+
+
+def scenario_columns(overrides):
+    """Override values as table columns (non-scalar values json encoded)"""
+    return OrderedDict(
+        (path, value if np.isscalar(value) else json.dumps(np.asarray(value).tolist()))
+        for path, value in overrides.items()
+    )
+
+
+def run_sweep(model, grid, total_days, outfile, max_workers=None, progress=None):
+    """
+    Run every scenario of the grid, appending each results table (with the scenario index and
+    override values as extra columns) to the csv outfile as soon as the scenario finishes.
+    progress is called with {"done", "total"} (numbers of scenarios) after every scenario.
+    Returns the number of scenarios run.
+    """
+    scenarios = expand_grid(grid)
+    # Every scenario has a column for every override path (empty if the scenario does not override it)
+    paths = list(OrderedDict.fromkeys(path for overrides in scenarios for path in overrides))
+    nDone = 0
+    for scenario, overrides, df in iter_sweep(
+        model, grid, total_days, max_workers=max_workers, asTable=True
+    ):
+        columns = scenario_columns(overrides)
+        for col, path in enumerate(paths):
+            df.insert(col, path, columns.get(path))
+        df.insert(0, "scenario", scenario)
+        df.to_csv(outfile, mode="w" if nDone == 0 else "a", header=(nDone == 0), index=False)
+        nDone += 1
+        if progress is not None:
+            progress(OrderedDict([("done", nDone), ("total", len(scenarios))]))
+    return nDone
+
+
+def run_branches(model, grid, total_days, outfile):
+    """
+    Run every scenario of the grid as a leaf of a scenario tree (see coexist.solveSystem_branches), writing the
+    results tables (with the scenario index and override values as extra columns) to the csv outfile.
+    A "branchDay" override is the day from which the other overrides of the scenario apply.
+    Returns the number of scenarios run.
+    """
+    scenarios = expand_grid(grid)
+    leaves, branchDays = OrderedDict(), OrderedDict()
+    for scenario, overrides in enumerate(scenarios):
+        overrides = OrderedDict(overrides)
+        if "branchDay" in overrides:
+            branchDays[scenario] = overrides.pop("branchDay")
+        inputOverrides, paramOverrides = split_overrides(overrides)
+        leaves[scenario] = apply_paramOverrides(scenario_model(model, inputOverrides).build_paramDict(), paramOverrides)
+
+    results = model.run_branches(total_days, leaves, branchDays=branchDays)
+    # Every scenario has a column for every override path (empty if the scenario does not override it)
+    paths = list(OrderedDict.fromkeys(path for overrides in scenarios for path in overrides))
+    for scenario, result in results.items():
+        df = model.results_df(result)
+        columns = scenario_columns(scenarios[scenario])
+        for col, path in enumerate(paths):
+            df.insert(col, path, columns.get(path))
+        df.insert(0, "scenario", scenario)
+        df.to_csv(outfile, mode="w" if scenario == 0 else "a", header=(scenario == 0), index=False)
+    return len(results)
+
+
+def main(argv=None):
+    ################### COMMAND LINE ARGS
+    parser = argparse.ArgumentParser(description="Run a sweep of scenarios")
+    parser.add_argument("-days", dest="total_days", type=int, help="Number of days to run simulation")
+    parser.add_argument("-grid", dest="gridfile", type=str, help="json file with the grid or list of overrides")
+    parser.add_argument("-out", dest="outfile", type=str, help="Name of output file")
+    parser.add_argument("-workers", dest="workers", type=int, default=None, help="Number of worker processes (default: number of cores)")
+    parser.add_argument("-branch", dest="branch", action="store_true", help="Run the scenarios as a scenario tree, integrating the days they share only once")
+
+    args = parser.parse_args(argv)
+
+    # Set Working/Data dirs
+    workdir = os.getcwd()
+    data_dir = f"{workdir}/{coexist.data_folder}"
+
+    with open(args.gridfile) as jf:
+        grid = json.load(jf)
+
+    print("\n")
+    start_it = datetime.now()
+    print(f"Started at {start_it}")
+    print("Running sweep...")
+
+    model = coexist.CoexistModel(data_dir)
+    if args.branch:
+        nDone = run_branches(model, grid, args.total_days, f"{workdir}/results/{args.outfile}")
+    else:
+        nDone = run_sweep(
+            model,
+            grid,
+            args.total_days,
+            f"{workdir}/results/{args.outfile}",
+            max_workers=args.workers,
+            progress=lambda event: print(f" Scenarios done: {event['done']} / {event['total']}", end="\r"),
+        )
+
+    end_it = datetime.now()
+    print(f"Runtime = {end_it-start_it}")
+    print("\n")
+    print(f"Results of {nDone} scenarios written to {workdir}/results/{args.outfile}")
+    print("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Scenario trees (solveSystem_branches): every leaf gives the results of a separate run with its own parameters,
+whichever node of the tree it branches off.
+"""
+
+import copy
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import coexist
+
+inputs_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "inputs")
+total_days = 100
+
+
+def scenario_tree(paramDict):
+    """Leaves that branch off paramDict, off another leaf, on a given day, and that differ from the start"""
+    start = paramDict["realStartDate"]
+    paramDict["tStopSocialDistancing"] = start + pd.Timedelta(days=40)
+
+    leaves = {}
+    leaves["later"] = copy.deepcopy(paramDict)
+    leaves["later"]["tStopSocialDistancing"] += pd.Timedelta(days=5)
+    # two leaves that branch off "later" (on day 60 and 80), so its checkpoints are used more than once
+    leaves["later+passports"] = copy.deepcopy(leaves["later"])
+    leaves["later+passports"]["tStartImmunityPassports"] = start + pd.Timedelta(days=60)
+    leaves["later+quarantineStop"] = copy.deepcopy(leaves["later"])
+    leaves["later+quarantineStop"]["tStopQuarantineCaseIsolation"] = start + pd.Timedelta(days=80)
+    # a change that is not a policy date, from day 30 on
+    leaves["hospitalMixing"] = copy.deepcopy(paramDict)
+    leaves["hospitalMixing"]["trFunc_newInfections_params"]["withinHospitalSocialMixing"] *= 2
+    # the same change, from the start
+    leaves["hospitalMixingFromStart"] = copy.deepcopy(leaves["hospitalMixing"])
+    return leaves, {"hospitalMixing": 30}
+
+
+def separate_run(model, paramDict, leaf, branchDay, **solverKwargs):
+    """A leaf run on its own: paramDict up to branchDay (if any), the leaf's parameters from then on"""
+    if branchDay is None:
+        return model.run(total_days, leaf, **solverKwargs)
+    checkpoints = {}
+    first = model.run(branchDay, paramDict, checkpointDays=[branchDay], checkpointPath=checkpoints, **solverKwargs)
+    rest = model.run(total_days, leaf, resumeFrom=checkpoints[branchDay], allowParameterChange=True, **solverKwargs)
+    return np.concatenate([first, rest], axis=-1)
+
+
+def test_branch_day():
+    paramDict = coexist.CoexistModel(inputs_dir).build_paramDict()
+    leaves, _ = scenario_tree(paramDict)
+    assert coexist.branch_day(paramDict, leaves["later"], total_days) == 40
+    assert coexist.branch_day(leaves["later"], leaves["later+passports"], total_days) == 60
+    assert coexist.branch_day(leaves["later"], leaves["later+quarantineStop"], total_days) == 80
+    assert coexist.branch_day(paramDict, leaves["hospitalMixing"], total_days) == 0
+
+
+@pytest.mark.parametrize("solverKwargs, tolerance", [({"samplesPerDay": 4}, 1e-12), ({}, 1e-5)])
+def test_leaves_match_separate_runs(solverKwargs, tolerance):
+    model = coexist.CoexistModel(inputs_dir)
+    paramDict = model.build_paramDict()
+    leaves, branchDays = scenario_tree(paramDict)
+
+    results = model.run_branches(total_days, leaves, paramDict=paramDict, branchDays=branchDays, **solverKwargs)
+
+    assert list(results) == list(leaves)
+    for name, leaf in leaves.items():
+        expected = separate_run(model, paramDict, leaf, branchDays.get(name), **solverKwargs)
+        assert results[name].shape == expected.shape
+        np.testing.assert_allclose(results[name], expected, rtol=0, atol=tolerance * np.max(expected), err_msg=name)
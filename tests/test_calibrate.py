@@ -0,0 +1,76 @@
+"""
+Calibration: the likelihoods against scipy.stats, and the expected daily counts of a CalibrationProblem against
+the tracked flows of separate runs.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+import calibrate
+import coexist
+
+inputs_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "inputs")
+
+
+def counts(seed):
+    """observed (nSeries x nDays, with missing values) and expected (nCandidates x nSeries x nDays) counts"""
+    rng = np.random.default_rng(seed)
+    expected = rng.gamma(2.0, 20.0, size=(3, 2, 12))
+    observed = rng.poisson(expected[0]).astype(float)
+    observed[0, [1, 7]] = np.nan
+    return observed, expected
+
+
+def test_poisson_logLikelihood_matches_scipy():
+    observed, expected = counts(0)
+    logLik = calibrate.poisson_logLikelihood(observed, expected)
+    present = ~np.isnan(observed)
+    reference = [np.sum(stats.poisson.logpmf(observed[present], mu[present])) for mu in expected]
+    np.testing.assert_allclose(logLik, reference, rtol=1e-12)
+
+
+def test_negbin_logLikelihood_matches_scipy():
+    observed, expected = counts(1)
+    present = ~np.isnan(observed)
+    for dispersion in [10.0, np.array([2.0, 50.0])]:
+        logLik = calibrate.negbin_logLikelihood(observed, expected, dispersion)
+        # scipy's parametrisation: n = dispersion, p = dispersion / (dispersion + mean)
+        n = np.broadcast_to(np.reshape(dispersion, (-1, 1)), observed.shape)
+        reference = [
+            np.sum(stats.nbinom.logpmf(observed[present], n[present], n[present] / (n[present] + mu[present])))
+            for mu in expected
+        ]
+        np.testing.assert_allclose(logLik, reference, rtol=1e-12)
+
+
+def test_expected_differences_tracked_flows_into_daily_counts():
+    model = coexist.CoexistModel(inputs_dir)
+    observedDays = [2, 3, 9, 20]
+    observations = pd.DataFrame(
+        {"simDay": observedDays, "deaths": [1.0, 2.0, np.nan, 5.0], "hospitalAdmissions": [3.0, 4.0, 6.0, 8.0]}
+    )
+    path = "trFunc_newInfections_params.transmissionInfectionStage"
+    problem = calibrate.CalibrationProblem(
+        model,
+        [{"path": path, "mode": "scale", "bounds": [0.5, 2.0]}],
+        calibrate.read_observations(observations),
+        solverKwargs={"samplesPerDay": 4},
+    )
+    X = np.array([[1.0], [1.5]])
+    expected = problem.expected(X)
+    assert expected.shape == (2, 2, len(observedDays))
+
+    for x, candidateExpected in zip(X, expected):
+        _, flows = model.run(
+            20, problem.paramDict_for(x), samplesPerDay=4, trackFlows=["deaths", "hospitalAdmissions"]
+        )
+        cumulative = flows.sum(axis=1)  # nFlows x days, column k - 1 is simDay k
+        np.testing.assert_array_equal(cumulative[:, 0], 0.0)  # the flows start at 0, on simDay 1
+        for col, simDay in enumerate(observedDays):
+            daily = cumulative[:, simDay - 1] - cumulative[:, simDay - 2]
+            np.testing.assert_allclose(candidateExpected[:, col], daily, rtol=1e-9, atol=1e-9)
+    # a scaled transmission gives more of both
+    assert np.all(expected[1, :, -1] > expected[0, :, -1])
@@ -0,0 +1,43 @@
+"""
+Checkpoints of solveSystem: a run continued from a checkpoint gives the same results as the run that wrote it,
+and only continues with other parameters when asked to.
+"""
+
+import copy
+import os
+
+import numpy as np
+import pytest
+
+import coexist
+
+inputs_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "inputs")
+
+
+@pytest.mark.parametrize("samplesPerDay", [np.inf, 4])
+def test_resumed_run_equals_full_run(tmp_path, samplesPerDay):
+    model = coexist.CoexistModel(inputs_dir)
+    paramDict = model.build_paramDict()
+    checkpointPath = str(tmp_path / "run.day{day}.checkpoint.npz")
+
+    full = model.run(30, paramDict, samplesPerDay=samplesPerDay, checkpointDays=[12], checkpointPath=checkpointPath)
+    resumed = model.run(30, paramDict, samplesPerDay=samplesPerDay, resumeFrom=checkpointPath.format(day=12))
+
+    # the resumed output starts after the checkpoint day (column i is simDay 12 + i + 1)
+    assert resumed.shape == full[..., 12:].shape
+    np.testing.assert_array_equal(resumed, full[..., 12:])
+
+
+def test_resume_with_other_parameters_needs_allowParameterChange():
+    model = coexist.CoexistModel(inputs_dir)
+    paramDict = model.build_paramDict()
+    checkpoints = {}
+    model.run(20, paramDict, checkpointDays=[10], checkpointPath=checkpoints)
+
+    otherParamDict = copy.deepcopy(paramDict)
+    otherParamDict["trFunc_newInfections_params"]["withinHospitalSocialMixing"] *= 2
+    with pytest.raises(ValueError, match="allowParameterChange"):
+        model.run(20, otherParamDict, resumeFrom=checkpoints[10])
+
+    resumed = model.run(20, otherParamDict, resumeFrom=checkpoints[10], allowParameterChange=True)
+    assert resumed.shape[-1] == 10
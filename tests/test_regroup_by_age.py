@@ -0,0 +1,71 @@
+"""
+regroup_by_age (the cached regroup_matrix applied with one tensordot) against the loop over the input age bins that it
+replaced, on age boundaries that do not line up.
+"""
+
+import numpy as np
+import pytest
+
+import coexist
+
+
+def loop_regroup_by_age(inp, fromAgeSplits, toAgeSplits, maxAge=100.0, maxAgeWeight=5.0):
+    """The previous implementation of regroup_by_age (first dimension is ages)"""
+    fromAgeSplits = np.concatenate([np.array([0]), fromAgeSplits, np.array([maxAge])])
+    toAgeSplits = np.concatenate([np.array([0]), toAgeSplits, np.array([maxAge])])
+
+    def getOverlap(a, b):
+        return max(0, min(a[1], b[1]) - max(a[0], b[0]))
+
+    out = np.zeros((len(toAgeSplits) - 1,) + inp.shape[1:])
+    for from_ind in range(1, len(fromAgeSplits)):
+        cur_out_distribution = [
+            getOverlap(
+                toAgeSplits[cur_to_ind - 1 : cur_to_ind + 1],
+                fromAgeSplits[from_ind - 1 : from_ind + 1],
+            )
+            for cur_to_ind in range(1, len(toAgeSplits))
+        ]
+        if cur_out_distribution[-1] > 0:
+            cur_out_distribution[-1] = maxAgeWeight
+        cur_out_distribution = cur_out_distribution / np.sum(cur_out_distribution)
+        for to_ind in range(len(out)):
+            out[to_ind] += cur_out_distribution[to_ind] * inp[from_ind - 1]
+    return out
+
+
+splitCases = [
+    # single year census data to the model age groups
+    (np.arange(1, 100), np.arange(10, 90, 10)),
+    # boundaries that do not line up, fewer and more output bins than input bins
+    (np.array([5, 17, 33, 48, 71, 90]), np.array([10, 25, 40, 65, 85])),
+    (np.array([12.5, 40, 77]), np.array([3, 18, 30, 45, 52, 60, 79, 95])),
+]
+
+
+@pytest.mark.parametrize("fromAgeSplits, toAgeSplits", splitCases)
+@pytest.mark.parametrize("maxAgeWeight", [5.0, 1.0])
+def test_matches_loop(fromAgeSplits, toAgeSplits, maxAgeWeight):
+    rng = np.random.default_rng(len(fromAgeSplits))
+    inp = rng.random((len(fromAgeSplits) + 1, 3, 2)) * 1000
+
+    out = coexist.regroup_by_age(inp, fromAgeSplits, toAgeSplits, maxAgeWeight=maxAgeWeight)
+    expected = loop_regroup_by_age(inp, fromAgeSplits, toAgeSplits, maxAgeWeight=maxAgeWeight)
+
+    assert out.shape == (len(toAgeSplits) + 1, 3, 2)
+    np.testing.assert_allclose(out, expected, rtol=1e-12)
+    # nobody is lost or added
+    np.testing.assert_allclose(out.sum(axis=0), inp.sum(axis=0), rtol=1e-12)
+
+
+def test_other_axis():
+    fromAgeSplits, toAgeSplits = splitCases[1]
+    # a results tensor: 2 x nAge x nHS x nIso x nTest x days
+    result = np.random.default_rng(0).random((2, len(fromAgeSplits) + 1, 8, 4, 4, 3))
+
+    out = coexist.regroup_by_age(result, fromAgeSplits, toAgeSplits, axis=-5)
+
+    expected = np.moveaxis(loop_regroup_by_age(np.moveaxis(result, 1, 0), fromAgeSplits, toAgeSplits), 0, 1)
+    np.testing.assert_allclose(out, expected, rtol=1e-12)
+    with pytest.raises(ValueError, match="fromAgeSplits"):
+        coexist.regroup_by_age(result, fromAgeSplits, toAgeSplits)
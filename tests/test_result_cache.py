@@ -0,0 +1,57 @@
+"""
+Regression tests of the result cache key (paramHash of the parameter tree): runs whose parameter functions differ only
+in their constants, defaults or closures must not share a cache entry.
+"""
+
+import copy
+import functools
+import os
+
+import numpy as np
+
+import coexist
+
+inputs_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "inputs")
+
+
+def test_paramHash_distinguishes_function_constants():
+    low = lambda realTime, **kwargs: (1.5e-4, 0.06)  # noqa: E731
+    high = lambda realTime, **kwargs: (5e-2, 0.30)  # noqa: E731
+    assert coexist.paramHash(low) != coexist.paramHash(high)
+    assert coexist.paramHash(low) == coexist.paramHash(low)
+
+
+def test_paramHash_distinguishes_defaults_closures_and_partials():
+    def scaled(scale):
+        return lambda x: scale * x
+
+    def withDefault(x, scale=1.0):
+        return scale * x
+
+    def withOtherDefault(x, scale=2.0):
+        return scale * x
+
+    assert coexist.paramHash(scaled(1.0)) != coexist.paramHash(scaled(2.0))
+    assert coexist.paramHash(withDefault) != coexist.paramHash(withOtherDefault)
+    assert coexist.paramHash(functools.partial(withDefault, scale=1.0)) != coexist.paramHash(
+        functools.partial(withDefault, scale=2.0)
+    )
+
+    class Callable:
+        def __call__(self, x):
+            return x
+
+    coexist.paramHash(Callable())  # hashed by repr instead of raising
+
+
+def test_result_cache_does_not_mix_up_symptom_functions(tmp_path):
+    model = coexist.CoexistModel(inputs_dir)
+    cache = coexist.ResultCache(tmp_path)
+    results = []
+    for symptoms in [lambda realTime, **kwargs: (1.5e-4, 0.06), lambda realTime, **kwargs: (5e-2, 0.30)]:
+        paramDict = copy.deepcopy(model.build_paramDict())
+        paramDict["trFunc_testing_params"]["policyFunc_params"]["basic_policyFunc_params"]["f_symptoms_nonCOVID"] = symptoms
+        results.append(model.run(10, paramDict, cache=cache))
+        assert np.array_equal(results[-1], model.run(10, paramDict))
+    assert cache.hits == 0
+    assert not np.array_equal(results[0], results[1])
@@ -0,0 +1,82 @@
+"""
+Result files: the full output tensor (save_result_tensor / load_result_tensor, with its json sidecar) and the long
+format results table in each of its formats (write_result_table / read_result_table) read back as they were written.
+"""
+
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import coexist
+
+startDate = "2020-12-14"
+labelColumns = ["timestamp", "arrivalType", "ageGroup", "healthState"]
+
+
+def random_result(nDays=4, seed=0):
+    """A solveSystem output shaped array: 2 x nAge x nHS x nIso x nTest x nDays"""
+    shape = (2, len(coexist.ageGroups), coexist.nHS, coexist.nIso, coexist.nTest, nDays)
+    return np.random.default_rng(seed).random(shape) * 1000
+
+
+@pytest.mark.parametrize("ext", [".npy", ".npz"])
+def test_result_tensor_round_trip(tmp_path, ext):
+    result = random_result()
+    path = str(tmp_path / f"run{ext}")
+
+    sidecar = coexist.save_result_tensor(path, result, startDate, firstDay=3)
+    assert sidecar == path + ".json"
+    with open(sidecar) as jf:
+        assert json.load(jf) == json.loads(json.dumps(coexist.result_axes(result, startDate, firstDay=3)))
+
+    loaded, axes = coexist.load_result_tensor(path)
+    np.testing.assert_array_equal(loaded, result)
+    assert isinstance(loaded, np.memmap) == (ext == ".npy")
+    assert axes["shape"] == list(result.shape)
+    assert axes["axes"][-1] == "simDay" and axes["firstSimDay"] == 3 and axes["startDate"] == startDate
+    assert axes["labels"]["ageGroup"] == coexist.ageGroups
+    assert axes["labels"]["healthState"] == coexist.healthStateNames
+
+
+def test_result_tensor_checks(tmp_path):
+    result = random_result()
+    with pytest.raises(ValueError, match="unknown tensor format"):
+        coexist.save_result_tensor(str(tmp_path / "run.csv"), result, startDate)
+
+    # a sidecar of another output
+    path = str(tmp_path / "run.npy")
+    coexist.save_result_tensor(path, result, startDate)
+    np.save(path, result[..., :2])
+    with pytest.raises(ValueError, match="sidecar"):
+        coexist.load_result_tensor(path)
+
+
+def expected_table(result, firstDay=1):
+    return coexist.result_frame(coexist.reduce_result(result), coexist.ageGroups, startDate=startDate, firstDay=firstDay)
+
+
+def check_table(path):
+    result = random_result(seed=1)
+    coexist.write_result_table(path, result, startDate, firstDay=2)
+    df = coexist.read_result_table(path)
+    # parquet and feather tables store the label columns as categories
+    df = df.astype({col: str for col in labelColumns})
+    expected = expected_table(result, firstDay=2).astype({col: str for col in labelColumns})
+    pd.testing.assert_frame_equal(df, expected, check_dtype=False, rtol=1e-12)
+
+
+def test_result_table_round_trip_csv(tmp_path):
+    check_table(str(tmp_path / "run.csv"))
+    with pytest.raises(ValueError, match="save_result_tensor"):
+        coexist.write_result_table(str(tmp_path / "run.npy"), random_result(), startDate)
+    with pytest.raises(ValueError, match="load_result_tensor"):
+        coexist.read_result_table(str(tmp_path / "run.npz"))
+
+
+@pytest.mark.parametrize("ext", [".parquet", ".feather", ".arrow"])
+def test_result_table_round_trip_arrow(tmp_path, ext):
+    pytest.importorskip("pyarrow")
+    assert coexist.result_format(str(tmp_path / f"run{ext}")) == coexist.tableFormats[ext]
+    check_table(str(tmp_path / f"run{ext}"))
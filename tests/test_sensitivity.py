@@ -0,0 +1,61 @@
+"""
+Sensitivity indices on test functions with known values: Sobol indices of the Ishigami function, and Morris
+elementary effects of a linear model.
+"""
+
+import os
+
+import numpy as np
+
+import coexist
+import sensitivity
+
+inputs_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "inputs")
+
+
+def ishigami(X, a=7.0, b=0.1):
+    x = -np.pi + 2 * np.pi * X  # from the unit cube to [-pi, pi]^3
+    return np.sin(x[:, 0]) + a * np.sin(x[:, 1]) ** 2 + b * x[:, 2] ** 4 * np.sin(x[:, 0])
+
+
+def test_sobol_indices_of_ishigami_function():
+    a, b = 7.0, 0.1
+    variance = a**2 / 8 + b * np.pi**4 / 5 + b**2 * np.pi**8 / 18 + 0.5
+    V1 = 0.5 * (1 + b * np.pi**4 / 5) ** 2
+    V2 = a**2 / 8
+    V13 = b**2 * np.pi**8 * (1 / 18 - 1 / 50)
+    S1 = np.array([V1, V2, 0.0]) / variance
+    ST = np.array([V1 + V13, V2, V13]) / variance
+
+    nSamples = 2**13
+    X = sensitivity.sobol_design(nSamples, 3, seed=0)
+    Y = ishigami(X)[:, None]
+    indices = sensitivity.sobol_indices(Y, nSamples, 3, nBootstrap=20, seed=0)
+
+    assert indices["S1"].shape == (3, 1)
+    np.testing.assert_allclose(indices["S1"][:, 0], S1, atol=0.05)
+    np.testing.assert_allclose(indices["ST"][:, 0], ST, atol=0.05)
+    assert np.all(indices["S1_conf"] > 0) and np.all(indices["ST_conf"] > 0)
+
+
+def test_morris_indices_of_linear_model():
+    coefficients = np.array([3.0, -1.5, 0.0, 0.25])
+    X, order = sensitivity.morris_design(20, 4, levels=4, seed=1)
+    Y = np.stack([X @ coefficients, 2 * X @ coefficients], axis=1)
+    indices = sensitivity.morris_indices(Y, X, order)
+
+    np.testing.assert_allclose(indices["mu"], np.stack([coefficients, 2 * coefficients], axis=1), atol=1e-12)
+    np.testing.assert_allclose(indices["mu_star"], np.abs(np.stack([coefficients, 2 * coefficients], axis=1)), atol=1e-12)
+    np.testing.assert_allclose(indices["sigma"], 0.0, atol=1e-12)
+
+
+def test_analysis_leaves_the_paramDict_of_the_caller():
+    model = coexist.CoexistModel(inputs_dir)
+    paramDict = model.build_paramDict()
+    sensitivity.SensitivityAnalysis(
+        model,
+        {"trFunc_newInfections_params_transmissionInfectionStage": {"mode": "scale", "bounds": [0.5, 2.0]}},
+        10,
+        paramDict=paramDict,
+    )
+    assert paramDict["debugReturnNewPerDay"] is True
@@ -0,0 +1,97 @@
+"""
+Simulation service: the HTTP request parser, and a short run submitted to a server on an ephemeral port, from the
+POST to its result.
+"""
+
+import asyncio
+import io
+import json
+import os
+
+import numpy as np
+import pytest
+
+import coexist
+import service
+
+inputs_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "inputs")
+
+
+def parse(raw):
+    async def read():
+        reader = asyncio.StreamReader()
+        reader.feed_data(raw)
+        reader.feed_eof()
+        return await service.read_request(reader)
+
+    return asyncio.run(read())
+
+
+def test_read_request():
+    body = b'{"days": 3}'
+    raw = b"post /runs/abc/result?format=json&x=1 HTTP/1.1\r\nHost: localhost\r\nContent-Length: %d\r\n\r\n" % len(body)
+    method, path, query, readBody = parse(raw + body)
+    assert (method, path, readBody) == ("POST", "/runs/abc/result", body)
+    assert query == {"format": ["json"], "x": ["1"]}
+
+    with pytest.raises(service.HTTPError) as err:
+        parse(b"nonsense\r\n\r\n")
+    assert err.value.status == 400
+    with pytest.raises(service.HTTPError) as err:
+        parse(b"POST /runs HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % (service.maxRequestBytes + 1))
+    assert err.value.status == 413
+
+
+async def request(port, method, path, body=None):
+    """(status, body) of a request to the server"""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    content = b"" if body is None else json.dumps(body).encode()
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Length: {len(content)}\r\n\r\n".encode() + content)
+    await writer.drain()
+    response = await reader.read()  # the server closes the connection after the response
+    writer.close()
+    head, _, responseBody = response.partition(b"\r\n\r\n")
+    return int(head.split(b" ", 2)[1]), responseBody
+
+
+def test_run_through_the_server():
+    model = coexist.CoexistModel(inputs_dir)
+
+    async def scenario():
+        simulationService = service.SimulationService(model, workers=1)
+        await simulationService.start()
+        server = await asyncio.start_server(simulationService.handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            status, body = await request(port, "POST", "/runs", {"days": 5})
+            assert status == 202
+            job = json.loads(body)
+            assert job["status"] == "queued"
+
+            status, body = await request(port, "POST", "/runs", {"days": 5, "overrides": {"user_input.foo": 1}})
+            assert status == 400 and "user_input.foo" in json.loads(body)["error"]
+            status, _ = await request(port, "GET", f"/runs/{job['id']}/result?format=xml")
+            assert status == 400
+
+            for _ in range(600):
+                status, body = await request(port, "GET", f"/runs/{job['id']}")
+                if json.loads(body)["status"] not in ["queued", "running"]:
+                    break
+                await asyncio.sleep(0.1)
+            assert status == 200 and json.loads(body)["status"] == "done", body
+
+            csvStatus, csv = await request(port, "GET", f"/runs/{job['id']}/result")
+            npyStatus, npy = await request(port, "GET", f"/runs/{job['id']}/result?format=npy")
+            missingStatus, _ = await request(port, "GET", "/runs/nothing/result")
+            return csvStatus, csv, npyStatus, npy, missingStatus
+        finally:
+            server.close()
+            await server.wait_closed()
+            simulationService.close()
+
+    csvStatus, csv, npyStatus, npy, missingStatus = asyncio.run(scenario())
+
+    assert csvStatus == 200 and csv.decode().count("\n") > 1
+    assert npyStatus == 200
+    np.testing.assert_allclose(np.load(io.BytesIO(npy)), model.run(5), rtol=1e-12, atol=0)
+    assert missingStatus == 404
@@ -0,0 +1,40 @@
+"""
+Scenario sweeps: the single output table has one column per override path of any scenario, whatever order the
+scenarios finish in.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+import coexist
+import sweep
+
+inputs_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "inputs")
+
+
+def test_run_sweep_heterogeneous_list_grid(tmp_path):
+    model = coexist.CoexistModel(inputs_dir)
+    grid = [
+        {"tStartSocialDistancing": "2021-01-01"},
+        {"user_input.nDaysInHomeIsolation": 10, "tStopSocialDistancing": "2021-03-01"},
+        {},
+    ]
+    outfile = str(tmp_path / "sweep.csv")
+    assert sweep.run_sweep(model, grid, 3, outfile, max_workers=2) == 3
+
+    overridePaths = ["tStartSocialDistancing", "user_input.nDaysInHomeIsolation", "tStopSocialDistancing"]
+    df = pd.read_csv(outfile, dtype={path: str for path in overridePaths})
+    assert list(df.columns[:4]) == ["scenario"] + overridePaths
+    assert list(df.columns[4:]) == list(model.results_df(model.run(3)).columns)
+    for scenario, overrides in enumerate(grid):
+        rows = df[df["scenario"] == scenario]
+        assert len(rows) > 0
+        for path in overridePaths:
+            if path in overrides:
+                assert (rows[path] == str(overrides[path])).all()
+            else:
+                assert rows[path].isna().all()
+        assert np.issubdtype(rows["simDay"].dtype, np.integer)
+        assert np.isfinite(rows["value"].to_numpy(dtype=float)).all()
@@ -0,0 +1,127 @@
+"""
+The sparse transition operator (TransitionOperator, and the rate vector aligned with its pattern) against the dense
+nAge x nHS x nIso x nTest x nHS x nIso x nTest transition tensor that it replaced, and a short run against the numbers
+of the dense implementation.
+"""
+
+import copy
+import os
+
+import numpy as np
+import pandas as pd
+
+import coexist
+
+package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+inputs_dir = os.path.join(package_dir, "inputs")
+# solveSystem(stateTensor_init, 20, **build_paramDict(dydt_Complete)) of the dense implementation (bundled inputs),
+# summed over the age groups: 2 (states, newOnly) x nHS x nIso x nTest x 20 days
+baseline_file = os.path.join(package_dir, "tests", "data", "baseline_run_20days.npz")
+
+
+def dense_dydt(t, stateTensor, paramDict):
+    """dydt and the transition tensor of the dense implementation (the newOnly copy is not needed here)"""
+    nAge, nHS, nIso, nTest = stateTensor.shape
+    realStartDate = paramDict["realStartDate"]
+
+    def days(date):
+        return (date - realStartDate).days
+
+    trTensor_complete = np.zeros((nAge, nHS, nIso, nTest, nHS, nIso, nTest))
+
+    trTensor_diseaseProgression = paramDict["trFunc_diseaseProgression"](
+        **paramDict["trFunc_diseaseProgression_params"]
+    )
+    for k1 in [0, 1, 2, 3]:
+        np.einsum("ijlml->ijlm", trTensor_complete[:, :, k1, :, :, k1, :])[:] += np.expand_dims(
+            trTensor_diseaseProgression[:, :, k1, :], [2]
+        )
+
+    policySocialDistancing = (t >= days(paramDict["tStartSocialDistancing"])) * (
+        t < days(paramDict["tStopSocialDistancing"])
+    )
+    policyImmunityPassports = (t >= days(paramDict["tStartImmunityPassports"])) * (
+        t < days(paramDict["tStopImmunityPassports"])
+    )
+    np.einsum("iklkl->ikl", trTensor_complete[:, 0, :, :, 1, :, :])[:] += paramDict["trFunc_newInfections"](
+        stateTensor,
+        policySocialDistancing=policySocialDistancing,
+        policyImmunityPassports=policyImmunityPassports,
+        **paramDict["trFunc_newInfections_params"],
+    )
+    trTensor_complete[:, 0, 0, 0, 1, 0, 0] += paramDict["trFunc_travelInfectionRate_ageAdjusted"](
+        t, **paramDict["trFunc_travelInfectionRate_ageAdjusted_params"]
+    )
+
+    for k1 in [0, 1]:
+        np.einsum("ijljl->ijl", trTensor_complete[:, :, k1, :, :, 2, :])[:] += np.expand_dims(
+            paramDict["trFunc_HospitalAdmission"](**paramDict["trFunc_HospitalAdmission_params"]), [2]
+        )
+    np.einsum("ijljl->ijl", trTensor_complete[:, :, 2, :, :, 0, :])[:] += np.expand_dims(
+        paramDict["trFunc_HospitalDischarge"](**paramDict["trFunc_HospitalDischarge_params"]), [2]
+    )
+
+    trTensor_testing = paramDict["trFunc_testing"](
+        stateTensor, t, realStartDate, **paramDict["trFunc_testing_params"]
+    )
+    np.einsum("ijkljkm->ijklm", trTensor_complete)[:] += trTensor_testing
+
+    if (t >= days(paramDict["tStartQuarantineCaseIsolation"])) * (
+        t < days(paramDict["tStopQuarantineCaseIsolation"])
+    ):
+        trTensor_quarantineRate = paramDict["trFunc_quarantine"](
+            t, trTensor_testing, **paramDict["trFunc_quarantine_params"]
+        )
+        trTensor_complete[:, :, 0, :2, :, 0, 1] = 0.0
+        trTensor_complete[:, :, 0, 2:, :, 0, 3] = 0.0
+        np.einsum("ijkj->ijk", trTensor_complete[:, :, 0, :2, :, 1, 1])[:] = trTensor_quarantineRate[:, :, 0, :2, 1]
+        np.einsum("ijkj->ijk", trTensor_complete[:, :, 0, 2:, :, 1, 3])[:] = trTensor_quarantineRate[:, :, 0, 2:, 1]
+        np.einsum("ijkj->ijk", trTensor_complete[:, :, 0, :2, :, 2, 1])[:] = trTensor_quarantineRate[:, :, 0, :2, 2]
+        np.einsum("ijkj->ijk", trTensor_complete[:, :, 0, 2:, :, 2, 3])[:] = trTensor_quarantineRate[:, :, 0, 2:, 2]
+        np.einsum("ijkjk->ijk", trTensor_complete[:, :, 1, :, :, 0, :])[:] = trTensor_quarantineRate[:, :, 1, :, 0]
+
+    np.einsum("ijkljkl->ijkl", trTensor_complete)[:] -= np.einsum("...jkl->...", trTensor_complete)
+    return np.einsum("ijkl,ijklmnp->imnp", stateTensor, trTensor_complete), trTensor_complete
+
+
+def random_state(model, seed):
+    """A state with people in every compartment, around the size of the initial population"""
+    rng = np.random.default_rng(seed)
+    stateTensor = rng.random(model.stateTensor_init.shape)
+    return stateTensor / stateTensor.sum() * model.stateTensor_init.sum()
+
+
+def test_dydt_matches_dense_transition_tensor():
+    model = coexist.CoexistModel(inputs_dir)
+    paramDict = model.build_paramDict()
+    # the quarantine policy on for part of the checked days
+    paramDict["tStartQuarantineCaseIsolation"] = paramDict["realStartDate"] + pd.Timedelta(days=10)
+    paramDict["tStopQuarantineCaseIsolation"] = paramDict["realStartDate"] + pd.Timedelta(days=40)
+
+    for seed, t in enumerate([3.37, 25.5, 60.2]):
+        stateTensor = random_state(model, seed)
+        dydt_expected, trTensor_expected = dense_dydt(t, stateTensor, copy.deepcopy(paramDict))
+
+        dydt, trTensor = coexist.dydt_Complete(
+            t,
+            np.concatenate([stateTensor.reshape(-1)] * 2),
+            **{**copy.deepcopy(paramDict), "debugTransition": True},
+        )
+        dydt = dydt.reshape((2,) + stateTensor.shape)
+
+        scale = np.max(np.abs(dydt_expected))
+        np.testing.assert_allclose(dydt[0], dydt_expected, rtol=0, atol=1e-12 * scale)
+        np.testing.assert_allclose(trTensor, trTensor_expected, rtol=0, atol=1e-12 * np.max(np.abs(trTensor_expected)))
+        # the newOnly copy: every incoming person, the dense tensor without its diagonal
+        trTensor_newOnly = trTensor_expected.copy()
+        np.einsum("ijkljkl->ijkl", trTensor_newOnly)[:] = 0.0
+        np.testing.assert_allclose(
+            dydt[1], np.einsum("ijkl,ijklmnp->imnp", stateTensor, trTensor_newOnly), rtol=0, atol=1e-12 * scale
+        )
+
+
+def test_solveSystem_matches_dense_baseline():
+    model = coexist.CoexistModel(inputs_dir)
+    result = model.run(20, model.build_paramDict())
+    expected = np.load(baseline_file)["ageTotals"]
+    np.testing.assert_allclose(result.sum(axis=1), expected, rtol=0, atol=1e-9 * np.max(expected))